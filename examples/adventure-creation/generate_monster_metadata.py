@@ -9,13 +9,33 @@ Uses OpenAI GPT-4 to semantically analyze monsters and assign appropriate keywor
 import os
 import re
 import json
-import time
+import asyncio
+import argparse
+import hashlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from bs4 import BeautifulSoup
-from openai import OpenAI
+from lxml import etree, html
+from tqdm import tqdm
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, BadRequestError, RateLimitError
 
 # Initialize OpenAI client
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+# Number of monsters sent to the LLM per keyword request
+BATCH_SIZE = 20
+
+# Maximum number of keyword requests in flight at once
+MAX_CONCURRENT_REQUESTS = 10
+
+# Attempts per keyword request when rate limited or timing out
+MAX_ATTEMPTS = 3
+
+# Seconds between status checks when using the Batch API
+BATCH_POLL_INTERVAL = 60
+
+# Save the keyword cache after this many new entries, so a crash loses little work
+CACHE_SAVE_INTERVAL = 50
 
 # Theme Keywords Taxonomy (100 keywords covering major D&D themes)
 THEME_KEYWORDS = [
@@ -69,228 +89,549 @@ COMBAT_ROLES = {
     "infiltrator": "Stealth-based, ambush specialist, espionage"
 }
 
+# Instructions for keyword requests. Identical for every request, so it is sent
+# before the monster details to benefit from provider-side prompt caching
+KEYWORD_SYSTEM_PROMPT = f"""You are analyzing D&D 5e monsters to assign theme keywords for encounter filtering.
+
+AVAILABLE KEYWORDS as id:keyword (choose UP TO 5 per monster that best fit):
+{', '.join(f'{i}:{keyword}' for i, keyword in enumerate(THEME_KEYWORDS))}
+
+INSTRUCTIONS:
+- Choose 3-5 keywords that BEST describe each monster's themes
+- Use semantic understanding: "avoids cities" should NOT get 'urban', but "city guard" should
+- "rarely in water" should NOT get 'underwater', but "aquatic hunter" should
+- Prioritize the most distinctive and useful keywords for encounter filtering
+- Include creature type, environment WHERE APPROPRIATE, and thematic elements
+- Analyze each monster independently
+
+Each monster is numbered like [1]. Return ONLY a JSON object with one result per monster, using the monster's number as id
+and the ids of its chosen keywords (not the keyword names) as keyword_ids:
+{{"results": [{{"id": 1, "keyword_ids": [15, 71, 2]}}, {{"id": 2, "keyword_ids": [25, 48]}}]}}
+
+Use at most 5 keywords, at least 2 per monster. Be selective and semantic."""
+
+# HTML parser shared by all files in a process; the monster pages are UTF-8
+HTML_PARSER = html.HTMLParser(encoding='utf-8')
+
+
+def has_class(class_name):
+    """XPath predicate matching elements with `class_name` among their classes."""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+# Compiled XPath expressions for the stat block elements, evaluated by libxml2
+XPATH_NAME_LINK = etree.XPath(f"//a[{has_class('mon-stat-block-2024__name-link')}]")
+XPATH_TIDBIT_LABELS = etree.XPath(f"//span[{has_class('mon-stat-block-2024__tidbit-label')}]")
+XPATH_NEXT_TIDBIT_DATA = etree.XPath(f"following::span[{has_class('mon-stat-block-2024__tidbit-data')}][1]")
+XPATH_META = etree.XPath(f"//div[{has_class('mon-stat-block-2024__meta')}]")
+XPATH_DESCRIPTION_PARAGRAPHS = etree.XPath(f"(//div[{has_class('mon-details__description-block-content')}])[1]//p")
+XPATH_ABILITY_BLOCKS = etree.XPath(f"//div[{has_class('mon-stat-block-2024__description-block')}]")
+XPATH_ABILITY_HEADINGS = etree.XPath(f".//div[{has_class('mon-stat-block-2024__description-block-heading')}]")
+XPATH_ABILITY_CONTENTS = etree.XPath(f".//div[{has_class('mon-stat-block-2024__description-block-content')}]")
+XPATH_ATTRIBUTE_LABELS = etree.XPath(f"//span[{has_class('mon-stat-block-2024__attribute-label')}]")
+XPATH_NEXT_ATTRIBUTE_VALUE = etree.XPath(
+    f"following::span[{has_class('mon-stat-block-2024__attribute-data-value')}][1]"
+)
+
+# Attribute labels in the stat block mapped to their stats keys
+STAT_LABELS = {'AC': 'ac', 'HP': 'hp', 'Speed': 'speed'}
+
+# Precompiled patterns used for every monster
+CR_PATTERN = re.compile(r'(\d+(?:/\d+)?)')
+NUMBER_PATTERN = re.compile(r'\d+')
+SENTENCE_END_PATTERN = re.compile(r'[.!?]')
+
+# Word groups checked by determine_combat_role. Like the `in` checks they stand
+# for, these match substrings (e.g. 'heal' also matches 'healing')
+ROLE_WORDS = {
+    'infiltrator': {'spy', 'assassin', 'invisible', 'invisibility'},
+    'healing': {'heal', 'cure', 'aid', 'bless'},
+    'summoning': {'summon', 'conjure', 'animate'},
+    'control': {'charm', 'frighten', 'paralyze', 'stun', 'grapple', 'restrain', 'prone'},
+    'area': {'area', 'cone', 'line', 'radius', 'emanation'},
+    'ranged_weapon': {'bow', 'crossbow', 'javelin', 'sling'},
+    'natural_melee': {'melee', 'bite', 'claw'},
+    'ranged': {'ranged', 'range 60', 'range 80', 'range 100', 'range 120', 'range 150'},
+    'defensive': {'protect', 'defend', 'shield', 'guard', 'parry', 'block'},
+    'hiding': {'stealth', 'hide', 'sneak'},
+    'mobile': {'mobile', 'nimble', 'quick', 'agile', 'dart', 'dodge'},
+    'striker': {'multiattack', 'extra damage', 'critical', 'deadly'},
+    'spell': {'spell'},
+    'damage': {'damage'},
+    'melee': {'melee'},
+    'stealth': {'stealth'},
+}
+
+# One bit per word group, so a monster's text reduces to a single integer of
+# features and every role check is a bit test
+ROLE_FLAGS = {group: 1 << i for i, group in enumerate(ROLE_WORDS)}
+
+# Flags set by each word (a word can belong to several groups)
+ROLE_WORD_FLAGS = {
+    word: sum(ROLE_FLAGS[group] for group, words in ROLE_WORDS.items() if word in words)
+    for word in set().union(*ROLE_WORDS.values())
+}
+
+# Finds every role word in one scan; the lookahead reports words that overlap or
+# sit inside other words. No word is a prefix of another, so each position
+# matches at most one word
+ROLE_WORD_PATTERN = re.compile(f"(?=({'|'.join(sorted(ROLE_WORD_FLAGS))}))")
 
-def extract_monster_name(soup):
+
+# Keywords used by extract_basic_keywords when the LLM fails: creature type and
+# alignment keywords found in the creature type, and keywords implied by the name
+FALLBACK_TYPE_KEYWORDS = [
+    'undead', 'fiend', 'elemental', 'fey', 'celestial', 'aberration',
+    'construct', 'dragon', 'giant', 'beast', 'humanoid', 'monstrosity', 'ooze', 'plant',
+    'evil', 'good', 'chaotic', 'lawful'
+]
+FALLBACK_NAME_KEYWORDS = {
+    'cultist': 'cultist', 'pirate': 'pirate', 'bandit': 'bandit',
+    'knight': 'military', 'guard': 'military', 'soldier': 'military',
+    'mage': 'spellcaster', 'wizard': 'spellcaster'
+}
+
+# Lookahead alternations so overlapping keywords are all found in a single scan
+TYPE_KEYWORD_PATTERN = re.compile(f"(?=({'|'.join(FALLBACK_TYPE_KEYWORDS)}))")
+NAME_KEYWORD_PATTERN = re.compile(f"(?=({'|'.join(FALLBACK_NAME_KEYWORDS)}))")
+
+
+def element_text(element, limit=None):
+    """
+    Get an element's text with each text node stripped and joined without spaces.
+    
+    With `limit`, the result is cut to that many characters and the element's
+    text nodes stop being walked once enough text has been collected.
+    """
+    parts = []
+    total = 0
+    for text in element.itertext():
+        text = text.strip()
+        parts.append(text)
+        total += len(text)
+        if limit is not None and total >= limit:
+            break
+    return ''.join(parts)[:limit]
+
+
+def extract_monster_name(tree):
     """Extract monster name from HTML."""
-    name_link = soup.find('a', class_='mon-stat-block-2024__name-link')
-    if name_link:
-        return name_link.get_text(strip=True)
+    name_links = XPATH_NAME_LINK(tree)
+    if name_links:
+        return element_text(name_links[0])
     return None
 
 
-def extract_cr(soup):
+def extract_cr(tree):
     """Extract Challenge Rating from HTML."""
-    cr_tidbit = soup.find('span', class_='mon-stat-block-2024__tidbit-label', string='CR')
-    if cr_tidbit:
-        cr_data = cr_tidbit.find_next('span', class_='mon-stat-block-2024__tidbit-data')
+    for cr_tidbit in XPATH_TIDBIT_LABELS(tree):
+        if element_text(cr_tidbit) != 'CR':
+            continue
+        cr_data = XPATH_NEXT_TIDBIT_DATA(cr_tidbit)
         if cr_data:
-            cr_text = cr_data.get_text(strip=True)
+            cr_text = element_text(cr_data[0])
             # Extract just the CR number (e.g., "3" from "3 (XP 700; PB +2)")
-            match = re.match(r'(\d+(?:/\d+)?)', cr_text)
+            match = CR_PATTERN.match(cr_text)
             if match:
                 return match.group(1)
+        break
     return None
 
 
-def extract_creature_type(soup):
+def extract_creature_type(tree):
     """Extract creature type/meta information."""
-    meta = soup.find('div', class_='mon-stat-block-2024__meta')
+    meta = XPATH_META(tree)
     if meta:
-        return meta.get_text(strip=True)
+        return element_text(meta[0])
     return ""
 
 
-def extract_description(soup):
+def extract_description(tree):
     """Extract monster description."""
-    desc_block = soup.find('div', class_='mon-details__description-block-content')
-    if desc_block:
-        # Get first paragraph as summary
-        first_para = desc_block.find('p')
-        if first_para:
-            return first_para.get_text(strip=True)
+    # Get first paragraph of the first description block as summary
+    paragraphs = XPATH_DESCRIPTION_PARAGRAPHS(tree)
+    if paragraphs:
+        return element_text(paragraphs[0])
     return ""
 
 
-def extract_abilities(soup):
+def extract_abilities(tree):
     """Extract monster abilities and actions."""
     abilities = []
     
     # Get traits
-    trait_blocks = soup.find_all('div', class_='mon-stat-block-2024__description-block')
-    for block in trait_blocks:
-        heading = block.find('div', class_='mon-stat-block-2024__description-block-heading')
+    for block in XPATH_ABILITY_BLOCKS(tree):
+        heading = XPATH_ABILITY_HEADINGS(block)
         if heading:
-            content = block.find('div', class_='mon-stat-block-2024__description-block-content')
+            content = XPATH_ABILITY_CONTENTS(block)
             if content:
                 abilities.append({
-                    'type': heading.get_text(strip=True),
-                    'text': content.get_text(strip=True)[:200]  # First 200 chars
+                    'type': element_text(heading[0]),
+                    'text': element_text(content[0], 200)  # First 200 chars
                 })
     
     return abilities
 
 
-def extract_stats(soup):
+def extract_stats(tree):
     """Extract basic stats (HP, AC, Speed, etc.)"""
     stats = {}
     
-    # AC
-    ac_label = soup.find('span', class_='mon-stat-block-2024__attribute-label', string='AC')
-    if ac_label:
-        ac_value = ac_label.find_next('span', class_='mon-stat-block-2024__attribute-data-value')
-        if ac_value:
-            stats['ac'] = ac_value.get_text(strip=True)
-    
-    # HP
-    hp_label = soup.find('span', class_='mon-stat-block-2024__attribute-label', string='HP')
-    if hp_label:
-        hp_value = hp_label.find_next('span', class_='mon-stat-block-2024__attribute-data-value')
-        if hp_value:
-            stats['hp'] = hp_value.get_text(strip=True)
-    
-    # Speed
-    speed_label = soup.find('span', class_='mon-stat-block-2024__attribute-label', string='Speed')
-    if speed_label:
-        speed_value = speed_label.find_next('span', class_='mon-stat-block-2024__attribute-data-value')
-        if speed_value:
-            stats['speed'] = speed_value.get_text(strip=True)
+    # Single pass over the attribute labels instead of one search per stat
+    for label in XPATH_ATTRIBUTE_LABELS(tree):
+        key = STAT_LABELS.get(element_text(label))
+        if not key or key in stats:
+            continue
+        value = XPATH_NEXT_ATTRIBUTE_VALUE(label)
+        if value:
+            stats[key] = element_text(value[0])
     
     return stats
 
 
+def role_features(text_lower):
+    """Bitmask of the ROLE_WORDS groups with at least one word in the text."""
+    features = 0
+    for word in set(ROLE_WORD_PATTERN.findall(text_lower)):
+        features |= ROLE_WORD_FLAGS[word]
+    return features
+
+
 def determine_combat_role(name, creature_type, abilities, stats, description):
     """Determine combat role based on creature characteristics."""
-    text_to_analyze = f"{name} {creature_type} {description} {' '.join([a.get('text', '') for a in abilities])}"
-    text_lower = text_to_analyze.lower()
+    text_lower = ' '.join((name, creature_type, description, *(a.get('text', '') for a in abilities))).lower()
     
     # Get HP for calculations
     hp = stats.get('hp', '0')
-    hp_val = int(re.search(r'\d+', str(hp)).group() if re.search(r'\d+', str(hp)) else 0)
+    hp_match = NUMBER_PATTERN.search(str(hp))
+    hp_val = int(hp_match.group()) if hp_match else 0
     
     # Get AC for calculations
     ac = stats.get('ac', '0')
-    ac_val = int(re.search(r'\d+', str(ac)).group() if re.search(r'\d+', str(ac)) else 0)
+    ac_match = NUMBER_PATTERN.search(str(ac))
+    ac_val = int(ac_match.group()) if ac_match else 0
+    
+    # Scan the text once; each check below is then a bit test
+    features = role_features(text_lower)
     
     # Priority order for role determination
     
     # 1. Infiltrator - stealth/spy specialists
-    if any(word in text_lower for word in ['spy', 'assassin', 'invisible', 'invisibility']):
+    if features & ROLE_FLAGS['infiltrator']:
         return "infiltrator"
     
     # 2. Support - healers and buffers
-    if any(word in text_lower for word in ['heal', 'cure', 'aid', 'bless']) and 'spell' in text_lower:
-        return "support"
-    if any(word in text_lower for word in ['summon', 'conjure', 'animate']) and 'spell' in text_lower:
-        return "support"
+    if features & ROLE_FLAGS['spell']:
+        if features & ROLE_FLAGS['healing']:
+            return "support"
+        if features & ROLE_FLAGS['summoning']:
+            return "support"
     
     # 3. Controller - battlefield manipulators
-    if any(word in text_lower for word in ['charm', 'frighten', 'paralyze', 'stun', 'grapple', 'restrain', 'prone']):
+    if features & ROLE_FLAGS['control']:
         return "controller"
-    if any(word in text_lower for word in ['area', 'cone', 'line', 'radius', 'emanation']) and 'damage' in text_lower:
+    if features & ROLE_FLAGS['area'] and features & ROLE_FLAGS['damage']:
         return "controller"
     
     # 4. Artillery - ranged attackers
-    if any(word in text_lower for word in ['bow', 'crossbow', 'javelin', 'sling']):
-        if not any(word in text_lower for word in ['melee', 'bite', 'claw']):
+    if features & ROLE_FLAGS['ranged_weapon']:
+        if not features & ROLE_FLAGS['natural_melee']:
             return "artillery"
-    if any(word in text_lower for word in ['ranged', 'range 60', 'range 80', 'range 100', 'range 120', 'range 150']):
-        if 'melee' not in text_lower or text_lower.count('range') > text_lower.count('melee'):
+    if features & ROLE_FLAGS['ranged']:
+        if not features & ROLE_FLAGS['melee'] or text_lower.count('range') > text_lower.count('melee'):
             return "artillery"
     
     # 5. Tank - high HP/AC defenders
     if hp_val >= 100 or ac_val >= 17:
-        if any(word in text_lower for word in ['protect', 'defend', 'shield', 'guard', 'parry', 'block']):
+        if features & ROLE_FLAGS['defensive']:
             return "tank"
         if hp_val >= 150:
             return "tank"
     
     # 6. Skirmisher - mobile hit-and-run
-    if any(word in text_lower for word in ['stealth', 'hide', 'sneak']):
+    if features & ROLE_FLAGS['hiding']:
         if hp_val < 60:
             return "skirmisher"
-    if any(word in text_lower for word in ['mobile', 'nimble', 'quick', 'agile', 'dart', 'dodge']):
+    if features & ROLE_FLAGS['mobile']:
         return "skirmisher"
     if 'speed' in stats and '40 ft' in stats['speed'] or '50 ft' in stats['speed'] or '60 ft' in stats['speed']:
         if hp_val < 50:
             return "skirmisher"
     
     # 7. Striker - high damage dealers (default for most combat creatures)
-    if any(word in text_lower for word in ['multiattack', 'extra damage', 'critical', 'deadly']):
+    if features & ROLE_FLAGS['striker']:
         return "striker"
     
     # Default assignment based on stats
     if hp_val > 100:
         return "tank"
-    elif hp_val < 30 and 'stealth' in text_lower:
+    elif hp_val < 30 and features & ROLE_FLAGS['stealth']:
         return "skirmisher"
     
     return "striker"
 
 
-def determine_theme_keywords(name, creature_type, abilities, description):
+def format_monster_for_prompt(index, monster):
+    """Format one monster's details as a numbered entry in a keyword prompt."""
+    abilities_text = '\n'.join([f"- {a.get('type', 'Ability')}: {a.get('text', '')}" for a in monster['abilities']])
+    description = monster['description']
+    
+    return f"""[{index}]
+MONSTER: {monster['name']}
+TYPE: {monster['creature_type']}
+DESCRIPTION: {description if description else "No description available"}
+
+ABILITIES:
+{abilities_text if abilities_text else "No abilities listed"}"""
+
+
+class KeywordCache:
+    """
+    LLM theme keywords keyed by a hash of the monster details sent to the LLM.
+    
+    Persisted as JSON so re-runs only pay for monsters whose details changed.
     """
-    Use LLM to semantically analyze the monster and assign appropriate theme keywords.
+    
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.unsaved = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+    
+    @staticmethod
+    def key(monster):
+        """Stable hash of the monster details that go into the prompt."""
+        content = json.dumps(
+            [monster['name'], monster['creature_type'], monster['description'], monster['abilities']],
+            ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+    
+    def get(self, monster):
+        return self.entries.get(self.key(monster))
+    
+    def put(self, monster, keywords):
+        self.entries[self.key(monster)] = keywords
+        self.unsaved += 1
+        if self.unsaved >= CACHE_SAVE_INTERVAL:
+            self.save()
+    
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        self.unsaved = 0
+
+
+def build_keyword_request(monsters):
+    """
+    Build the chat completion request body asking the LLM for theme keywords.
     
     The LLM understands context - "rarely seen in cities" won't get 'urban' tag,
     but "city guard" will. This semantic analysis is done once during metadata
     generation, then simple keyword matching is used at runtime.
+    
+    Several monsters are sent in one request to cut API round trips. The
+    instructions and keyword list are the same in every request and go first
+    (as the system message) so the provider can reuse its cached prompt prefix.
     """
     # Prepare context for LLM
-    abilities_text = '\n'.join([f"- {a.get('type', 'Ability')}: {a.get('text', '')}" for a in abilities])
+    monsters_text = '\n\n'.join(format_monster_for_prompt(i, m) for i, m in enumerate(monsters, 1))
+    
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": KEYWORD_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Assign theme keywords to these {len(monsters)} monsters:\n\n{monsters_text}"}
+        ],
+        "temperature": 0.3,
+        "max_tokens": 50 * len(monsters),
+        "response_format": {"type": "json_object"}
+    }
+
+
+def parse_keyword_response(result_text, count):
+    """
+    Parse the LLM's keyword response for a batch of `count` monsters.
+    
+    Returns a list of keyword lists in batch order, with None for any monster
+    the model did not answer for. Raises if the response isn't valid JSON.
+    """
+    # JSON mode guarantees a bare JSON object, no markdown code blocks
+    result = json.loads(result_text)
+    
+    keywords_by_monster = [None] * count
+    for entry in result['results']:
+        index = entry.get('id')
+        if not isinstance(index, int) or not 1 <= index <= count:
+            continue
+        
+        # Map keyword ids back to the approved list, ignoring invalid ids
+        valid_keywords = [
+            THEME_KEYWORDS[i] for i in entry.get('keyword_ids', [])
+            if isinstance(i, int) and 0 <= i < len(THEME_KEYWORDS)
+        ]
+        keywords_by_monster[index - 1] = valid_keywords[:5]  # Maximum 5 keywords
     
-    prompt = f"""You are analyzing a D&D 5e monster to assign theme keywords for encounter filtering.
+    return keywords_by_monster
 
-MONSTER: {name}
-TYPE: {creature_type}
-DESCRIPTION: {description if description else "No description available"}
 
-ABILITIES:
-{abilities_text if abilities_text else "No abilities listed"}
+def apply_theme_keywords(batch, keywords_by_monster, cache):
+    """
+    Store assigned keywords on each monster in the batch.
+    
+    LLM keywords are written through to the cache. Monsters without LLM keywords
+    fall back to basic keyword extraction, which isn't cached so the LLM is tried
+    again next run. Returns the number of monsters that used the fallback.
+    """
+    fallback_count = 0
+    for monster, keywords in zip(batch, keywords_by_monster):
+        if keywords is None:
+            # Fallback to basic extraction from creature type
+            keywords = extract_basic_keywords(monster['name'], monster['creature_type'])
+            fallback_count += 1
+        else:
+            cache.put(monster, keywords)
+        monster['theme_keywords'] = keywords
+    return fallback_count
 
-AVAILABLE KEYWORDS (choose UP TO 5 that best fit):
-{', '.join(THEME_KEYWORDS)}
 
-INSTRUCTIONS:
-- Choose 3-5 keywords that BEST describe this monster's themes
-- Use semantic understanding: "avoids cities" should NOT get 'urban', but "city guard" should
-- "rarely in water" should NOT get 'underwater', but "aquatic hunter" should
-- Prioritize the most distinctive and useful keywords for encounter filtering
-- Include creature type, environment WHERE APPROPRIATE, and thematic elements
+async def determine_theme_keywords_batch(monsters):
+    """
+    Use LLM to semantically analyze a batch of monsters and assign appropriate theme keywords.
+    
+    Returns a list of keyword lists in the same order as `monsters`, with None
+    for any monster the model did not answer for. Raises if the response can't
+    be parsed.
+    """
+    request = build_keyword_request(monsters)
+    
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            response = await client.chat.completions.create(**request)
+            break
+        except (RateLimitError, APITimeoutError, APIConnectionError):
+            if attempt == MAX_ATTEMPTS:
+                raise
+            # Exponential backoff: 2s, 4s, ...
+            await asyncio.sleep(2 ** attempt)
+    
+    return parse_keyword_response(response.choices[0].message.content, len(monsters))
 
-Return ONLY a JSON object with this structure:
-{{"keywords": ["keyword1", "keyword2", "keyword3", "keyword4", "keyword5"]}}
 
-Use at most 5 keywords, at least 2. Be selective and semantic."""
+async def assign_theme_keywords_batch(batch, cache, semaphore, progress):
+    """
+    Assign theme keywords to one batch of monsters.
+    
+    If the response can't be parsed or the request is rejected (e.g. context too
+    long), the batch is split into batches 10% smaller and retried. Monsters that
+    still get no answer fall back to basic keyword extraction.
+    """
+    keywords_by_monster = [None] * len(batch)
+    
+    async with semaphore:
+        try:
+            keywords_by_monster = await determine_theme_keywords_batch(batch)
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError, BadRequestError) as e:
+            if len(batch) > 1:
+                keywords_by_monster = None
+            tqdm.write(f"  ⚠️  Keyword batch of {len(batch)} failed: {e}")
+        except Exception as e:
+            tqdm.write(f"  ⚠️  LLM keyword generation failed: {e}")
+    
+    if keywords_by_monster is None:
+        smaller = max(1, int(len(batch) * 0.9))
+        await asyncio.gather(*[
+            assign_theme_keywords_batch(batch[i:i + smaller], cache, semaphore, progress)
+            for i in range(0, len(batch), smaller)
+        ])
+        return
+    
+    fallback_count = apply_theme_keywords(batch, keywords_by_monster, cache)
+    if fallback_count:
+        tqdm.write(f"  {fallback_count} monsters used fallback keywords")
+    progress.update(len(batch))
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3,
-            max_tokens=150
-        )
-        
-        result_text = response.choices[0].message.content.strip()
-        
-        # Parse JSON response
-        # Handle markdown code blocks if present
-        if '```json' in result_text:
-            result_text = result_text.split('```json')[1].split('```')[0].strip()
-        elif '```' in result_text:
-            result_text = result_text.split('```')[1].split('```')[0].strip()
-        
-        result = json.loads(result_text)
-        keywords = result.get('keywords', [])
-        
-        # Validate keywords are from the approved list
-        valid_keywords = [kw for kw in keywords if kw in THEME_KEYWORDS]
-        
-        return valid_keywords[:5]  # Maximum 5 keywords
-        
-    except Exception as e:
-        print(f"  ⚠️  LLM keyword generation failed for {name}: {e}")
-        # Fallback to basic extraction from creature type
-        return extract_basic_keywords(name, creature_type)
+
+async def assign_theme_keywords(monsters, cache, batch_size=BATCH_SIZE):
+    """
+    Assign theme keywords to all monsters, sending them to the LLM in batches.
+    
+    Batches are requested concurrently, with at most MAX_CONCURRENT_REQUESTS
+    requests in flight to stay within rate limits.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    
+    with tqdm(total=len(monsters), desc='Keywords', unit='mon') as progress:
+        await asyncio.gather(*[
+            assign_theme_keywords_batch(monsters[i:i + batch_size], cache, semaphore, progress)
+            for i in range(0, len(monsters), batch_size)
+        ])
+
+
+async def assign_theme_keywords_batch_api(monsters, cache, batch_size=BATCH_SIZE):
+    """
+    Assign theme keywords to all monsters using the OpenAI Batch API.
+    
+    The Batch API costs about half as much as online requests and isn't subject
+    to online rate limits, but results can take up to 24 hours. Batches without
+    a usable result fall back to basic keyword extraction.
+    """
+    batches = [monsters[i:i + batch_size] for i in range(0, len(monsters), batch_size)]
+    
+    lines = [
+        json.dumps({
+            "custom_id": f"batch-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_keyword_request(batch)
+        }, ensure_ascii=False)
+        for i, batch in enumerate(batches)
+    ]
+    input_file = await client.files.create(
+        file=('keyword-requests.jsonl', '\n'.join(lines).encode('utf-8')),
+        purpose='batch'
+    )
+    
+    job = await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h'
+    )
+    print(f"Created batch job {job.id} with {len(batches)} requests, waiting for results...")
+    
+    while job.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        job = await client.batches.retrieve(job.id)
+        counts = job.request_counts
+        done = f"{counts.completed}/{counts.total}" if counts else "?"
+        print(f"  Batch job {job.status}: {done} requests completed")
+    
+    # Expired jobs may still have partial results
+    results = {}
+    if job.output_file_id:
+        output = await client.files.content(job.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            if response.get('status_code') == 200:
+                results[record['custom_id']] = response['body']['choices'][0]['message']['content']
+    
+    fallback_count = 0
+    for i, batch in enumerate(batches):
+        keywords_by_monster = [None] * len(batch)
+        result_text = results.get(f"batch-{i}")
+        if result_text is not None:
+            try:
+                keywords_by_monster = parse_keyword_response(result_text, len(batch))
+            except (json.JSONDecodeError, KeyError, TypeError, AttributeError) as e:
+                print(f"  ⚠️  Could not parse keywords for batch {i}: {e}")
+        fallback_count += apply_theme_keywords(batch, keywords_by_monster, cache)
+    
+    print(f"Batch job {job.status}: {len(monsters) - fallback_count}/{len(monsters)} monsters got LLM keywords")
 
 
 def extract_basic_keywords(name, creature_type):
@@ -298,30 +639,16 @@ def extract_basic_keywords(name, creature_type):
     Fallback function for basic keyword extraction when LLM fails.
     Only extracts from structured, reliable sources (creature type and name).
     """
-    keywords = []
-    creature_type_lower = creature_type.lower()
+    # One scan per source text finds every keyword it contains
+    type_matches = set(TYPE_KEYWORD_PATTERN.findall(creature_type.lower()))
+    name_matches = set(NAME_KEYWORD_PATTERN.findall(name.lower()))
     
-    # Creature type keywords
-    for keyword in ['undead', 'fiend', 'elemental', 'fey', 'celestial', 'aberration', 
-                    'construct', 'dragon', 'giant', 'beast', 'humanoid', 'monstrosity', 'ooze', 'plant']:
-        if keyword in creature_type_lower:
-            keywords.append(keyword)
-    
-    # Alignment keywords
-    for keyword in ['evil', 'good', 'chaotic', 'lawful']:
-        if keyword in creature_type_lower:
-            keywords.append(keyword)
+    # Creature type and alignment keywords, in taxonomy order
+    keywords = [kw for kw in FALLBACK_TYPE_KEYWORDS if kw in type_matches]
     
     # Name-based keywords
-    name_lower = name.lower()
-    name_keywords = {
-        'cultist': 'cultist', 'pirate': 'pirate', 'bandit': 'bandit',
-        'knight': 'military', 'guard': 'military', 'soldier': 'military',
-        'mage': 'spellcaster', 'wizard': 'spellcaster'
-    }
-    
-    for word, keyword in name_keywords.items():
-        if word in name_lower and keyword not in keywords:
+    for word, keyword in FALLBACK_NAME_KEYWORDS.items():
+        if word in name_matches and keyword not in keywords:
             keywords.append(keyword)
     
     return keywords[:5]
@@ -332,7 +659,7 @@ def generate_summary(name, creature_type, description, cr):
     # Use description if available, otherwise create generic summary
     if description:
         # Truncate to first sentence or ~100 chars
-        sentences = re.split(r'[.!?]', description)
+        sentences = SENTENCE_END_PATTERN.split(description)
         summary = sentences[0].strip() if sentences else description[:100]
         if len(summary) > 120:
             summary = summary[:117] + "..."
@@ -342,27 +669,26 @@ def generate_summary(name, creature_type, description, cr):
     return f"A {creature_type.lower()} of CR {cr}"
 
 
-def process_monster_file(filepath):
-    """Process a single monster HTML file and extract metadata."""
+def parse_monster_file(filepath):
+    """Parse a single monster HTML file and extract metadata (without theme keywords)."""
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
+        with open(filepath, 'rb') as f:
             content = f.read()
         
-        soup = BeautifulSoup(content, 'html.parser')
+        tree = html.document_fromstring(content, parser=HTML_PARSER)
         
-        name = extract_monster_name(soup)
+        name = extract_monster_name(tree)
         if not name:
             return None
         
-        cr = extract_cr(soup)
-        creature_type = extract_creature_type(soup)
-        description = extract_description(soup)
-        abilities = extract_abilities(soup)
-        stats = extract_stats(soup)
+        cr = extract_cr(tree)
+        creature_type = extract_creature_type(tree)
+        description = extract_description(tree)
+        abilities = extract_abilities(tree)
+        stats = extract_stats(tree)
         
-        # Determine combat role and theme keywords
+        # Determine combat role
         combat_role = determine_combat_role(name, creature_type, abilities, stats, description)
-        theme_keywords = determine_theme_keywords(name, creature_type, abilities, description)
         
         # Generate summary
         summary = generate_summary(name, creature_type, description, cr)
@@ -373,8 +699,9 @@ def process_monster_file(filepath):
             "cr": cr,
             "summary": summary,
             "combat_role": combat_role,
-            "theme_keywords": theme_keywords,
-            "creature_type": creature_type
+            "creature_type": creature_type,
+            "description": description,
+            "abilities": abilities
         }
     
     except Exception as e:
@@ -382,8 +709,86 @@ def process_monster_file(filepath):
         return None
 
 
+def to_metadata_entry(monster):
+    """Build the metadata JSON entry for a parsed monster with keywords assigned."""
+    return {
+        "name": monster['name'],
+        "file": monster['file'],
+        "cr": monster['cr'],
+        "summary": monster['summary'],
+        "combat_role": monster['combat_role'],
+        "theme_keywords": monster['theme_keywords'],
+        "creature_type": monster['creature_type']
+    }
+
+
+def cr_sort_key(cr):
+    """Numeric sort key for a CR string such as '3' or '1/8'; unknown CRs sort last."""
+    if not cr or cr == 'Unknown':
+        return (1, 0.0)
+    if '/' in cr:
+        numerator, denominator = cr.split('/')
+        return (0, float(numerator) / float(denominator))
+    return (0, float(cr))
+
+
+def file_stamp(filepath):
+    """Size and modification time of a file, used to detect changed monster files."""
+    stat = filepath.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_unchanged_entries(output_path, stamps_path, monster_files):
+    """
+    Load metadata entries from a previous run for monster files that haven't changed.
+    
+    Returns a dict of file name -> metadata entry. A file counts as unchanged when
+    its size and modification time match the stamp recorded by the previous run.
+    """
+    if not os.path.exists(output_path) or not os.path.exists(stamps_path):
+        return {}
+    
+    with open(output_path, 'r', encoding='utf-8') as f:
+        previous = {m['file']: m for m in json.load(f)['monsters']}
+    with open(stamps_path, 'r', encoding='utf-8') as f:
+        stamps = json.load(f)
+    
+    return {
+        p.name: previous[p.name]
+        for p in monster_files
+        if p.name in previous and stamps.get(p.name) == file_stamp(p)
+    }
+
+
+def write_metadata(output_path, metadata, monsters):
+    """
+    Write the metadata JSON with the monster entries streamed one at a time.
+    
+    Produces the same layout as json.dump(..., indent=2) of the full structure
+    without building all entries, or the whole JSON string, in memory.
+    """
+    # Everything up to the monsters list, which comes last
+    header = json.dumps({**metadata, "monsters": []}, indent=2, ensure_ascii=False)
+    
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(header[:-len('[]\n}')] + '[')
+        count = 0
+        for monster in monsters:
+            entry = json.dumps(monster, indent=2, ensure_ascii=False).replace('\n', '\n    ')
+            f.write(f"{',' if count else ''}\n    {entry}")
+            count += 1
+        f.write('\n  ]\n}' if count else ']\n}')
+
+
 def main():
     """Main function to process all monster files."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--batch-api', action='store_true',
+        help='Use the OpenAI Batch API for keyword generation (about half the cost, results within 24h)'
+    )
+    args = parser.parse_args()
+    
     # Check for API key
     if not os.environ.get("OPENAI_API_KEY"):
         print("ERROR: OPENAI_API_KEY environment variable not set!")
@@ -391,30 +796,63 @@ def main():
         return
     
     monsters_dir = Path('/workspaces/spark-template/monsters')
-    monster_files = list(monsters_dir.glob('*.html'))
+    monster_files = sorted(monsters_dir.glob('*.html'))
     
     print(f"Found {len(monster_files)} monster files")
     print("Processing monsters with LLM-powered keyword analysis...")
     print("(This may take a while - using GPT-4o-mini for semantic keyword assignment)\n")
     
-    monsters = []
+    output_path = '/workspaces/spark-template/monsters-metadata.json'
+    stamps_path = '/workspaces/spark-template/monsters-metadata-stamps.json'
+    
+    # Reuse entries from the previous run for files that haven't changed since
+    unchanged = load_unchanged_entries(output_path, stamps_path, monster_files)
+    files_to_parse = [p for p in monster_files if p.name not in unchanged]
+    print(f"{len(unchanged)} monster files unchanged since the last run, parsing {len(files_to_parse)}\n")
+    
+    parsed = []
     failed_count = 0
     
-    for i, filepath in enumerate(sorted(monster_files), 1):
-        print(f"Processing {i}/{len(monster_files)}: {filepath.name}...", end='')
-        
-        monster_data = process_monster_file(filepath)
-        if monster_data:
-            monsters.append(monster_data)
-            print(f" ✓ [{', '.join(monster_data['theme_keywords'])}]")
+    # Parse all HTML files first (CPU-bound, spread over all cores), then assign
+    # keywords in batched LLM calls from the main process
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(parse_monster_file, files_to_parse, chunksize=8)
+        progress = tqdm(zip(files_to_parse, results), total=len(files_to_parse), desc='Parsing', unit='mon')
+        for filepath, monster_data in progress:
+            if monster_data:
+                parsed.append(monster_data)
+            else:
+                failed_count += 1
+                tqdm.write(f"  ✗ FAILED: {filepath.name}")
+    
+    # Reuse cached keywords, and request each distinct set of monster details only once
+    cache = KeywordCache('/workspaces/spark-template/keyword_cache.json')
+    uncached = {}
+    for monster in parsed:
+        keywords = cache.get(monster)
+        if keywords is not None:
+            monster['theme_keywords'] = keywords
         else:
-            failed_count += 1
-            print(" ✗ FAILED")
-        
-        # Rate limiting: small delay between requests
-        if i % 10 == 0:
-            print(f"  (Processed {i} monsters, taking brief pause...)")
-            time.sleep(1)
+            uncached.setdefault(KeywordCache.key(monster), []).append(monster)
+    to_request = [group[0] for group in uncached.values()]
+    print(f"\n{len(parsed) - sum(len(g) for g in uncached.values())} monsters have cached keywords")
+    
+    if to_request:
+        print(f"Assigning theme keywords to {len(to_request)} monsters in batches of up to {BATCH_SIZE}...\n")
+        if args.batch_api:
+            asyncio.run(assign_theme_keywords_batch_api(to_request, cache))
+        else:
+            asyncio.run(assign_theme_keywords(to_request, cache))
+        cache.save()
+    
+    for group in uncached.values():
+        for duplicate in group[1:]:
+            duplicate['theme_keywords'] = group[0]['theme_keywords']
+    
+    # Combine reused and newly parsed monsters in file order
+    parsed_by_file = {m['file']: m for m in parsed}
+    monsters = [unchanged.get(p.name) or parsed_by_file[p.name] for p in monster_files
+                if p.name in unchanged or p.name in parsed_by_file]
     
     print(f"\n{'='*60}")
     print(f"Successfully processed {len(monsters)} monsters")
@@ -428,14 +866,22 @@ def main():
         "generated": "2025-11-23",
         "description": "Monster metadata for D&D 5e creatures, including CR, combat roles, and theme keywords",
         "combat_roles": COMBAT_ROLES,
-        "theme_keywords": THEME_KEYWORDS,
-        "monsters": monsters
+        "theme_keywords": THEME_KEYWORDS
     }
     
     # Save to JSON
-    output_path = '/workspaces/spark-template/monsters-metadata.json'
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    write_metadata(output_path, metadata, (to_metadata_entry(m) for m in monsters))
+    
+    # Stamp files whose entries are complete. Monsters that fell back to basic
+    # keywords aren't in the keyword cache and are left unstamped, so the LLM is
+    # tried again next run
+    stamps = {
+        m['file']: file_stamp(monsters_dir / m['file'])
+        for m in monsters
+        if m['file'] in unchanged or cache.get(m) is not None
+    }
+    with open(stamps_path, 'w', encoding='utf-8') as f:
+        json.dump(stamps, f)
     
     print(f"\nMetadata saved to: {output_path}")
     
@@ -443,33 +889,29 @@ def main():
     print("\n=== Statistics ===")
     print(f"Total monsters: {len(monsters)}")
     
-    # CR distribution
-    cr_counts = {}
+    # Count CRs, roles and keywords in one pass
+    cr_counts = Counter()
+    role_counts = Counter()
+    keyword_counts = Counter()
     for m in monsters:
-        cr = m.get('cr', 'Unknown')
-        cr_counts[cr] = cr_counts.get(cr, 0) + 1
+        cr_counts[m.get('cr', 'Unknown')] += 1
+        role_counts[m.get('combat_role', 'Unknown')] += 1
+        keyword_counts.update(m.get('theme_keywords', []))
+    
+    # CR distribution
     print(f"\nCR distribution:")
-    for cr in sorted(cr_counts.keys(), key=lambda x: (x.count('/'), float(x.split('/')[0]) if '/' in x else float(x) if x != 'Unknown' else -1)):
-        print(f"  CR {cr}: {cr_counts[cr]}")
+    for cr, count in sorted(cr_counts.items(), key=lambda item: cr_sort_key(item[0])):
+        print(f"  CR {cr}: {count}")
     
     # Role distribution
-    role_counts = {}
-    for m in monsters:
-        role = m.get('combat_role', 'Unknown')
-        role_counts[role] = role_counts.get(role, 0) + 1
     print(f"\nCombat role distribution:")
-    for role, count in sorted(role_counts.items(), key=lambda x: x[1], reverse=True):
+    for role, count in role_counts.most_common():
         print(f"  {role}: {count}")
     
     # Most common keywords
-    keyword_counts = {}
-    for m in monsters:
-        for kw in m.get('theme_keywords', []):
-            keyword_counts[kw] = keyword_counts.get(kw, 0) + 1
     print(f"\nTop 20 theme keywords:")
-    for kw, count in sorted(keyword_counts.items(), key=lambda x: x[1], reverse=True)[:20]:
+    for kw, count in keyword_counts.most_common(20):
         print(f"  {kw}: {count}")
 
-
 if __name__ == '__main__':
     main()
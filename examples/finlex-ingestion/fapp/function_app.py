@@ -1,12 +1,18 @@
 import logging
 import os
+import re
+import hashlib
 import requests
 import zipfile
 import tempfile
 import time
 import traceback
-import xml.etree.ElementTree as ET
-from azure.storage.blob import BlobServiceClient
+from concurrent.futures import ThreadPoolExecutor
+from xml.parsers import expat
+import zstandard
+from remotezip import RemoteZip, RangeNotSupported
+from azure.core.exceptions import HttpResponseError
+from azure.storage.blob import BlobServiceClient, ContentSettings
 import azure.functions as func
 
 # Environment variables
@@ -14,36 +20,150 @@ STORAGE_CONNECTION_STRING = os.getenv("AzureWebJobsStorage")
 FINLEX_URL = os.getenv("FINLEX_URL")
 CONTAINER_NAME = os.getenv("BLOB_CONTAINER_NAME")
 TARGET_YEARS = os.getenv("TARGET_YEARS", "2024,2025").split(",")
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "32"))
+UPLOAD_MAX_ATTEMPTS = 4
+ZSTD_LEVEL = 3
+
+# Matches consolidated statutes of the target years and captures the year and the path below it
+STATUTE_FILE_PATTERN = re.compile(
+    rf"akn/fi/act/statute-consolidated/(?P<year>{'|'.join(map(re.escape, TARGET_YEARS))})/(?P<rest>.*\.xml)"
+)
 
 # Blob client
 blob_service_client = BlobServiceClient.from_connection_string(STORAGE_CONNECTION_STRING)
 container_client = blob_service_client.get_container_client(CONTAINER_NAME)
 
+# Expat reports namespaced element names as '<namespace uri> <local name>'
+AKN_NS = 'http://docs.oasis-open.org/legaldocml/ns/akn/3.0 '
+AKN_DOC_TITLE = AKN_NS + 'docTitle'
+AKN_HEADING = AKN_NS + 'heading'
+AKN_PARAGRAPH = AKN_NS + 'p'
+
 # XML cleanup function
 def extract_text_from_akn(xml_bytes):
     try:
-        root = ET.fromstring(xml_bytes)
-        ns = {'akn': 'http://docs.oasis-open.org/legaldocml/ns/akn/3.0'}
-        lines = []
-
-        title = root.find('.//akn:docTitle', ns)
-        if title is not None and title.text:
-            lines.append(title.text.strip())
-
-        for heading in root.findall('.//akn:heading', ns):
-            if heading.text:
-                lines.append(heading.text.strip())
-
-        for para in root.findall('.//akn:p', ns):
-            if para.text:
-                lines.append(para.text.strip())
-
+        texts = {AKN_DOC_TITLE: [], AKN_HEADING: [], AKN_PARAGRAPH: []}
+        # One entry per open element: [target list or None, slot, text parts until the first child starts]
+        open_elements = []
+
+        def end_text():
+            # Like ElementTree's .text, an element's text stops at its first child
+            top = open_elements[-1]
+            if top[2] is not None:
+                top[0][top[1]] = ''.join(top[2])
+                top[2] = None
+
+        def start(name, attrs):
+            if open_elements:
+                end_text()
+            found = texts.get(name)
+            if found is None:
+                open_elements.append([None, 0, None])
+            else:
+                found.append(None)
+                open_elements.append([found, len(found) - 1, []])
+
+        def characters(data):
+            parts = open_elements[-1][2]
+            if parts is not None:
+                parts.append(data)
+
+        def end(name):
+            end_text()
+            open_elements.pop()
+
+        # Handler-based parse builds no tree at all; buffer_text delivers each text run in one call
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = characters
+        parser.Parse(xml_bytes, True)
+
+        titles = texts[AKN_DOC_TITLE]
+        lines = [titles[0].strip()] if titles and titles[0] else []
+        lines.extend(text.strip() for text in texts[AKN_HEADING] if text)
+        lines.extend(text.strip() for text in texts[AKN_PARAGRAPH] if text)
         return '\n'.join(lines)
     except Exception as e:
         logging.error("Failed to parse XML")
         logging.error(traceback.format_exc())
         return None
 
+def load_existing_md5():
+    """Map blob name -> Content-MD5 for everything already in the container (one LIST, no HEADs)."""
+    return {
+        blob.name: bytes(blob.content_settings.content_md5)
+        for blob in container_client.list_blobs()
+        if blob.content_settings.content_md5
+    }
+
+def upload_with_retry(blob_client, data, content_settings=None):
+    """Upload a blob, backing off when the storage account answers 503 Server Busy."""
+    for attempt in range(UPLOAD_MAX_ATTEMPTS):
+        try:
+            blob_client.upload_blob(data, overwrite=True, max_concurrency=1, content_settings=content_settings)
+            return
+        except HttpResponseError as e:
+            if e.status_code != 503 or attempt == UPLOAD_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+def process_xml_file(item):
+    """Parse one statute XML and upload its cleaned text unless the stored copy is identical.
+
+    Returns True when the blob is uploaded or already up to date.
+    """
+    file_name, short_name, xml_bytes, existing_md5 = item
+    try:
+        clean_text = extract_text_from_akn(xml_bytes)
+        if clean_text:
+            # Stored zstd-compressed; MD5 covers the stored bytes so unchanged text still skips the upload
+            data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(clean_text.encode('utf-8'))
+            md5 = hashlib.md5(data).digest()
+            if md5 == existing_md5:
+                logging.info(f"Unchanged, skipping upload: {short_name}")
+                return True
+
+            blob_client = container_client.get_blob_client(short_name)
+            logging.info(f"Uploading cleaned text {short_name} to Blob Storage...")
+            upload_with_retry(blob_client, data, ContentSettings(
+                content_type='text/plain; charset=utf-8',
+                content_encoding='zstd',
+                content_md5=md5
+            ))
+            logging.info(f"Successfully uploaded: {short_name}")
+            return True
+        logging.warning(f"No content extracted from {file_name}")
+    except Exception as file_error:
+        logging.error(f"Error uploading file: {file_name}")
+        logging.error(traceback.format_exc())
+    return False
+
+def open_finlex_zip():
+    """Open the Finlex archive with HTTP range requests so only the needed entries are fetched.
+
+    Falls back to downloading the whole archive to a temp file if the server ignores Range headers.
+    """
+    logging.info(f"Opening remote archive {FINLEX_URL}")
+    try:
+        return RemoteZip(FINLEX_URL, session=requests.Session(), timeout=300)
+    except RangeNotSupported:
+        logging.warning("Server does not support range requests, downloading the full archive")
+
+    logging.info(f"Starting download from {FINLEX_URL}")
+    with tempfile.NamedTemporaryFile(delete=False) as tmp_zip:
+        response = requests.get(FINLEX_URL, stream=True, timeout=300)
+        response.raise_for_status()
+
+        for chunk in response.iter_content(chunk_size=8192):
+            tmp_zip.write(chunk)
+
+        tmp_zip_path = tmp_zip.name
+        logging.info(f"Download complete. ZIP saved to {tmp_zip_path}")
+
+    return zipfile.ZipFile(tmp_zip_path, 'r')
+
 app = func.FunctionApp()
 
 @app.function_name(name="FinlexIngest")
@@ -57,41 +177,30 @@ def finlex_ingest(mytimer: func.TimerRequest) -> None:
     logging.info("Python timer trigger function executed.")
 
     try:
-        logging.info(f"Starting download from {FINLEX_URL}")
-        with tempfile.NamedTemporaryFile(delete=False) as tmp_zip:
-            response = requests.get(FINLEX_URL, stream=True, timeout=300)
-            response.raise_for_status()
-
-            for chunk in response.iter_content(chunk_size=8192):
-                tmp_zip.write(chunk)
-
-            tmp_zip_path = tmp_zip.name
-            logging.info(f"Download complete. ZIP saved to {tmp_zip_path}")
-
-        with zipfile.ZipFile(tmp_zip_path, 'r') as zip_ref:
+        with open_finlex_zip() as zip_ref:
             file_list = zip_ref.namelist()
             logging.info(f"Found {len(file_list)} files in the ZIP archive.")
 
+            # Stored MD5s let unchanged statutes skip the upload
+            existing_md5 = load_existing_md5()
+
+            # ZipFile is not thread-safe, so read the matching entries serially first
+            items = []
             for file_name in file_list:
-                for year in TARGET_YEARS:
-                    prefix = f"akn/fi/act/statute-consolidated/{year}/"
-                    if file_name.startswith(prefix) and file_name.endswith(".xml"):
-                        try:
-                            logging.info(f"Opening file: {file_name}")
-                            with zip_ref.open(file_name) as file_data:
-                                xml_bytes = file_data.read()
-                                clean_text = extract_text_from_akn(xml_bytes)
-                                if clean_text:
-                                    short_name = file_name.replace(prefix, f"{year}/")
-                                    blob_client = container_client.get_blob_client(short_name)
-                                    logging.info(f"Uploading cleaned text {short_name} to Blob Storage...")
-                                    blob_client.upload_blob(clean_text.encode('utf-8'), overwrite=True)
-                                    logging.info(f"Successfully uploaded: {short_name}")
-                                else:
-                                    logging.warning(f"No content extracted from {file_name}")
-                        except Exception as file_error:
-                            logging.error(f"Error uploading file: {file_name}")
-                            logging.error(traceback.format_exc())
+                match = STATUTE_FILE_PATTERN.fullmatch(file_name)
+                if not match:
+                    continue
+                try:
+                    logging.info(f"Opening file: {file_name}")
+                    with zip_ref.open(file_name) as file_data:
+                        short_name = f"{match['year']}/{match['rest']}"
+                        items.append((file_name, short_name, file_data.read(), existing_md5.get(short_name)))
+                except Exception as file_error:
+                    logging.error(f"Error reading file: {file_name}")
+                    logging.error(traceback.format_exc())
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            list(executor.map(process_xml_file, items))
 
     except Exception as e:
         logging.error("Unexpected error during function execution.")
@@ -1,17 +1,25 @@
+import asyncio
 import logging
 import os
+import re
+import hashlib
 import requests
 import zipfile
 import tempfile
 import time
+import random
 import traceback
-import json
-import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from xml.parsers import expat
 from datetime import datetime
-from io import BytesIO
-from azure.storage.blob import BlobServiceClient
-from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
+import orjson
+import zstandard
+import tiktoken
+from remotezip import RemoteZip, RangeNotSupported
+from azure.core.exceptions import HttpResponseError
+from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.search.documents import SearchIndexingBufferedSender
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     SearchIndex,
@@ -20,8 +28,11 @@ from azure.search.documents.indexes.models import (
     VectorSearch,
     HnswAlgorithmConfiguration,
     VectorSearchProfile,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
 )
-from openai import AzureOpenAI
+from openai import AzureOpenAI, APIConnectionError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 import azure.functions as func
 
 # Environment variables
@@ -29,11 +40,36 @@ STORAGE_ACCOUNT_NAME = os.getenv("STORAGE_ACCOUNT_NAME")
 FINLEX_URL = os.getenv("FINLEX_URL", "https://data.finlex.fi/download/kaikki")
 BLOB_CONTAINER_NAME = os.getenv("BLOB_CONTAINER_NAME", "finlex-raw")
 TARGET_YEARS = os.getenv("TARGET_YEARS", "2024,2025").split(",")
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "32"))
+UPLOAD_MAX_ATTEMPTS = 4
+ZSTD_LEVEL = 3
+ZSTD_FRAME_MAGIC = b'\x28\xb5\x2f\xfd'
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "text-embedding-3-small")
 AZURE_OPENAI_DIMENSIONS = int(os.getenv("AZURE_OPENAI_DIMENSIONS", "1536"))
+EMBEDDING_BATCH_SIZE = 16
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "5"))
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX", "finlex-functions-index")
+INDEXED_CONTAINER_NAME = os.getenv("INDEXED_CONTAINER_NAME", "finlex-indexed")
+
+# Bounded hand-off queues between the process pipeline stages (items are whole blobs)
+RAW_QUEUE_SIZE = 4
+CHUNK_QUEUE_SIZE = 8
+EMBEDDED_QUEUE_SIZE = 8
+
+# Embedding calls pause pre-emptively when the deployment reports less headroom than this
+# (about one round of concurrent 16 x 500-token batches)
+RATE_LIMIT_MIN_REMAINING_REQUESTS = EMBEDDING_WORKERS
+RATE_LIMIT_MIN_REMAINING_TOKENS = EMBEDDING_WORKERS * EMBEDDING_BATCH_SIZE * 500
+RATE_LIMIT_DEFAULT_PAUSE = 10.0
+DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+# Matches consolidated statutes of the target years and captures the year and the path below it
+STATUTE_FILE_PATTERN = re.compile(
+    rf"akn/fi/act/statute-consolidated/(?P<year>{'|'.join(map(re.escape, TARGET_YEARS))})/(?P<rest>.*\.xml)"
+)
 
 # Initialize clients with managed identity
 credential = DefaultAzureCredential()
@@ -43,37 +79,156 @@ blob_service_client = BlobServiceClient(
 )
 container_client = blob_service_client.get_container_client(BLOB_CONTAINER_NAME)
 
+# Token provider caches the bearer token and refreshes it shortly before expiry
+token_provider = get_bearer_token_provider(
+    credential,
+    "https://cognitiveservices.azure.com/.default"
+)
+
 openai_client = AzureOpenAI(
     api_version="2024-02-01",
     azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    azure_ad_token_provider=lambda: credential.get_token("https://cognitiveservices.azure.com/.default").token
+    azure_ad_token_provider=token_provider
 )
+# Chunk sizes are measured with the embedding model's tokenizer
+ENCODING = tiktoken.get_encoding("cl100k_base")
+# Sentence bodies between line breaks and . ! ? terminators
+SENTENCE_PATTERN = re.compile(r'[^.!?\n]+')
+
+# Monotonic time before which embeddings calls wait, set from rate-limit headers
+next_embedding_call_at = 0.0
+
+# Expat reports namespaced element names as '<namespace uri> <local name>'
+AKN_NS = 'http://docs.oasis-open.org/legaldocml/ns/akn/3.0 '
+AKN_DOC_TITLE = AKN_NS + 'docTitle'
+AKN_HEADING = AKN_NS + 'heading'
+AKN_PARAGRAPH = AKN_NS + 'p'
 
 # XML cleanup function (from your working code)
 def extract_text_from_akn(xml_bytes):
     try:
-        root = ET.fromstring(xml_bytes)
-        ns = {'akn': 'http://docs.oasis-open.org/legaldocml/ns/akn/3.0'}
-        lines = []
+        texts = {AKN_DOC_TITLE: [], AKN_HEADING: [], AKN_PARAGRAPH: []}
+        # One entry per open element: [target list or None, slot, text parts until the first child starts]
+        open_elements = []
 
-        title = root.find('.//akn:docTitle', ns)
-        if title is not None and title.text:
-            lines.append(title.text.strip())
+        def end_text():
+            # Like ElementTree's .text, an element's text stops at its first child
+            top = open_elements[-1]
+            if top[2] is not None:
+                top[0][top[1]] = ''.join(top[2])
+                top[2] = None
 
-        for heading in root.findall('.//akn:heading', ns):
-            if heading.text:
-                lines.append(heading.text.strip())
+        def start(name, attrs):
+            if open_elements:
+                end_text()
+            found = texts.get(name)
+            if found is None:
+                open_elements.append([None, 0, None])
+            else:
+                found.append(None)
+                open_elements.append([found, len(found) - 1, []])
+
+        def characters(data):
+            parts = open_elements[-1][2]
+            if parts is not None:
+                parts.append(data)
 
-        for para in root.findall('.//akn:p', ns):
-            if para.text:
-                lines.append(para.text.strip())
+        def end(name):
+            end_text()
+            open_elements.pop()
 
+        # Handler-based parse builds no tree at all; buffer_text delivers each text run in one call
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = characters
+        parser.Parse(xml_bytes, True)
+
+        titles = texts[AKN_DOC_TITLE]
+        lines = [titles[0].strip()] if titles and titles[0] else []
+        lines.extend(text.strip() for text in texts[AKN_HEADING] if text)
+        lines.extend(text.strip() for text in texts[AKN_PARAGRAPH] if text)
         return '\n'.join(lines)
     except Exception as e:
         logging.error("Failed to parse XML")
         logging.error(traceback.format_exc())
         return None
 
+def load_existing_md5():
+    """Map blob name -> Content-MD5 for everything already in the container (one LIST, no HEADs)."""
+    return {
+        blob.name: bytes(blob.content_settings.content_md5)
+        for blob in container_client.list_blobs()
+        if blob.content_settings.content_md5
+    }
+
+def upload_with_retry(blob_client, data, content_settings=None):
+    """Upload a blob, backing off when the storage account answers 503 Server Busy."""
+    for attempt in range(UPLOAD_MAX_ATTEMPTS):
+        try:
+            blob_client.upload_blob(data, overwrite=True, max_concurrency=1, content_settings=content_settings)
+            return
+        except HttpResponseError as e:
+            if e.status_code != 503 or attempt == UPLOAD_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(2 ** attempt)
+
+def process_xml_file(item):
+    """Parse one statute XML and upload its cleaned text unless the stored copy is identical.
+
+    Returns True when the blob is uploaded or already up to date.
+    """
+    file_name, short_name, xml_bytes, existing_md5 = item
+    try:
+        clean_text = extract_text_from_akn(xml_bytes)
+        if clean_text:
+            # Stored zstd-compressed; MD5 covers the stored bytes so unchanged text still skips the upload
+            data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(clean_text.encode('utf-8'))
+            md5 = hashlib.md5(data).digest()
+            if md5 == existing_md5:
+                logging.info(f"Unchanged, skipping upload: {short_name}")
+                return True
+
+            blob_client = container_client.get_blob_client(short_name)
+            logging.info(f"Uploading cleaned text {short_name} to Blob Storage...")
+            upload_with_retry(blob_client, data, ContentSettings(
+                content_type='text/plain; charset=utf-8',
+                content_encoding='zstd',
+                content_md5=md5
+            ))
+            logging.info(f"Successfully uploaded: {short_name}")
+            return True
+        logging.warning(f"No content extracted from {file_name}")
+    except Exception as file_error:
+        logging.error(f"Error uploading file: {file_name}")
+        logging.error(traceback.format_exc())
+    return False
+
+def open_finlex_zip():
+    """Open the Finlex archive with HTTP range requests so only the needed entries are fetched.
+
+    Falls back to downloading the whole archive to a temp file if the server ignores Range headers.
+    """
+    logging.info(f"Opening remote archive {FINLEX_URL}")
+    try:
+        return RemoteZip(FINLEX_URL, session=requests.Session(), timeout=300)
+    except RangeNotSupported:
+        logging.warning("Server does not support range requests, downloading the full archive")
+
+    logging.info(f"Starting download from {FINLEX_URL}")
+    with tempfile.NamedTemporaryFile(delete=False) as tmp_zip:
+        response = requests.get(FINLEX_URL, stream=True, timeout=300)
+        response.raise_for_status()
+
+        for chunk in response.iter_content(chunk_size=8192):
+            tmp_zip.write(chunk)
+
+        tmp_zip_path = tmp_zip.name
+        logging.info(f"Download complete. ZIP saved to {tmp_zip_path}")
+
+    return zipfile.ZipFile(tmp_zip_path, 'r')
+
 app = func.FunctionApp()
 
 @app.function_name(name="ingest_function")
@@ -84,43 +239,30 @@ def ingest_function(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Finlex ingest function started")
 
     try:
-        logging.info(f"Starting download from {FINLEX_URL}")
-        with tempfile.NamedTemporaryFile(delete=False) as tmp_zip:
-            response = requests.get(FINLEX_URL, stream=True, timeout=300)
-            response.raise_for_status()
-
-            for chunk in response.iter_content(chunk_size=8192):
-                tmp_zip.write(chunk)
-
-            tmp_zip_path = tmp_zip.name
-            logging.info(f"Download complete. ZIP saved to {tmp_zip_path}")
-
-        processed_count = 0
-        with zipfile.ZipFile(tmp_zip_path, 'r') as zip_ref:
+        with open_finlex_zip() as zip_ref:
             file_list = zip_ref.namelist()
             logging.info(f"Found {len(file_list)} files in the ZIP archive.")
 
+            # Stored MD5s let unchanged statutes skip the upload
+            existing_md5 = load_existing_md5()
+
+            # ZipFile is not thread-safe, so read the matching entries serially first
+            items = []
             for file_name in file_list:
-                for year in TARGET_YEARS:
-                    prefix = f"akn/fi/act/statute-consolidated/{year}/"
-                    if file_name.startswith(prefix) and file_name.endswith(".xml"):
-                        try:
-                            logging.info(f"Opening file: {file_name}")
-                            with zip_ref.open(file_name) as file_data:
-                                xml_bytes = file_data.read()
-                                clean_text = extract_text_from_akn(xml_bytes)
-                                if clean_text:
-                                    short_name = file_name.replace(prefix, f"{year}/")
-                                    blob_client = container_client.get_blob_client(short_name)
-                                    logging.info(f"Uploading cleaned text {short_name} to Blob Storage...")
-                                    blob_client.upload_blob(clean_text.encode('utf-8'), overwrite=True)
-                                    logging.info(f"Successfully uploaded: {short_name}")
-                                    processed_count += 1
-                                else:
-                                    logging.warning(f"No content extracted from {file_name}")
-                        except Exception as file_error:
-                            logging.error(f"Error uploading file: {file_name}")
-                            logging.error(traceback.format_exc())
+                match = STATUTE_FILE_PATTERN.fullmatch(file_name)
+                if not match:
+                    continue
+                try:
+                    logging.info(f"Opening file: {file_name}")
+                    with zip_ref.open(file_name) as file_data:
+                        short_name = f"{match['year']}/{match['rest']}"
+                        items.append((file_name, short_name, file_data.read(), existing_md5.get(short_name)))
+                except Exception as file_error:
+                    logging.error(f"Error reading file: {file_name}")
+                    logging.error(traceback.format_exc())
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            processed_count = sum(executor.map(process_xml_file, items))
 
         duration = time.time() - start_time
         message = f"Function execution completed in {duration:.2f} seconds. Processed {processed_count} files."
@@ -134,41 +276,50 @@ def ingest_function(req: func.HttpRequest) -> func.HttpResponse:
 
 
 def chunk_text(text: str, max_tokens: int = 500, overlap_tokens: int = 50) -> list:
-    """Chunk text using character-based estimation (approximates 4 chars = 1 token)."""
-    max_chars = max_tokens * 4
-    overlap_chars = overlap_tokens * 4
+    """Chunk text on sentence boundaries, measuring sizes in exact tiktoken tokens."""
+    # Split into sentences in one regex pass; every sentence ends with '.'
+    sentences = [
+        sentence + '.'
+        for match in SENTENCE_PATTERN.finditer(text)
+        if (sentence := match.group().strip())
+    ]
     
-    # Split into sentences
-    sentences = []
-    for line in text.split('\n'):
-        line = line.strip()
-        if line:
-            # Simple sentence splitting
-            parts = line.replace('!', '.').replace('?', '.').split('.')
-            sentences.extend([s.strip() + '.' for s in parts if s.strip()])
+    # Token-count every sentence in one batch; sentences longer than a chunk are cut into token windows
+    pieces = []
+    for sentence, token_ids in zip(sentences, ENCODING.encode_ordinary_batch(sentences)):
+        if len(token_ids) <= max_tokens:
+            pieces.append((sentence, len(token_ids)))
+            continue
+        for start in range(0, len(token_ids), max_tokens - overlap_tokens):
+            window = token_ids[start:start + max_tokens]
+            pieces.append((ENCODING.decode(window), len(window)))
+            if start + max_tokens >= len(token_ids):
+                break
     
     chunks = []
     current_chunk = []
+    current_lengths = []
     current_length = 0
     
-    for sentence in sentences:
-        sentence_length = len(sentence)
-        
-        if current_length + sentence_length > max_chars and current_chunk:
+    for piece, piece_length in pieces:
+        if current_length + piece_length > max_tokens and current_chunk:
             # Save current chunk
             chunks.append(' '.join(current_chunk))
             
-            # Start new chunk with overlap (last 3 sentences)
-            overlap_text = ' '.join(current_chunk[-3:])
-            if len(overlap_text) < overlap_chars:
+            # Start new chunk with overlap (last 3 sentences) when it still leaves room for this piece
+            overlap_length = sum(current_lengths[-3:])
+            if overlap_length < overlap_tokens and overlap_length + piece_length <= max_tokens:
                 current_chunk = current_chunk[-3:]
-                current_length = len(overlap_text)
+                current_lengths = current_lengths[-3:]
+                current_length = overlap_length
             else:
                 current_chunk = []
+                current_lengths = []
                 current_length = 0
         
-        current_chunk.append(sentence)
-        current_length += sentence_length
+        current_chunk.append(piece)
+        current_lengths.append(piece_length)
+        current_length += piece_length
     
     if current_chunk:
         chunks.append(' '.join(current_chunk))
@@ -176,19 +327,103 @@ def chunk_text(text: str, max_tokens: int = 500, overlap_tokens: int = 50) -> li
     return chunks
 
 
+def parse_reset_seconds(value):
+    """Parse a rate-limit reset header ('1.5', '20ms', '6m0s') into seconds, or None."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parts = DURATION_PATTERN.findall(value)
+        return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts) if parts else None
+
+
+def parse_remaining(value):
+    """Parse an x-ratelimit-remaining-* header into an int, or None if it is missing or not a number."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def update_rate_limit_pause(headers, exhausted=False):
+    """Push back the next embeddings call when the x-ratelimit-* headers show little headroom left."""
+    global next_embedding_call_at
+    # A malformed header is ignored rather than failing the call that returned it
+    remaining_requests = parse_remaining(headers.get("x-ratelimit-remaining-requests"))
+    remaining_tokens = parse_remaining(headers.get("x-ratelimit-remaining-tokens"))
+    running_low = (
+        (remaining_requests is not None and remaining_requests < RATE_LIMIT_MIN_REMAINING_REQUESTS)
+        or (remaining_tokens is not None and remaining_tokens < RATE_LIMIT_MIN_REMAINING_TOKENS)
+    )
+    if not (exhausted or running_low):
+        return
+
+    pause = (
+        parse_reset_seconds(headers.get("retry-after"))
+        or parse_reset_seconds(headers.get("x-ratelimit-reset-tokens"))
+        or parse_reset_seconds(headers.get("x-ratelimit-reset-requests"))
+        or RATE_LIMIT_DEFAULT_PAUSE
+    )
+    logging.info(f"Embedding rate limit running low, pausing calls for {pause:.1f} seconds")
+    next_embedding_call_at = max(next_embedding_call_at, time.monotonic() + pause)
+
+
+@retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=1, max=60),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError)),
+    reraise=True
+)
 def generate_embeddings(texts: list[str]) -> list[list[float]]:
-    """Generate embeddings using Azure OpenAI."""
+    """Generate embeddings using Azure OpenAI, retrying on 429s and connection errors."""
+    wait = next_embedding_call_at - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+
     try:
-        response = openai_client.embeddings.create(
+        raw_response = openai_client.embeddings.with_raw_response.create(
             model=AZURE_OPENAI_DEPLOYMENT,
             input=texts,
             dimensions=AZURE_OPENAI_DIMENSIONS
         )
-        return [item.embedding for item in response.data]
+    except RateLimitError as e:
+        logging.warning(f"Embedding request rate limited: {e}")
+        update_rate_limit_pause(e.response.headers, exhausted=True)
+        raise
     except Exception as e:
         logging.error(f"Embedding generation failed: {e}")
         raise
 
+    update_rate_limit_pause(raw_response.headers)
+    response = raw_response.parse()
+    return [item.embedding for item in response.data]
+
+
+def embed_chunks(chunks: list[str]) -> list[list[float]]:
+    """Embed chunks in concurrent batches, returning embeddings in chunk order.
+
+    Repeated chunks (statute boilerplate) are embedded once and shared by every position.
+    """
+    unique_index = {}
+    unique_chunks = []
+    positions = []
+    for chunk in chunks:
+        if chunk not in unique_index:
+            unique_index[chunk] = len(unique_chunks)
+            unique_chunks.append(chunk)
+        positions.append(unique_index[chunk])
+
+    with ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS) as executor:
+        futures = []
+        for i in range(0, len(unique_chunks), EMBEDDING_BATCH_SIZE):
+            # Small jitter so the batches don't hit the deployment as one burst
+            time.sleep(random.uniform(0, 0.05))
+            futures.append(executor.submit(generate_embeddings, unique_chunks[i:i + EMBEDDING_BATCH_SIZE]))
+        unique_embeddings = [embedding for future in futures for embedding in future.result()]
+
+    return [unique_embeddings[position] for position in positions]
+
 
 def ensure_search_index():
     """Create AI Search index if it doesn't exist."""
@@ -215,15 +450,31 @@ def ensure_search_index():
             name="embedding",
             type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
             vector_search_dimensions=AZURE_OPENAI_DIMENSIONS,
-            vector_search_profile_name="default-profile"
+            vector_search_profile_name="default-profile",
+            # Vectors are only searched, never returned; skip the retrievable full-precision copy
+            hidden=True,
+            stored=False
         ),
         SearchField(name="year", type=SearchFieldDataType.String, filterable=True),
         SearchField(name="indexed_at", type=SearchFieldDataType.DateTimeOffset, filterable=True),
     ]
     
+    # HNSW runs on int8 scalar-quantized vectors; the top candidates are rescored with the originals
     vector_search = VectorSearch(
         algorithms=[HnswAlgorithmConfiguration(name="default-algo")],
-        profiles=[VectorSearchProfile(name="default-profile", algorithm_configuration_name="default-algo")]
+        compressions=[
+            ScalarQuantizationCompression(
+                compression_name="sq8",
+                rerank_with_original_vectors=True,
+                default_oversampling=4.0,
+                parameters=ScalarQuantizationParameters(quantized_data_type="int8")
+            )
+        ],
+        profiles=[VectorSearchProfile(
+            name="default-profile",
+            algorithm_configuration_name="default-algo",
+            compression_name="sq8"
+        )]
     )
     
     index = SearchIndex(
@@ -236,6 +487,133 @@ def ensure_search_index():
     logging.info(f"Created index {AZURE_SEARCH_INDEX}")
 
 
+def log_index_error(action):
+    """Log documents the buffered sender could not index after its retries."""
+    logging.error(f"Failed to index document {action.additional_properties.get('id')}")
+
+
+def load_indexed_etags() -> dict:
+    """Map source blob name -> etag it had when last indexed, from marker blobs (one LIST call)."""
+    indexed_container = blob_service_client.get_container_client(INDEXED_CONTAINER_NAME)
+    if not indexed_container.exists():
+        indexed_container.create_container()
+        return {}
+    return {
+        marker.name[:-len(".indexed")]: marker.metadata.get("source_etag")
+        for marker in indexed_container.list_blobs(include=["metadata"])
+    }
+
+
+def mark_indexed(blob_item):
+    """Record that this version of a source blob has been indexed."""
+    marker_client = blob_service_client.get_blob_client(INDEXED_CONTAINER_NAME, f"{blob_item.name}.indexed")
+    marker_client.upload_blob(b"", overwrite=True, metadata={"source_etag": blob_item.etag.strip('"')})
+
+
+async def run_process_pipeline(container_client, pending_blobs, search_sender):
+    """
+    Stream blobs through reader -> chunker -> embedder -> indexer stages joined by bounded queues,
+    so the next blob downloads and the previous one is indexed while embeddings are requested.
+    Returns the (blob_item, doc_id) pairs queued for indexing and the number of chunks queued.
+    """
+    raw_queue = asyncio.Queue(RAW_QUEUE_SIZE)
+    chunk_queue = asyncio.Queue(CHUNK_QUEUE_SIZE)
+    embedded_queue = asyncio.Queue(EMBEDDED_QUEUE_SIZE)
+    queued_blobs = []
+    total_chunks = 0
+
+    def download(blob_item):
+        blob_data = container_client.get_blob_client(blob_item.name).download_blob().readall()
+        # Skip when the HTTP stack has already decoded the body (it then no longer starts with the frame magic)
+        if blob_item.content_settings.content_encoding == 'zstd' and blob_data[:4] == ZSTD_FRAME_MAGIC:
+            blob_data = zstandard.ZstdDecompressor().decompress(blob_data)
+        json_content = orjson.loads(blob_data)
+        # The later stages read fields from the document; anything else is skipped like unreadable JSON
+        if not isinstance(json_content, dict):
+            raise ValueError(f"expected a JSON object, got {type(json_content).__name__}")
+        return json_content
+
+    async def reader():
+        for blob_item in pending_blobs:
+            try:
+                json_content = await asyncio.to_thread(download, blob_item)
+            except Exception as e:
+                logging.error(f"Error reading {blob_item.name}: {e}")
+                continue
+            await raw_queue.put((blob_item, json_content))
+        await raw_queue.put(None)
+
+    async def chunker():
+        while (item := await raw_queue.get()) is not None:
+            blob_item, json_content = item
+            content = json_content.get("content", "")
+            if not content:
+                logging.warning(f"No content in {blob_item.name}, skipping")
+                continue
+            try:
+                chunks = await asyncio.to_thread(chunk_text, content, 500, 50)
+            except Exception as e:
+                logging.error(f"Error chunking {blob_item.name}: {e}")
+                continue
+            if not chunks:
+                logging.warning(f"No chunks created from {blob_item.name}")
+                continue
+            await chunk_queue.put((blob_item, json_content, chunks))
+        await chunk_queue.put(None)
+
+    async def embedder():
+        while (item := await chunk_queue.get()) is not None:
+            blob_item, json_content, chunks = item
+            try:
+                # Concurrent batches of up to 16
+                all_embeddings = await asyncio.to_thread(embed_chunks, chunks)
+
+                doc_id = json_content.get("id") or json_content.get("number") or blob_item.name
+                title = json_content.get("title", "Untitled")
+                year = blob_item.name.split('/')[0]  # Extract year from path
+
+                # Prepare documents for indexing; per-document values are computed once
+                id_prefix = f"{doc_id}_".replace('/', '_').replace(':', '_')
+                indexed_at = datetime.utcnow().isoformat()
+                documents = []
+                for idx, (chunk, embedding) in enumerate(zip(chunks, all_embeddings)):
+                    doc = {
+                        "id": id_prefix + str(idx),
+                        "doc_id": doc_id,
+                        "title": title,
+                        "chunk_id": idx,
+                        "content": chunk,
+                        "embedding": embedding,
+                        "year": year,
+                        "indexed_at": indexed_at
+                    }
+                    documents.append(doc)
+            except Exception as e:
+                logging.error(f"Error embedding {blob_item.name}: {e}")
+                continue
+            await embedded_queue.put((blob_item, doc_id, documents))
+        await embedded_queue.put(None)
+
+    async def indexer():
+        nonlocal total_chunks
+        while (item := await embedded_queue.get()) is not None:
+            blob_item, doc_id, documents = item
+            try:
+                # Queue for AI Search; the sender flushes in batches
+                await asyncio.to_thread(search_sender.upload_documents, documents=documents)
+            except Exception as e:
+                logging.error(f"Error indexing {blob_item.name}: {e}")
+                continue
+            queued_blobs.append((blob_item, doc_id))
+            total_chunks += len(documents)
+
+            if len(queued_blobs) % 10 == 0:
+                logging.info(f"Processed {len(queued_blobs)}/{len(pending_blobs)} blobs, {total_chunks} chunks indexed")
+
+    await asyncio.gather(reader(), chunker(), embedder(), indexer())
+    return queued_blobs, total_chunks
+
+
 @app.function_name(name="process_function")
 @app.route(route="process", methods=["POST"], auth_level=func.AuthLevel.FUNCTION)
 def process_function(req: func.HttpRequest) -> func.HttpResponse:
@@ -257,80 +635,43 @@ def process_function(req: func.HttpRequest) -> func.HttpResponse:
         if not blob_list:
             return func.HttpResponse("No JSON blobs found in container", status_code=200)
         
+        # Skip blobs whose current version was already indexed by an earlier run
+        indexed_etags = load_indexed_etags()
+        pending_blobs = [b for b in blob_list if indexed_etags.get(b.name) != b.etag.strip('"')]
+        logging.info(f"{len(blob_list) - len(pending_blobs)} blobs already indexed, {len(pending_blobs)} to process")
+        
+        if not pending_blobs:
+            return func.HttpResponse(f"All {len(blob_list)} JSON blobs are already indexed", status_code=200)
+        
         # Ensure index exists
         ensure_search_index()
         
-        total_chunks = 0
-        processed_blobs = 0
+        failed_doc_ids = set()
         
-        # Process each blob
-        for blob_item in blob_list:
+        def on_index_error(action):
+            log_index_error(action)
+            failed_doc_ids.add(action.additional_properties.get("doc_id"))
+        
+        # One buffered sender batches, retries and flushes uploads across all blobs
+        with SearchIndexingBufferedSender(
+            endpoint=AZURE_SEARCH_ENDPOINT,
+            index_name=AZURE_SEARCH_INDEX,
+            credential=credential,
+            on_error=on_index_error
+        ) as search_sender:
+            queued_blobs, total_chunks = asyncio.run(
+                run_process_pipeline(container_client, pending_blobs, search_sender)
+            )
+        processed_blobs = len(queued_blobs)
+        
+        # The sender has flushed; mark blobs whose chunks all made it into the index
+        for blob_item, doc_id in queued_blobs:
+            if doc_id in failed_doc_ids:
+                continue
             try:
-                # Download blob
-                blob_client = container_client.get_blob_client(blob_item.name)
-                blob_data = blob_client.download_blob().readall()
-                json_content = json.loads(blob_data.decode('utf-8'))
-                
-                doc_id = json_content.get("id") or json_content.get("number") or blob_item.name
-                title = json_content.get("title", "Untitled")
-                content = json_content.get("content", "")
-                year = blob_item.name.split('/')[0]  # Extract year from path
-                
-                if not content:
-                    logging.warning(f"No content in {blob_item.name}, skipping")
-                    continue
-                
-                # Chunk text
-                chunks = chunk_text(content, max_tokens=500, overlap_tokens=50)
-                if not chunks:
-                    logging.warning(f"No chunks created from {blob_item.name}")
-                    continue
-                
-                # Generate embeddings (batch up to 16 at a time)
-                all_embeddings = []
-                batch_size = 16
-                for i in range(0, len(chunks), batch_size):
-                    batch = chunks[i:i + batch_size]
-                    embeddings = generate_embeddings(batch)
-                    all_embeddings.extend(embeddings)
-                
-                # Prepare documents for indexing
-                documents = []
-                for idx, (chunk, embedding) in enumerate(zip(chunks, all_embeddings)):
-                    doc = {
-                        "id": f"{doc_id}_{idx}".replace('/', '_').replace(':', '_'),
-                        "doc_id": doc_id,
-                        "title": title,
-                        "chunk_id": idx,
-                        "content": chunk,
-                        "embedding": embedding,
-                        "year": year,
-                        "indexed_at": datetime.utcnow().isoformat()
-                    }
-                    documents.append(doc)
-                
-                # Upload to AI Search
-                search_client = SearchClient(
-                    endpoint=AZURE_SEARCH_ENDPOINT,
-                    index_name=AZURE_SEARCH_INDEX,
-                    credential=credential
-                )
-                
-                # Upload in batches of 100
-                for i in range(0, len(documents), 100):
-                    batch = documents[i:i + 100]
-                    result = search_client.upload_documents(documents=batch)
-                    succeeded = sum(1 for r in result if r.succeeded)
-                
-                total_chunks += len(documents)
-                processed_blobs += 1
-                
-                if processed_blobs % 10 == 0:
-                    logging.info(f"Processed {processed_blobs}/{len(blob_list)} blobs, {total_chunks} chunks indexed")
-                    
+                mark_indexed(blob_item)
             except Exception as e:
-                logging.error(f"Error processing {blob_item.name}: {e}")
-                continue
+                logging.error(f"Failed to mark {blob_item.name} as indexed: {e}")
         
         message = f"Success: Processed {processed_blobs} blobs, indexed {total_chunks} chunks"
         logging.info(message)
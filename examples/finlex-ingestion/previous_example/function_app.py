@@ -6,6 +6,7 @@ import tempfile
 import time
 import traceback
 import xml.etree.ElementTree as ET
+from io import BytesIO
 from azure.storage.blob import BlobServiceClient
 import azure.functions as func
 
@@ -19,25 +20,36 @@ TARGET_YEARS = os.getenv("TARGET_YEARS", "2024,2025").split(",")
 blob_service_client = BlobServiceClient.from_connection_string(STORAGE_CONNECTION_STRING)
 container_client = blob_service_client.get_container_client(CONTAINER_NAME)
 
+AKN_NS = '{http://docs.oasis-open.org/legaldocml/ns/akn/3.0}'
+AKN_DOC_TITLE = AKN_NS + 'docTitle'
+AKN_HEADING = AKN_NS + 'heading'
+AKN_PARAGRAPH = AKN_NS + 'p'
+
 # XML cleanup function
 def extract_text_from_akn(xml_bytes):
     try:
-        root = ET.fromstring(xml_bytes)
-        ns = {'akn': 'http://docs.oasis-open.org/legaldocml/ns/akn/3.0'}
-        lines = []
-
-        title = root.find('.//akn:docTitle', ns)
-        if title is not None and title.text:
-            lines.append(title.text.strip())
-
-        for heading in root.findall('.//akn:heading', ns):
-            if heading.text:
-                lines.append(heading.text.strip())
-
-        for para in root.findall('.//akn:p', ns):
-            if para.text:
-                lines.append(para.text.strip())
-
+        texts = {AKN_DOC_TITLE: [], AKN_HEADING: [], AKN_PARAGRAPH: []}
+        open_slots = []
+
+        # Single streaming pass; slots are reserved on start so nested elements keep document order
+        for event, elem in ET.iterparse(BytesIO(xml_bytes), events=('start', 'end')):
+            found = texts.get(elem.tag)
+            if event == 'start':
+                if found is not None:
+                    open_slots.append(len(found))
+                    found.append(None)
+                continue
+
+            if found is not None:
+                found[open_slots.pop()] = elem.text
+
+            # Drop the finished subtree's content to keep memory flat
+            elem.clear()
+
+        titles = texts[AKN_DOC_TITLE]
+        lines = [titles[0].strip()] if titles and titles[0] else []
+        lines.extend(text.strip() for text in texts[AKN_HEADING] if text)
+        lines.extend(text.strip() for text in texts[AKN_PARAGRAPH] if text)
         return '\n'.join(lines)
     except Exception as e:
         logging.error("Failed to parse XML")
@@ -3,10 +3,14 @@ Shared blob storage I/O utilities for multi-stage pipeline
 """
 import logging
 import os
-import json
-from typing import List, Dict, Optional
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+import threading
+import orjson
+import zstandard
+from typing import IO, Iterable, List, Dict, Iterator, Optional, Tuple, Union
+from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient, ContentSettings
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from azure.identity import DefaultAzureCredential
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
 
 logger = logging.getLogger(__name__)
 
@@ -21,9 +25,34 @@ CONTAINER_CHUNKS = "finlex-chunks"
 CONTAINER_EMBEDDED = "finlex-embedded"
 CONTAINER_INDEXED = "finlex-indexed"
 
+# Blobs above UPLOAD_BLOCK_SIZE are staged as blocks, UPLOAD_MAX_CONCURRENCY at a time
+UPLOAD_BLOCK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_CONCURRENCY = 8
+
+# JSON/JSONL blobs are stored zstd-compressed; downloads recognise the frame magic, so older
+# uncompressed blobs (and transports that already decoded the content) still read as before
+ZSTD_LEVEL = 3
+ZSTD_FRAME_MAGIC = b'\x28\xb5\x2f\xfd'
+JSON_CONTENT_SETTINGS = ContentSettings(content_type='application/json', content_encoding='zstd')
+JSONL_CONTENT_SETTINGS = ContentSettings(content_type='application/x-ndjson', content_encoding='zstd')
+
+# Bytes of downloaded JSONL content decompressed and split into lines at a time by parse_jsonl
+JSONL_PARSE_WINDOW = 256 * 1024
+
+# Concurrent async uploads (the aiohttp transport pools up to 100 connections)
+ASYNC_MAX_CONCURRENCY = 64
+
 # Initialize blob service client with managed identity
 _blob_service_client = None
 
+# Blob names per (container, prefix) listed by blob_exists, kept current by uploads from this process
+_listing_cache: Dict[Tuple[str, str], set] = {}
+_listing_lock = threading.Lock()
+
+# Containers already checked or created by ensure_container_exists in this process
+_container_clients: Dict[str, ContainerClient] = {}
+_container_lock = threading.Lock()
+
 def get_blob_service_client() -> BlobServiceClient:
     """Get or create blob service client with managed identity"""
     global _blob_service_client
@@ -31,33 +60,76 @@ def get_blob_service_client() -> BlobServiceClient:
         credential = DefaultAzureCredential()
         _blob_service_client = BlobServiceClient(
             account_url=STORAGE_ACCOUNT_URL,
-            credential=credential
+            credential=credential,
+            max_block_size=UPLOAD_BLOCK_SIZE,
+            max_single_put_size=UPLOAD_BLOCK_SIZE
         )
     return _blob_service_client
 
+# Async client is bound to the event loop it is first used in; close it before that loop ends
+_async_blob_service_client = None
+
+def get_async_blob_service_client() -> AsyncBlobServiceClient:
+    """Get or create async blob service client with managed identity"""
+    global _async_blob_service_client
+    if _async_blob_service_client is None:
+        credential = AsyncDefaultAzureCredential()
+        _async_blob_service_client = AsyncBlobServiceClient(
+            account_url=STORAGE_ACCOUNT_URL,
+            credential=credential,
+            max_block_size=UPLOAD_BLOCK_SIZE,
+            max_single_put_size=UPLOAD_BLOCK_SIZE
+        )
+    return _async_blob_service_client
+
+async def close_async_blob_service_client():
+    """Close the async client and its credential"""
+    global _async_blob_service_client
+    if _async_blob_service_client is not None:
+        await _async_blob_service_client.close()
+        await _async_blob_service_client.credential.close()
+        _async_blob_service_client = None
+
 def ensure_container_exists(container_name: str) -> ContainerClient:
-    """Ensure container exists, create if not"""
-    blob_service_client = get_blob_service_client()
-    container_client = blob_service_client.get_container_client(container_name)
+    """
+    Ensure container exists, create if not
     
-    try:
-        container_client.get_container_properties()
-        logger.debug(f"Container '{container_name}' exists")
-    except Exception:
-        logger.info(f"Creating container '{container_name}'")
-        container_client.create_container()
+    Checked once per process; later calls (one per upload_blob) return the cached client.
+    """
+    container_client = _container_clients.get(container_name)
+    if container_client is not None:
+        return container_client
+    
+    with _container_lock:
+        if container_name not in _container_clients:
+            blob_service_client = get_blob_service_client()
+            container_client = blob_service_client.get_container_client(container_name)
+            
+            try:
+                container_client.get_container_properties()
+                logger.debug(f"Container '{container_name}' exists")
+            except Exception:
+                logger.info(f"Creating container '{container_name}'")
+                container_client.create_container()
+            
+            _container_clients[container_name] = container_client
     
-    return container_client
+    return _container_clients[container_name]
 
-def upload_blob(container_name: str, blob_name: str, data: bytes, overwrite: bool = True) -> str:
+def upload_blob(container_name: str, blob_name: str, data: Union[bytes, Iterable[bytes], IO[bytes]],
+                overwrite: bool = True, max_concurrency: int = UPLOAD_MAX_CONCURRENCY,
+                length: Optional[int] = None, content_settings: Optional[ContentSettings] = None) -> str:
     """
     Upload data to blob storage
     
     Args:
         container_name: Container name
         blob_name: Blob path (e.g., "2024/1234.xml")
-        data: Data to upload (bytes)
+        data: Data to upload (bytes, or a file-like object / iterable of bytes streamed by the SDK)
         overwrite: Whether to overwrite existing blob
+        max_concurrency: Parallel block uploads for blobs larger than UPLOAD_BLOCK_SIZE
+        length: Number of bytes in a streamed upload
+        content_settings: Content type / encoding headers to store with the blob
         
     Returns:
         Blob URL
@@ -65,7 +137,25 @@ def upload_blob(container_name: str, blob_name: str, data: bytes, overwrite: boo
     container_client = ensure_container_exists(container_name)
     blob_client = container_client.get_blob_client(blob_name)
     
-    blob_client.upload_blob(data, overwrite=overwrite)
+    blob_client.upload_blob(data, length=length, overwrite=overwrite, max_concurrency=max_concurrency,
+                            content_settings=content_settings)
+    _remember_blob(container_name, blob_name)
+    # Streamed data (generators, file objects) has no len(); its size is only known when length is given
+    if length is None and isinstance(data, (bytes, bytearray, memoryview)):
+        length = len(data)
+    if length is not None:
+        logger.debug("Uploaded: %s/%s (%d bytes)", container_name, blob_name, length)
+    else:
+        logger.debug("Uploaded: %s/%s", container_name, blob_name)
+    
+    return blob_client.url
+
+async def upload_blob_async(container_name: str, blob_name: str, data: bytes, overwrite: bool = True) -> str:
+    """Async version of upload_blob; the container must already exist"""
+    blob_client = get_async_blob_service_client().get_blob_client(container_name, blob_name)
+    
+    await blob_client.upload_blob(data, overwrite=overwrite)
+    _remember_blob(container_name, blob_name)
     logger.debug(f"Uploaded: {container_name}/{blob_name} ({len(data)} bytes)")
     
     return blob_client.url
@@ -89,15 +179,33 @@ def download_blob(container_name: str, blob_name: str) -> bytes:
     
     return data
 
+def _listing_prefix(blob_name: str) -> str:
+    """Virtual directory of a blob, e.g. '2024/' for '2024/1234.json'"""
+    return blob_name.rsplit('/', 1)[0] + '/' if '/' in blob_name else ''
+
+def _remember_blob(container_name: str, blob_name: str):
+    """Add a freshly uploaded blob to its cached listing, if that listing is loaded"""
+    names = _listing_cache.get((container_name, _listing_prefix(blob_name)))
+    if names is not None:
+        names.add(blob_name)
+
 def blob_exists(container_name: str, blob_name: str) -> bool:
-    """Check if blob exists"""
-    try:
-        blob_service_client = get_blob_service_client()
-        blob_client = blob_service_client.get_blob_client(container_name, blob_name)
-        blob_client.get_blob_properties()
-        return True
-    except Exception:
-        return False
+    """
+    Check if blob exists
+    
+    The blob's virtual directory is listed once and cached, so checking N documents
+    costs one LIST call per directory instead of N HEAD requests.
+    """
+    key = (container_name, _listing_prefix(blob_name))
+    if key not in _listing_cache:
+        # Worker threads asking about the same directory wait for one listing
+        with _listing_lock:
+            if key not in _listing_cache:
+                try:
+                    _listing_cache[key] = set(list_blobs(container_name, prefix=key[1]))
+                except Exception:
+                    return False
+    return blob_name in _listing_cache[key]
 
 def list_blobs(container_name: str, prefix: str = None) -> List[str]:
     """
@@ -120,27 +228,79 @@ def list_blobs(container_name: str, prefix: str = None) -> List[str]:
     logger.debug(f"Listed {len(blobs)} blobs in {container_name} with prefix '{prefix}'")
     return blobs
 
+def list_blobs_by_year(container_name: str, years: List[str]) -> Dict[str, List[str]]:
+    """
+    List a container once and bucket blob names by their top-level year directory
+    
+    Args:
+        container_name: Container name
+        years: Years to keep (e.g., ["2024", "2025"]); blobs under other directories are dropped
+        
+    Returns:
+        Dict of year -> blob names under "{year}/"
+    """
+    by_year = {year: [] for year in years}
+    for blob_name in list_blobs(container_name):
+        year, separator, _ = blob_name.partition('/')
+        if separator and year in by_year:
+            by_year[year].append(blob_name)
+    
+    return by_year
+
 def upload_json(container_name: str, blob_name: str, data: Dict, overwrite: bool = True) -> str:
-    """Upload JSON object to blob"""
-    json_bytes = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
-    return upload_blob(container_name, blob_name, json_bytes, overwrite)
+    """Upload JSON object to blob (zstd-compressed)"""
+    json_bytes = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(json_bytes)
+    return upload_blob(container_name, blob_name, compressed, overwrite, content_settings=JSON_CONTENT_SETTINGS)
 
 def download_json(container_name: str, blob_name: str) -> Dict:
     """Download and parse JSON from blob"""
     json_bytes = download_blob(container_name, blob_name)
-    return json.loads(json_bytes.decode('utf-8'))
+    if json_bytes[:4] == ZSTD_FRAME_MAGIC:
+        json_bytes = zstandard.ZstdDecompressor().decompress(json_bytes)
+    return orjson.loads(json_bytes)
 
 def upload_jsonl(container_name: str, blob_name: str, items: List[Dict], overwrite: bool = True) -> str:
-    """Upload list of objects as JSONL (one JSON object per line)"""
-    lines = [json.dumps(item, ensure_ascii=False) for item in items]
-    jsonl_bytes = '\n'.join(lines).encode('utf-8')
-    return upload_blob(container_name, blob_name, jsonl_bytes, overwrite)
-
-def download_jsonl(container_name: str, blob_name: str) -> List[Dict]:
-    """Download and parse JSONL from blob"""
-    jsonl_bytes = download_blob(container_name, blob_name)
-    lines = jsonl_bytes.decode('utf-8').strip().split('\n')
-    return [json.loads(line) for line in lines if line.strip()]
+    """Upload list of objects as JSONL (one JSON object per line, zstd-compressed); NumPy arrays are serialized natively"""
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE
+    jsonl_bytes = b''.join(orjson.dumps(item, option=option) for item in items)
+    compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(jsonl_bytes)
+    return upload_blob(container_name, blob_name, compressed, overwrite, content_settings=JSONL_CONTENT_SETTINGS)
+
+def download_jsonl(container_name: str, blob_name: str) -> Iterator[Dict]:
+    """Stream and parse JSONL from blob, yielding one object per line"""
+    blob_service_client = get_blob_service_client()
+    blob_client = blob_service_client.get_blob_client(container_name, blob_name)
+    
+    return _iter_jsonl(blob_client.download_blob().chunks())
+
+def parse_jsonl(data: bytes) -> Iterator[Dict]:
+    """
+    Parse JSONL blob content fetched with download_blob, yielding one object per line
+    
+    Lets a caller prefetch the compact (compressed) blob bytes and build the Python objects
+    only as it consumes them, instead of holding every parsed line at once.
+    """
+    view = memoryview(data)
+    return _iter_jsonl(view[i:i + JSONL_PARSE_WINDOW] for i in range(0, len(view), JSONL_PARSE_WINDOW))
+
+def _iter_jsonl(chunks: Iterable[bytes]) -> Iterator[Dict]:
+    """Decompress (if zstd) and parse a stream of JSONL byte chunks"""
+    pending = b''
+    decompressor = None
+    for index, data in enumerate(chunks):
+        # Compressed blobs are decompressed chunk by chunk as they stream in
+        if index == 0 and data[:4] == ZSTD_FRAME_MAGIC:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+        if decompressor is not None:
+            data = decompressor.decompress(data)
+        *lines, pending = (pending + data).split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield orjson.loads(line)
+    
+    if pending.strip():
+        yield orjson.loads(pending)
 
 def mark_indexed(doc_id: str, year: str) -> str:
     """Create marker file indicating document has been indexed"""
@@ -0,0 +1,21 @@
+"""
+Compact encoding for embedding vectors stored between pipeline stages
+"""
+import base64
+import numpy as np
+
+def quantize_int8(vector) -> tuple:
+    """
+    Symmetric per-vector int8 quantization
+    
+    Returns:
+        (base64 string of the int8 values, scale to multiply them by)
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    scale = float(np.abs(vector).max()) / 127 or 1.0
+    quantized = np.round(vector / scale).astype(np.int8)
+    return base64.b64encode(quantized.tobytes()).decode('ascii'), scale
+
+def dequantize_int8(data: str, scale: float) -> np.ndarray:
+    """Restore a float32 vector encoded by quantize_int8"""
+    return np.frombuffer(base64.b64decode(data), dtype=np.int8).astype(np.float32) * np.float32(scale)
@@ -2,17 +2,26 @@
 Stage 1: Download and Extract
 Downloads Finlex ZIP archive, extracts XML files, uploads to blob storage
 """
+import asyncio
 import logging
 import os
+import queue
+import re
 import sys
-import tempfile
-import zipfile
+import threading
 from datetime import datetime
+from typing import Iterable, Iterator, Optional, Tuple
 import requests
+from requests.adapters import HTTPAdapter
+from stream_unzip import stream_unzip
+from urllib3.util.retry import Retry
 
 # Add parent directory to path for shared imports
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
-from shared.blob_io import upload_blob, CONTAINER_RAW, ensure_container_exists
+from shared.blob_io import (
+    upload_blob, upload_blob_async, close_async_blob_service_client, CONTAINER_RAW, ensure_container_exists,
+    ASYNC_MAX_CONCURRENCY, UPLOAD_BLOCK_SIZE
+)
 
 # Configure logging
 logging.basicConfig(
@@ -25,55 +34,176 @@ logger = logging.getLogger(__name__)
 # Environment variables
 FINLEX_URL = os.getenv("FINLEX_URL", "https://data.finlex.fi/download/kaikki")
 TARGET_YEARS = os.getenv("TARGET_YEARS", "2024,2025").split(",")
+UPLOAD_CONCURRENCY = ASYNC_MAX_CONCURRENCY  # Uploads in flight, and so files held in memory
+UPLOAD_LOG_EVERY = 500
+ENTRY_QUEUE_SIZE = 64  # Extracted files waiting for an upload slot
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+STREAM_UPLOAD_THRESHOLD = UPLOAD_BLOCK_SIZE  # Larger files go straight from the archive stream to storage
+
+# Shared session: keep-alive connections, retries with backoff on connection errors and 502/503/504.
+# The archive is already compressed, so ask for it as-is rather than gzip-wrapped.
+session = requests.Session()
+session.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=32,
+    max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
+))
+session.headers["Accept-Encoding"] = "identity"
 
-def download_archive() -> str:
-    """Download Finlex ZIP archive to temp file"""
+def stream_archive_entries(target_years: list, stats: dict) -> Iterator[Tuple[str, str, Optional[int], Iterable[bytes]]]:
+    """
+    Stream the Finlex ZIP archive over HTTP and yield (file_name, year, file_size, chunks)
+    for XML files of the target years; the archive is never written to disk.
+    file_size is None when the entry header does not declare it, and chunks must be
+    consumed before the next entry is requested.
+    """
     logger.info(f"Downloading from {FINLEX_URL}")
     
-    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-    tmp_path = tmp_file.name
-    
-    try:
-        response = requests.get(FINLEX_URL, stream=True, timeout=300)
+    with session.get(FINLEX_URL, stream=True, timeout=300) as response:
         response.raise_for_status()
         
+        # Matches XML files of the target years and captures the year
+        statute_pattern = re.compile(
+            rf"akn/fi/act/statute-consolidated/(?P<year>{'|'.join(map(re.escape, target_years))})/.*\.xml"
+        )
+        
         total_size = int(response.headers.get('content-length', 0))
         if total_size:
             logger.info(f"Archive size: {total_size / (1024*1024):.2f} MB")
         
-        downloaded = 0
-        chunk_size = 8192
-        for chunk in response.iter_content(chunk_size=chunk_size):
-            tmp_file.write(chunk)
-            downloaded += len(chunk)
+        for file_name, file_size, chunks in stream_unzip(response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)):
+            file_name = file_name.decode('utf-8')
+            stats['files_scanned'] += 1
+            
+            # Check if file matches target year pattern
+            match = statute_pattern.fullmatch(file_name)
             
-            if downloaded % (10 * 1024 * 1024) == 0:
-                logger.info(f"Downloaded: {downloaded / (1024*1024):.2f} MB")
+            if match is None:
+                # Each entry must be read to the end before the stream reaches the next one
+                for _ in chunks:
+                    pass
+                continue
+            
+            stats['files_found'] += 1
+            yield file_name, match['year'], file_size, chunks
+    
+    logger.info(f"Download complete: archive contains {stats['files_scanned']} files")
+
+def raw_blob_name(file_name: str, year: str) -> str:
+    """Blob path of an archive entry: {year}/{docid}.xml"""
+    doc_id = os.path.basename(file_name).removesuffix('.xml')
+    return f"{year}/{doc_id}.xml"
+
+async def upload_entries(entries: Iterator[Tuple[str, str, Optional[int], Iterable[bytes]]], stats: dict):
+    """
+    Upload archive entries as they arrive, keeping up to UPLOAD_CONCURRENCY uploads in flight.
+    Entries are read in a background thread, so the download continues while uploads run.
+    Entries above STREAM_UPLOAD_THRESHOLD are streamed to storage by that thread instead of
+    being buffered; the archive stream is forward-only, so these uploads run one at a time.
+    """
+    in_flight = {}  # upload task -> (file_name, year, size)
+    ready = queue.Queue(maxsize=ENTRY_QUEUE_SIZE)
+    stop = threading.Event()
+    
+    def put(item) -> bool:
+        # Gives up once the uploader has stopped, so the thread never blocks on a full queue forever
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for file_name, year, file_size, chunks in entries:
+                if file_size is not None and file_size > STREAM_UPLOAD_THRESHOLD:
+                    # Streamed straight from the archive; the reader gets the outcome instead of the content
+                    try:
+                        upload_blob(CONTAINER_RAW, raw_blob_name(file_name, year), chunks, length=file_size)
+                        entry = (file_name, year, file_size, None, None)
+                    except Exception as e:
+                        for _ in chunks:
+                            pass
+                        entry = (file_name, year, file_size, None, e)
+                else:
+                    xml_content = b''.join(chunks)
+                    entry = (file_name, year, len(xml_content), xml_content, None)
+                if not put(entry):
+                    break
+        finally:
+            put(None)
+    
+    def record(file_name: str, year: str, size: int, error: Optional[BaseException]):
+        if error is not None:
+            error_msg = f"Failed to process {file_name}: {str(error)}"
+            logger.error(error_msg)
+            stats['errors'].append(error_msg)
+            return
         
-        tmp_file.close()
-        logger.info(f"Download complete: {tmp_path}")
-        return tmp_path
+        stats['files_uploaded'] += 1
+        stats['bytes_uploaded'] += size
         
-    except Exception as e:
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
-        logger.error(f"Download failed: {str(e)}")
-        raise
+        # Track per-year stats
+        if year not in stats['years']:
+            stats['years'][year] = 0
+        stats['years'][year] += 1
+        
+        if stats['files_uploaded'] % UPLOAD_LOG_EVERY == 0:
+            logger.info(f"Uploaded {stats['files_uploaded']} files...")
+    
+    def record_tasks(done):
+        for task in done:
+            record(*in_flight.pop(task), task.exception())
+    
+    producer = asyncio.get_running_loop().run_in_executor(None, produce)
+    try:
+        while (entry := await asyncio.to_thread(ready.get)) is not None:
+            file_name, year, size, xml_content, error = entry
+            if xml_content is None:
+                record(file_name, year, size, error)
+                continue
+            
+            # Upload to blob storage: finlex-raw/{year}/{docid}.xml
+            task = asyncio.create_task(upload_blob_async(CONTAINER_RAW, raw_blob_name(file_name, year), xml_content))
+            in_flight[task] = (file_name, year, size)
+            
+            # A slot frees up as soon as any upload finishes, so one slow upload never stalls the rest
+            if len(in_flight) >= UPLOAD_CONCURRENCY:
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                record_tasks(done)
+        
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            record_tasks(done)
+        
+        # Re-raise a download or extraction failure from the reader thread
+        await producer
+    finally:
+        stop.set()
+        try:
+            ready.put_nowait(None)  # Wake a reader-side get that is still waiting
+        except queue.Full:
+            pass
+        for task in in_flight:
+            task.cancel()
+        await close_async_blob_service_client()
 
-def extract_and_upload(archive_path: str, target_years: list) -> dict:
+def extract_and_upload(target_years: list) -> dict:
     """
-    Extract XML files from archive and upload to blob storage
+    Stream XML files out of the archive and upload them to blob storage
     
     Returns:
         Dict with statistics
     """
-    logger.info(f"Processing archive: {archive_path}")
     logger.info(f"Target years: {', '.join(target_years)}")
     
     # Ensure container exists
     ensure_container_exists(CONTAINER_RAW)
     
     stats = {
+        'files_scanned': 0,
         'files_found': 0,
         'files_uploaded': 0,
         'bytes_uploaded': 0,
@@ -82,44 +212,7 @@ def extract_and_upload(archive_path: str, target_years: list) -> dict:
     }
     
     try:
-        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-            file_list = zip_ref.namelist()
-            logger.info(f"Archive contains {len(file_list)} files")
-            
-            for file_name in file_list:
-                # Check if file matches target year pattern
-                for year in target_years:
-                    prefix = f"akn/fi/act/statute-consolidated/{year}/"
-                    if file_name.startswith(prefix) and file_name.endswith(".xml"):
-                        stats['files_found'] += 1
-                        
-                        try:
-                            # Extract file content
-                            with zip_ref.open(file_name) as file_data:
-                                xml_content = file_data.read()
-                            
-                            # Extract document ID from filename
-                            doc_id = file_name.split('/')[-1].replace('.xml', '')
-                            
-                            # Upload to blob storage: finlex-raw/{year}/{docid}.xml
-                            blob_name = f"{year}/{doc_id}.xml"
-                            upload_blob(CONTAINER_RAW, blob_name, xml_content)
-                            
-                            stats['files_uploaded'] += 1
-                            stats['bytes_uploaded'] += len(xml_content)
-                            
-                            # Track per-year stats
-                            if year not in stats['years']:
-                                stats['years'][year] = 0
-                            stats['years'][year] += 1
-                            
-                            if stats['files_uploaded'] % 100 == 0:
-                                logger.info(f"Uploaded {stats['files_uploaded']} files...")
-                                
-                        except Exception as e:
-                            error_msg = f"Failed to process {file_name}: {str(e)}"
-                            logger.error(error_msg)
-                            stats['errors'].append(error_msg)
+        asyncio.run(upload_entries(stream_archive_entries(target_years, stats), stats))
         
         logger.info(f"Extraction complete")
         logger.info(f"Files found: {stats['files_found']}")
@@ -135,11 +228,6 @@ def extract_and_upload(archive_path: str, target_years: list) -> dict:
     except Exception as e:
         logger.error(f"Failed to process archive: {str(e)}")
         raise
-    finally:
-        # Clean up archive file
-        if os.path.exists(archive_path):
-            os.unlink(archive_path)
-            logger.info(f"Cleaned up archive: {archive_path}")
     
     return stats
 
@@ -151,11 +239,8 @@ def main():
     logger.info("=" * 80)
     
     try:
-        # Step 1: Download archive
-        archive_path = download_archive()
-        
-        # Step 2: Extract and upload to blob storage
-        stats = extract_and_upload(archive_path, TARGET_YEARS)
+        # Download, extract and upload to blob storage in one streaming pass
+        stats = extract_and_upload(TARGET_YEARS)
         
         # Summary
         duration = (datetime.now() - start_time).total_seconds()
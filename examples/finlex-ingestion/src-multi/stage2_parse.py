@@ -2,17 +2,20 @@
 Stage 2: Parse
 Reads raw XML files from blob storage, parses AKN structure, writes JSON to blob
 """
+import io
 import logging
 import os
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import xml.etree.ElementTree as ET
+from lxml import etree
 
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 from shared.blob_io import (
-    list_blobs, download_blob, upload_json,
-    CONTAINER_RAW, CONTAINER_PARSED, blob_exists
+    list_blobs_by_year, download_blob, upload_json,
+    CONTAINER_RAW, CONTAINER_PARSED
 )
 
 # Configure logging
@@ -26,64 +29,106 @@ logger = logging.getLogger(__name__)
 # Environment variables
 TARGET_YEARS = os.getenv("TARGET_YEARS", "2024,2025").split(",")
 SKIP_EXISTING = os.getenv("SKIP_EXISTING", "true").lower() == "true"
+WORKERS = int(os.getenv("WORKERS", "32"))
 
 # AKN namespace
-AKN_NS = {'akn': 'http://docs.oasis-open.org/legaldocml/ns/akn/3.0'}
+AKN_NS = '{http://docs.oasis-open.org/legaldocml/ns/akn/3.0}'
+AKN_DOC_TITLE = AKN_NS + 'docTitle'
+AKN_PUBLICATION = AKN_NS + 'publication'
+AKN_FRBR_DATE = AKN_NS + 'FRBRdate'
+AKN_FRBR_WORK = AKN_NS + 'FRBRWork'
+AKN_FRBR_TYPE = AKN_NS + 'FRBRtype'
+AKN_NUM = AKN_NS + 'num'
+AKN_HEADING = AKN_NS + 'heading'
+AKN_PARAGRAPH = AKN_NS + 'p'
+
+# Section-like elements and their heading levels; output lists sections, then chapters, then articles
+SECTION_LEVELS = {
+    AKN_NS + 'section': 1,
+    AKN_NS + 'chapter': 0,
+    AKN_NS + 'article': 2,
+}
+
+# Markdown heading marks by hierarchy level in the full text (H2-H6)
+HEADING_MARKS = {level: "#" * min(level + 2, 6) for level in SECTION_LEVELS.values()}
+
+# Each worker thread reuses one parser: an lxml parser serialises concurrent parses behind its
+# own lock, so a single shared instance would undo the thread pool
+_thread_local = threading.local()
+
+def get_xml_parser() -> etree.XMLParser:
+    """This thread's XML parser, created on first use"""
+    parser = getattr(_thread_local, 'xml_parser', None)
+    if parser is None:
+        # Comments and processing instructions are dropped so element text matches ElementTree's;
+        # xml:id values are not indexed since nothing looks them up. Entities are not expanded,
+        # nothing is fetched over the network, and huge_tree lifts libxml2's depth and text-size
+        # limits; blank text is kept, as it separates the words of inline elements in a paragraph
+        parser = _thread_local.xml_parser = etree.XMLParser(
+            remove_comments=True,
+            remove_pis=True,
+            collect_ids=False,
+            resolve_entities=False,
+            no_network=True,
+            huge_tree=True
+        )
+    return parser
 
 def parse_akn_xml(xml_content: bytes) -> dict:
     """Parse AKN XML and extract structured content"""
     try:
-        root = ET.fromstring(xml_content)
-        
-        # Extract title
-        title_elem = root.find('.//akn:docTitle', AKN_NS)
-        title = title_elem.text.strip() if title_elem is not None and title_elem.text else "Untitled"
-        
-        # Extract dates
-        pub_date_elem = root.find('.//akn:publication[@date]', AKN_NS)
-        pub_date = pub_date_elem.get('date') if pub_date_elem is not None else None
-        
-        eff_date_elem = root.find('.//akn:FRBRdate[@name="vigencyDate"]', AKN_NS)
-        eff_date = eff_date_elem.get('date') if eff_date_elem is not None else None
-        
-        # Extract document type
-        doc_type_elem = root.find('.//akn:FRBRWork/akn:FRBRtype', AKN_NS)
-        doc_type = doc_type_elem.get('value') if doc_type_elem is not None else "statute"
-        
-        # Extract sections
-        sections = []
-        
-        # Find sections
-        for elem in root.findall('.//akn:section', AKN_NS):
-            section = extract_section_content(elem, level=1)
-            if section and section.get('paragraphs'):
-                sections.append(section)
-        
-        # Find chapters
-        for elem in root.findall('.//akn:chapter', AKN_NS):
-            section = extract_section_content(elem, level=0)
-            if section and section.get('paragraphs'):
-                sections.append(section)
-        
-        # Find articles
-        for elem in root.findall('.//akn:article', AKN_NS):
-            section = extract_section_content(elem, level=2)
-            if section and section.get('paragraphs'):
-                sections.append(section)
-        
-        # Build full text
-        full_text_parts = [f"# {title}\n"]
+        root = etree.fromstring(xml_content, get_xml_parser())
+        
+        title = "Untitled"
+        pub_date = None
+        eff_date = None
+        doc_type = "statute"
+        found = set()
+        sections_by_tag = {tag: [] for tag in SECTION_LEVELS}
+        
+        # Single pass over the tree in document order, dispatching on tag; the first match of each
+        # metadata element wins
+        for elem in root.iter(AKN_DOC_TITLE, AKN_PUBLICATION, AKN_FRBR_DATE, AKN_FRBR_WORK, *SECTION_LEVELS):
+            tag = elem.tag
+            if elem is root:
+                continue
+            if tag in SECTION_LEVELS:
+                section = extract_section_content(elem, level=SECTION_LEVELS[tag])
+                if section and section.get('paragraphs'):
+                    sections_by_tag[tag].append(section)
+            elif tag in found:
+                continue
+            elif tag == AKN_DOC_TITLE:
+                found.add(tag)
+                title = elem.text.strip() if elem.text else "Untitled"
+            elif tag == AKN_PUBLICATION:
+                if elem.get('date') is not None:
+                    found.add(tag)
+                    pub_date = elem.get('date')
+            elif tag == AKN_FRBR_DATE:
+                if elem.get('name') == "vigencyDate":
+                    found.add(tag)
+                    eff_date = elem.get('date')
+            else:
+                doc_type_elem = elem.find(AKN_FRBR_TYPE)
+                if doc_type_elem is not None:
+                    found.add(tag)
+                    doc_type = doc_type_elem.get('value')
+        
+        sections = [section for tag_sections in sections_by_tag.values() for section in tag_sections]
+        
+        # Build full text; every part after the title starts on a new line
+        buffer = io.StringIO()
+        buffer.write(f"# {title}\n")
         for section in sections:
-            level = section.get('level', 0)
-            indent = "#" * min(level + 2, 6)
-            
-            if section.get('heading'):
-                full_text_parts.append(f"\n{indent} {section['heading']}\n")
+            heading = section['heading']
+            if heading:
+                buffer.write(f"\n\n{HEADING_MARKS[section['level']]} {heading}\n")
             
-            for para in section.get('paragraphs', []):
-                full_text_parts.append(f"{para}\n")
+            for para in section['paragraphs']:
+                buffer.write(f"\n{para}\n")
         
-        full_text = '\n'.join(full_text_parts)
+        full_text = buffer.getvalue()
         
         return {
             'title': title,
@@ -92,30 +137,37 @@ def parse_akn_xml(xml_content: bytes) -> dict:
             'effective_date': eff_date,
             'sections': sections,
             'full_text': full_text,
-            'last_modified': datetime.utcnow().isoformat()
+            'last_modified': datetime.utcnow()
         }
         
     except Exception as e:
         logger.error(f"XML parsing error: {str(e)}")
         return None
 
-def extract_section_content(elem: ET.Element, level: int) -> dict:
+def extract_section_content(elem: etree._Element, level: int) -> dict:
     """Extract content from a section element"""
-    # Extract section number
-    num_elem = elem.find('.//akn:num', AKN_NS)
-    number = num_elem.text.strip() if num_elem is not None and num_elem.text else None
-    
-    # Extract heading
-    heading_elem = elem.find('.//akn:heading', AKN_NS)
-    heading = heading_elem.text.strip() if heading_elem is not None and heading_elem.text else None
-    
-    # Extract paragraphs
+    # One walk over the subtree, filtered by tag in C: the first num and heading in document
+    # order give the section number and heading, every p a paragraph with its inline text
+    num_elem = None
+    heading_elem = None
     paragraphs = []
-    for para in elem.findall('.//akn:p', AKN_NS):
-        if para.text:
-            text = para.text.strip()
+    for child in elem.iterdescendants(AKN_PARAGRAPH, AKN_NUM, AKN_HEADING):
+        tag = child.tag
+        if tag == AKN_PARAGRAPH:
+            # Inline elements (refs, emphasis) split a paragraph's text; only then join the pieces
+            text = child.text if len(child) == 0 else ''.join(child.itertext())
             if text:
-                paragraphs.append(text)
+                text = text.strip()
+                if text:
+                    paragraphs.append(text)
+        elif tag == AKN_NUM:
+            if num_elem is None:
+                num_elem = child
+        elif heading_elem is None:
+            heading_elem = child
+    
+    number = num_elem.text.strip() if num_elem is not None and num_elem.text else None
+    heading = heading_elem.text.strip() if heading_elem is not None and heading_elem.text else None
     
     return {
         'level': level,
@@ -124,15 +176,15 @@ def extract_section_content(elem: ET.Element, level: int) -> dict:
         'paragraphs': paragraphs
     }
 
-def process_document(blob_name: str, year: str) -> bool:
+def process_document(blob_name: str, year: str, existing: set) -> bool:
     """Process a single XML document"""
     try:
         # Extract document ID from blob name
-        doc_id = blob_name.split('/')[-1].replace('.xml', '')
+        doc_id = os.path.basename(blob_name).removesuffix('.xml')
         
         # Check if already parsed
         output_blob = f"{year}/{doc_id}.json"
-        if SKIP_EXISTING and blob_exists(CONTAINER_PARSED, output_blob):
+        if output_blob in existing:
             logger.debug(f"Skipping {doc_id} (already parsed)")
             return True
         
@@ -166,30 +218,40 @@ def main():
     logger.info("=" * 80)
     logger.info("STAGE 2: Parse")
     logger.info("=" * 80)
+    logger.info(f"Workers: {WORKERS}")
     
     try:
         total_processed = 0
         total_failed = 0
         
+        # One listing per container covers all target years
+        inputs_by_year = list_blobs_by_year(CONTAINER_RAW, TARGET_YEARS)
+        existing_by_year = list_blobs_by_year(CONTAINER_PARSED, TARGET_YEARS) if SKIP_EXISTING else {}
+        
         for year in TARGET_YEARS:
             logger.info(f"Processing year: {year}")
             
             # List all XML files for this year
-            prefix = f"{year}/"
-            blobs = list_blobs(CONTAINER_RAW, prefix=prefix)
+            blobs = inputs_by_year[year]
             logger.info(f"Found {len(blobs)} XML files")
             
+            # Outputs already written for this year, checked in memory per document
+            existing = set(existing_by_year.get(year, ()))
+            
             processed = 0
             failed = 0
             
-            for blob_name in blobs:
-                if process_document(blob_name, year):
-                    processed += 1
-                else:
-                    failed += 1
-                
-                if (processed + failed) % 100 == 0:
-                    logger.info(f"Progress: {processed + failed}/{len(blobs)}")
+            # Documents are independent; overlap their blob round trips
+            with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+                futures = [executor.submit(process_document, blob_name, year, existing) for blob_name in blobs]
+                for future in as_completed(futures):
+                    if future.result():
+                        processed += 1
+                    else:
+                        failed += 1
+                    
+                    if (processed + failed) % 100 == 0:
+                        logger.info(f"Progress: {processed + failed}/{len(blobs)}")
             
             logger.info(f"Year {year}: {processed} parsed, {failed} failed")
             total_processed += processed
@@ -3,16 +3,19 @@ Stage 3: Chunk
 Reads parsed JSON documents, chunks text optimally, writes JSONL to blob
 """
 import logging
+import multiprocessing
 import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
 import tiktoken
 
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 from shared.blob_io import (
-    list_blobs, download_json, upload_jsonl,
-    CONTAINER_PARSED, CONTAINER_CHUNKS, blob_exists
+    list_blobs_by_year, download_json, upload_jsonl,
+    CONTAINER_PARSED, CONTAINER_CHUNKS
 )
 
 # Configure logging
@@ -29,10 +32,27 @@ SKIP_EXISTING = os.getenv("SKIP_EXISTING", "true").lower() == "true"
 MIN_CHUNK_SIZE = int(os.getenv("MIN_CHUNK_SIZE", "800"))
 MAX_CHUNK_SIZE = int(os.getenv("MAX_CHUNK_SIZE", "1000"))
 OVERLAP_SIZE = int(os.getenv("OVERLAP_SIZE", "100"))
+WORKERS = int(os.getenv("WORKERS", "32"))
+CHUNK_PROCESSES = int(os.getenv("CHUNK_PROCESSES", str(os.cpu_count() or 1)))
 
 # Encoding for token counting
 ENCODING_MODEL = "cl100k_base"
 
+# Sentence-ending punctuation followed by whitespace or the end of the text
+SENTENCE_END_PATTERN = re.compile(r'[.!?](?=\s|\Z)')
+
+# Encoding of a chunking worker process, loaded once by init_chunk_worker
+_encoding = None
+
+def init_chunk_worker():
+    """Load the tokenizer in a chunking worker process"""
+    global _encoding
+    _encoding = tiktoken.get_encoding(ENCODING_MODEL)
+
+def chunk_document_in_worker(doc: dict) -> list:
+    """chunk_document with the worker process's encoding"""
+    return chunk_document(doc, _encoding)
+
 def chunk_document(doc: dict, encoding) -> list:
     """Chunk a document into optimal search chunks"""
     chunks = []
@@ -77,9 +97,13 @@ def chunk_section(doc: dict, section: dict, encoding) -> list:
     
     section_text = '\n\n'.join(section_parts)
     
-    # Check if fits in single chunk
-    tokens = encoding.encode(section_text)
-    if len(tokens) <= MAX_CHUNK_SIZE:
+    # Check if fits in single chunk; every token covers at least one byte, so short sections
+    # fit without being tokenized, and the tokens are reused if it has to be split
+    fits = len(section_text.encode('utf-8')) <= MAX_CHUNK_SIZE
+    if not fits:
+        tokens = encoding.encode(section_text)
+        fits = len(tokens) <= MAX_CHUNK_SIZE
+    if fits:
         chunks.append(create_chunk_dict(
             doc=doc,
             content=section_text,
@@ -89,11 +113,11 @@ def chunk_section(doc: dict, section: dict, encoding) -> list:
         ))
     else:
         # Split into multiple chunks
-        text_chunks = chunk_text(section_text, encoding)
-        for i, chunk_text in enumerate(text_chunks):
+        text_chunks = chunk_tokens(tokens, encoding)
+        for i, text in enumerate(text_chunks):
             chunks.append(create_chunk_dict(
                 doc=doc,
-                content=chunk_text,
+                content=text,
                 chunk_index=i,
                 section_number=section.get('number'),
                 section_heading=section.get('heading')
@@ -103,39 +127,47 @@ def chunk_section(doc: dict, section: dict, encoding) -> list:
 
 def chunk_text(text: str, encoding) -> list:
     """Split text into chunks with overlap"""
+    # Text no longer in bytes than MAX_CHUNK_SIZE cannot exceed it in tokens
+    if len(text.encode('utf-8')) <= MAX_CHUNK_SIZE:
+        return [text]
+    
     tokens = encoding.encode(text)
     
     if len(tokens) <= MAX_CHUNK_SIZE:
         return [text]
     
+    return chunk_tokens(tokens, encoding)
+
+def chunk_tokens(tokens: list, encoding) -> list:
+    """Split encoded text into chunks with overlap, decoding only the emitted chunks"""
+    if len(tokens) <= MAX_CHUNK_SIZE:
+        return [encoding.decode(tokens)]
+    
     chunks = []
     start = 0
     
     while start < len(tokens):
         end = min(start + MAX_CHUNK_SIZE, len(tokens))
-        chunk_tokens = tokens[start:end]
-        chunk_text = encoding.decode(chunk_tokens)
         
-        # Try to break at sentence boundary
-        if end < len(tokens) and len(chunk_tokens) >= MIN_CHUNK_SIZE:
-            search_start = int(len(chunk_text) * 0.8)
-            sentence_end = find_sentence_boundary(chunk_text, search_start)
+        # Try to break at sentence boundary within the last 20% of the window
+        if end < len(tokens) and end - start >= MIN_CHUNK_SIZE:
+            tail_start = start + int((end - start) * 0.8)
+            tail_text = encoding.decode(tokens[tail_start:end])
+            sentence_end = find_sentence_boundary(tail_text, 0)
             
             if sentence_end > 0:
-                chunk_text = chunk_text[:sentence_end]
-                chunk_tokens = encoding.encode(chunk_text)
-                end = start + len(chunk_tokens)
+                end = tail_start + len(encoding.encode(tail_text[:sentence_end]))
         
-        chunks.append(chunk_text)
+        chunks.append(encoding.decode(tokens[start:end]))
         start = end - OVERLAP_SIZE if end < len(tokens) else end
     
     return chunks
 
 def find_sentence_boundary(text: str, start_pos: int) -> int:
     """Find nearest sentence boundary"""
-    for i in range(start_pos, len(text)):
-        if text[i] in '.!?' and (i + 1 >= len(text) or text[i + 1].isspace()):
-            return i + 1
+    match = SENTENCE_END_PATTERN.search(text, start_pos)
+    if match:
+        return match.end()
     
     # Fallback: paragraph break
     para_pos = text.find('\n\n', start_pos)
@@ -164,22 +196,22 @@ def create_chunk_dict(doc: dict, content: str, chunk_index: int,
         'last_modified': doc.get('last_modified')
     }
 
-def process_document(blob_name: str, year: str, encoding) -> int:
+def process_document(blob_name: str, year: str, chunker: ProcessPoolExecutor, existing: set) -> int:
     """Process a single document"""
     try:
-        doc_id = blob_name.split('/')[-1].replace('.json', '')
+        doc_id = os.path.basename(blob_name).removesuffix('.json')
         
         # Check if already chunked
         output_blob = f"{year}/{doc_id}.jsonl"
-        if SKIP_EXISTING and blob_exists(CONTAINER_CHUNKS, output_blob):
+        if output_blob in existing:
             logger.debug(f"Skipping {doc_id} (already chunked)")
             return 0
         
         # Download parsed document
         doc = download_json(CONTAINER_PARSED, blob_name)
         
-        # Chunk the document
-        chunks = chunk_document(doc, encoding)
+        # Chunk the document in a worker process; tokenizing is CPU-bound and threads would contend for the GIL
+        chunks = chunker.submit(chunk_document_in_worker, doc).result()
         
         if not chunks:
             logger.warning(f"No chunks created for {doc_id}")
@@ -203,37 +235,55 @@ def main():
     logger.info("=" * 80)
     logger.info(f"Chunk size: {MIN_CHUNK_SIZE}-{MAX_CHUNK_SIZE} tokens")
     logger.info(f"Overlap: {OVERLAP_SIZE} tokens")
+    logger.info(f"Workers: {WORKERS}")
+    logger.info(f"Chunking processes: {CHUNK_PROCESSES}")
     
     try:
-        encoding = tiktoken.get_encoding(ENCODING_MODEL)
-        
         total_docs = 0
         total_chunks = 0
         
+        # One listing per container covers all target years
+        inputs_by_year = list_blobs_by_year(CONTAINER_PARSED, TARGET_YEARS)
+        existing_by_year = list_blobs_by_year(CONTAINER_CHUNKS, TARGET_YEARS) if SKIP_EXISTING else {}
+        
+        # Spawned rather than forked: the pool starts while download threads are already running
+        chunker = ProcessPoolExecutor(
+            max_workers=CHUNK_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_chunk_worker
+        )
+        
         for year in TARGET_YEARS:
             logger.info(f"Processing year: {year}")
             
             # List all parsed JSON files
-            prefix = f"{year}/"
-            blobs = list_blobs(CONTAINER_PARSED, prefix=prefix)
+            blobs = inputs_by_year[year]
             logger.info(f"Found {len(blobs)} parsed documents")
             
+            # Outputs already written for this year, checked in memory per document
+            existing = set(existing_by_year.get(year, ()))
+            
             docs_processed = 0
             chunks_created = 0
             
-            for blob_name in blobs:
-                chunk_count = process_document(blob_name, year, encoding)
-                if chunk_count > 0:
-                    docs_processed += 1
-                    chunks_created += chunk_count
-                
-                if (docs_processed % 100) == 0 and docs_processed > 0:
-                    logger.info(f"Progress: {docs_processed}/{len(blobs)} docs, {chunks_created} chunks")
+            # Threads overlap the blob I/O of independent documents; chunking runs in the process pool
+            with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+                futures = [executor.submit(process_document, blob_name, year, chunker, existing) for blob_name in blobs]
+                for future in as_completed(futures):
+                    chunk_count = future.result()
+                    if chunk_count > 0:
+                        docs_processed += 1
+                        chunks_created += chunk_count
+                    
+                        if (docs_processed % 100) == 0:
+                            logger.info(f"Progress: {docs_processed}/{len(blobs)} docs, {chunks_created} chunks")
             
             logger.info(f"Year {year}: {docs_processed} docs, {chunks_created} chunks")
             total_docs += docs_processed
             total_chunks += chunks_created
         
+        chunker.shutdown()
+        
         # Summary
         duration = (datetime.now() - start_time).total_seconds()
         logger.info("=" * 80)
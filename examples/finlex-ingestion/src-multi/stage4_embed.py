@@ -2,19 +2,23 @@
 Stage 4: Embed
 Reads chunked documents, generates embeddings via Azure OpenAI, writes embedded chunks
 """
+import asyncio
 import logging
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 from shared.blob_io import (
-    list_blobs, download_jsonl, upload_jsonl,
-    CONTAINER_CHUNKS, CONTAINER_EMBEDDED, blob_exists
+    list_blobs_by_year, download_jsonl, upload_jsonl,
+    CONTAINER_CHUNKS, CONTAINER_EMBEDDED
 )
+from shared.vectors import quantize_int8
 
 # Configure logging
 logging.basicConfig(
@@ -31,20 +35,17 @@ AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "text-embedding-3-small")
 AZURE_OPENAI_DIMENSIONS = int(os.getenv("AZURE_OPENAI_DIMENSIONS", "1536"))
 BATCH_SIZE = 16  # Azure OpenAI max per request
+WORKERS = int(os.getenv("WORKERS", "8"))  # Kept low to stay within the deployment's RPM quota
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", str(WORKERS)))  # Embedding requests in flight
+PREFETCH_DOCS = WORKERS  # Documents downloaded ahead of the one being embedded
 
-# Initialize OpenAI client
+# Token provider for the OpenAI client (created per event loop in embed_documents)
 token_provider = get_bearer_token_provider(
     DefaultAzureCredential(),
     "https://cognitiveservices.azure.com/.default"
 )
 
-client = AzureOpenAI(
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    azure_ad_token_provider=token_provider,
-    api_version="2024-02-01"
-)
-
-def generate_embeddings_batch(chunks: list) -> list:
+async def generate_embeddings_batch(client: AsyncAzureOpenAI, chunks: list) -> list:
     """Generate embeddings for a batch of chunks"""
     if not chunks:
         return []
@@ -52,7 +53,7 @@ def generate_embeddings_batch(chunks: list) -> list:
     texts = [chunk['content'] for chunk in chunks]
     
     try:
-        response = client.embeddings.create(
+        response = await client.embeddings.create(
             model=AZURE_OPENAI_DEPLOYMENT,
             input=texts,
             dimensions=AZURE_OPENAI_DIMENSIONS
@@ -65,7 +66,8 @@ def generate_embeddings_batch(chunks: list) -> list:
             if len(embedding) != AZURE_OPENAI_DIMENSIONS:
                 logger.warning(f"Unexpected embedding dimension: {len(embedding)}, expected {AZURE_OPENAI_DIMENSIONS}")
             
-            chunk['content_vector'] = embedding
+            # Stored as int8 + scale (about 8x smaller than JSON floats); stage 5 dequantizes
+            chunk['content_vector_int8'], chunk['content_vector_scale'] = quantize_int8(embedding)
         
         return chunks
         
@@ -73,42 +75,131 @@ def generate_embeddings_batch(chunks: list) -> list:
         logger.error(f"Failed to generate embeddings: {str(e)}")
         raise
 
-def process_document(blob_name: str, year: str) -> int:
-    """Process a single document's chunks"""
+def load_document(blob_name: str, year: str, existing: set):
+    """Download a document's chunks, or return None if it is already embedded or empty"""
     try:
-        doc_id = blob_name.split('/')[-1].replace('.jsonl', '')
+        doc_id = os.path.basename(blob_name).removesuffix('.jsonl')
         
         # Check if already embedded
         output_blob = f"{year}/{doc_id}.jsonl"
-        if SKIP_EXISTING and blob_exists(CONTAINER_EMBEDDED, output_blob):
+        if output_blob in existing:
             logger.debug(f"Skipping {doc_id} (already embedded)")
-            return 0
+            return None
         
         # Download chunks
-        chunks = download_jsonl(CONTAINER_CHUNKS, blob_name)
+        chunks = list(download_jsonl(CONTAINER_CHUNKS, blob_name))
         
         if not chunks:
             logger.warning(f"No chunks found for {doc_id}")
-            return 0
-        
-        # Process in batches
-        embedded_chunks = []
-        for i in range(0, len(chunks), BATCH_SIZE):
-            batch = chunks[i:i + BATCH_SIZE]
-            embedded_batch = generate_embeddings_batch(batch)
-            embedded_chunks.extend(embedded_batch)
-            
-            logger.debug(f"{doc_id}: Embedded batch {i//BATCH_SIZE + 1}/{(len(chunks) + BATCH_SIZE - 1)//BATCH_SIZE}")
-        
-        # Upload embedded chunks
-        upload_jsonl(CONTAINER_EMBEDDED, output_blob, embedded_chunks)
+            return None
         
-        logger.debug(f"Embedded {doc_id}: {len(embedded_chunks)} chunks")
-        return len(embedded_chunks)
+        return doc_id, output_blob, chunks
         
     except Exception as e:
         logger.error(f"Failed to process {blob_name}: {str(e)}")
-        return 0
+        return None
+
+def prefetch_documents(executor: ThreadPoolExecutor, blobs: list, year: str, existing: set):
+    """Yield load_document results in order while up to PREFETCH_DOCS later documents download in the background"""
+    pending = deque()
+    for blob_name in blobs:
+        pending.append(executor.submit(load_document, blob_name, year, existing))
+        if len(pending) > PREFETCH_DOCS:
+            yield pending.popleft().result()
+    
+    while pending:
+        yield pending.popleft().result()
+
+async def embed_documents_async(blobs: list, year: str, existing: set) -> tuple:
+    """
+    Embed a year's documents, packing chunks from consecutive documents into full BATCH_SIZE requests.
+    Up to EMBED_CONCURRENCY requests run concurrently on one event loop and one HTTP connection pool.
+    A document's JSONL is uploaded once its last chunk has been embedded.
+    Returns (documents embedded, chunks embedded).
+    """
+    pending = {}  # doc_id -> [output_blob, chunks, chunks still without a vector]
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+    docs_processed = 0
+    chunks_embedded = 0
+    
+    async with AsyncAzureOpenAI(
+        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        azure_ad_token_provider=token_provider,
+        api_version="2024-02-01"
+    ) as client:
+        
+        async def embed_batch(batch: list):
+            """Embed (doc_id, chunk) pairs and upload the documents they complete"""
+            nonlocal docs_processed, chunks_embedded
+            try:
+                async with semaphore:
+                    await generate_embeddings_batch(client, [chunk for _, chunk in batch])
+            except Exception:
+                # The documents can no longer be completed; their other batches are dropped as they finish
+                for doc_id in {doc_id for doc_id, _ in batch}:
+                    if pending.pop(doc_id, None) is not None:
+                        logger.error(f"Failed to embed {doc_id}")
+                return
+            
+            # Bookkeeping runs on the event loop only, so no lock is needed
+            completed = []
+            for doc_id, _ in batch:
+                doc = pending.get(doc_id)
+                if doc is None:
+                    continue
+                doc[2] -= 1
+                if doc[2] == 0:
+                    completed.append((doc_id, pending.pop(doc_id)))
+            
+            for doc_id, (output_blob, chunks, _) in completed:
+                try:
+                    await asyncio.to_thread(upload_jsonl, CONTAINER_EMBEDDED, output_blob, chunks)
+                except Exception as e:
+                    logger.error(f"Failed to upload {doc_id}: {str(e)}")
+                    continue
+                logger.debug(f"Embedded {doc_id}: {len(chunks)} chunks")
+                docs_processed += 1
+                chunks_embedded += len(chunks)
+                
+                if (docs_processed % 10) == 0:
+                    logger.info(f"Progress: {docs_processed}/{len(blobs)} docs, {chunks_embedded} chunks")
+        
+        with ThreadPoolExecutor(max_workers=WORKERS) as download_executor:
+            documents = prefetch_documents(download_executor, blobs, year, existing)
+            exhausted = object()
+            in_flight = set()
+            batch = []
+            try:
+                while (document := await asyncio.to_thread(next, documents, exhausted)) is not exhausted:
+                    if document is None:
+                        continue
+                    doc_id, output_blob, chunks = document
+                    pending[doc_id] = [output_blob, chunks, len(chunks)]
+                    for chunk in chunks:
+                        batch.append((doc_id, chunk))
+                        if len(batch) == BATCH_SIZE:
+                            in_flight.add(asyncio.create_task(embed_batch(batch)))
+                            batch = []
+                    
+                    # Bound the vectors held in memory to a couple of batches per request slot
+                    if len(in_flight) >= 2 * EMBED_CONCURRENCY:
+                        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            task.result()
+                
+                if batch:
+                    in_flight.add(asyncio.create_task(embed_batch(batch)))
+                if in_flight:
+                    await asyncio.gather(*in_flight)
+            finally:
+                for task in in_flight:
+                    task.cancel()
+    
+    return docs_processed, chunks_embedded
+
+def embed_documents(blobs: list, year: str, existing: set) -> tuple:
+    """Synchronous entry point for embed_documents_async"""
+    return asyncio.run(embed_documents_async(blobs, year, existing))
 
 def main():
     """Main function for Stage 4"""
@@ -119,30 +210,28 @@ def main():
     logger.info(f"Model: {AZURE_OPENAI_DEPLOYMENT}")
     logger.info(f"Dimensions: {AZURE_OPENAI_DIMENSIONS}")
     logger.info(f"Batch size: {BATCH_SIZE}")
+    logger.info(f"Workers: {WORKERS}")
+    logger.info(f"Embedding concurrency: {EMBED_CONCURRENCY}")
     
     try:
         total_docs = 0
         total_chunks = 0
         
+        # One listing per container covers all target years
+        inputs_by_year = list_blobs_by_year(CONTAINER_CHUNKS, TARGET_YEARS)
+        existing_by_year = list_blobs_by_year(CONTAINER_EMBEDDED, TARGET_YEARS) if SKIP_EXISTING else {}
+        
         for year in TARGET_YEARS:
             logger.info(f"Processing year: {year}")
             
             # List all chunked documents
-            prefix = f"{year}/"
-            blobs = list_blobs(CONTAINER_CHUNKS, prefix=prefix)
+            blobs = inputs_by_year[year]
             logger.info(f"Found {len(blobs)} chunked documents")
             
-            docs_processed = 0
-            chunks_embedded = 0
+            # Outputs already written for this year, checked in memory per document
+            existing = set(existing_by_year.get(year, ()))
             
-            for blob_name in blobs:
-                chunk_count = process_document(blob_name, year)
-                if chunk_count > 0:
-                    docs_processed += 1
-                    chunks_embedded += chunk_count
-                
-                if (docs_processed % 10) == 0 and docs_processed > 0:
-                    logger.info(f"Progress: {docs_processed}/{len(blobs)} docs, {chunks_embedded} chunks")
+            docs_processed, chunks_embedded = embed_documents(blobs, year, existing)
             
             logger.info(f"Year {year}: {docs_processed} docs, {chunks_embedded} chunks")
             total_docs += docs_processed
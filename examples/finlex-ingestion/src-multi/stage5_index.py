@@ -2,13 +2,19 @@
 Stage 5: Index
 Reads embedded chunks, uploads to Azure AI Search, tracks indexed documents
 """
+import asyncio
 import logging
 import os
+import random
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 from azure.identity import DefaultAzureCredential
-from azure.search.documents import SearchClient
+from azure.identity.aio import DefaultAzureCredential as AsyncDefaultAzureCredential
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     SearchIndex,
@@ -24,9 +30,10 @@ from azure.search.documents.indexes.models import (
 # Add parent directory to path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 from shared.blob_io import (
-    list_blobs, download_jsonl, upload_json,
+    list_blobs_by_year, download_blob, parse_jsonl, upload_json,
     CONTAINER_EMBEDDED, CONTAINER_INDEXED
 )
+from shared.vectors import dequantize_int8
 
 # Configure logging
 logging.basicConfig(
@@ -42,7 +49,17 @@ SKIP_EXISTING = os.getenv("SKIP_EXISTING", "true").lower() == "true"
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX", "finlex-index")
 AZURE_OPENAI_DIMENSIONS = int(os.getenv("AZURE_OPENAI_DIMENSIONS", "1536"))
-BATCH_SIZE = 100  # AI Search batch upload limit
+BATCH_SIZE = 100  # Starting batch size; adapts between MIN_BATCH_SIZE and MAX_BATCH_SIZE
+MIN_BATCH_SIZE = 25
+MAX_BATCH_SIZE = 1000  # AI Search limit per indexing request
+BATCH_SIZE_STEP = 25  # Growth after a batch the service accepted without throttling
+WORKERS = int(os.getenv("WORKERS", "16"))  # Documents indexed concurrently
+PREFETCH_DOCS = WORKERS  # Documents downloaded ahead of the ones being indexed
+MAX_CONCURRENT_BATCHES = 8  # Upload requests in flight across all documents
+UPLOAD_MAX_ATTEMPTS = 5
+MAX_BACKOFF_SECONDS = 30
+# Per-document statuses worth retrying: version conflict, index busy, throttled, unavailable
+RETRYABLE_STATUS_CODES = {409, 422, 429, 503}
 
 # Initialize Search clients
 credential = DefaultAzureCredential()
@@ -50,11 +67,16 @@ index_client = SearchIndexClient(
     endpoint=AZURE_SEARCH_ENDPOINT,
     credential=credential
 )
-search_client = SearchClient(
-    endpoint=AZURE_SEARCH_ENDPOINT,
-    index_name=AZURE_SEARCH_INDEX,
-    credential=credential
-)
+
+# Async upload client and the semaphore capping its concurrent upload_documents calls, so the
+# documents do not push the service into throttling; both are bound to the event loop of one
+# index_documents_async run, which opens and closes them
+search_client = None
+upload_slots = None
+
+# Shared by all documents: grows while uploads go through cleanly, halves when the service throttles.
+# Only the event loop touches it, so no lock is needed
+batch_size = BATCH_SIZE
 
 def ensure_index_exists():
     """Create search index if it doesn't exist"""
@@ -109,22 +131,58 @@ def ensure_index_exists():
     index_client.create_index(index)
     logger.info(f"Index '{AZURE_SEARCH_INDEX}' created successfully")
 
-def upload_batch(documents: list) -> int:
-    """Upload a batch of documents to AI Search"""
+def record_batch_outcome(throttled: bool):
+    """Adapt the shared batch size: halve it after throttling, grow it by BATCH_SIZE_STEP otherwise"""
+    global batch_size
+    if throttled:
+        new_size = max(MIN_BATCH_SIZE, batch_size // 2)
+    else:
+        new_size = min(MAX_BATCH_SIZE, batch_size + BATCH_SIZE_STEP)
+    if new_size != batch_size:
+        logger.info(f"Batch size: {batch_size} -> {new_size}")
+        batch_size = new_size
+
+def backoff_seconds(attempt: int) -> float:
+    """Exponential backoff with jitter, so throttled uploads do not retry in lockstep"""
+    return min(2 ** attempt, MAX_BACKOFF_SECONDS) * random.uniform(0.5, 1.0)
+
+async def upload_batch(documents: list) -> int:
+    """
+    Upload a batch of documents to AI Search
+    
+    Documents rejected with a retryable status are re-submitted on their own with backoff;
+    returns the number of documents indexed.
+    """
     if not documents:
         return 0
     
+    succeeded = 0
+    pending = documents
     try:
-        result = search_client.upload_documents(documents=documents)
-        
-        succeeded = sum(1 for r in result if r.succeeded)
-        failed = len(result) - succeeded
-        
-        if failed > 0:
-            logger.warning(f"Batch upload: {succeeded} succeeded, {failed} failed")
+        for attempt in range(UPLOAD_MAX_ATTEMPTS):
+            result = await upload_with_retry(pending)
+            
+            by_key = {document['id']: document for document in pending}
+            retry = []
             for r in result:
-                if not r.succeeded:
+                if r.succeeded:
+                    succeeded += 1
+                elif r.status_code in RETRYABLE_STATUS_CODES and attempt < UPLOAD_MAX_ATTEMPTS - 1:
+                    retry.append(by_key[r.key])
+                else:
                     logger.error(f"Failed to upload {r.key}: {r.error_message}")
+            
+            record_batch_outcome(throttled=bool(retry))
+            if not retry:
+                break
+            
+            delay = backoff_seconds(attempt)
+            logger.warning(f"Batch upload: {len(retry)} of {len(pending)} documents throttled, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            pending = retry
+        
+        if succeeded < len(documents):
+            logger.warning(f"Batch upload: {succeeded} succeeded, {len(documents) - succeeded} failed")
         else:
             logger.debug(f"Batch upload: {succeeded} documents")
         
@@ -132,43 +190,170 @@ def upload_batch(documents: list) -> int:
         
     except Exception as e:
         logger.error(f"Batch upload failed: {str(e)}")
-        return 0
+        return succeeded
+
+async def upload_with_retry(documents: list) -> list:
+    """Upload documents, backing off when the search service rejects the whole request as busy"""
+    for attempt in range(UPLOAD_MAX_ATTEMPTS):
+        try:
+            async with upload_slots:
+                return await search_client.upload_documents(documents=documents)
+        except HttpResponseError as e:
+            if e.status_code not in (429, 503) or attempt == UPLOAD_MAX_ATTEMPTS - 1:
+                raise
+            record_batch_outcome(throttled=True)
+            delay = backoff_seconds(attempt)
+            logger.warning(f"Search service busy, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+def indexed_blob_name(blob_name: str, year: str) -> str:
+    """Name of the indexing metadata blob written for an embedded document"""
+    doc_id = os.path.basename(blob_name).removesuffix('.jsonl')
+    return f"{year}/{doc_id}.json"
+
+def load_document(blob_name: str):
+    """
+    Download a document's embedded JSONL, or return None if the download fails
+    
+    The blob is kept as its compressed bytes; process_document parses the chunks as it batches them.
+    """
+    try:
+        return download_blob(CONTAINER_EMBEDDED, blob_name)
+    except Exception as e:
+        logger.error(f"Failed to download {blob_name}: {str(e)}")
+        return None
+
+def prefetch_documents(executor: ThreadPoolExecutor, blobs: list):
+    """Yield (blob_name, data) in order while up to PREFETCH_DOCS later documents download in the background"""
+    pending = deque()
+    for blob_name in blobs:
+        pending.append((blob_name, executor.submit(load_document, blob_name)))
+        if len(pending) > PREFETCH_DOCS:
+            blob_name, future = pending.popleft()
+            yield blob_name, future.result()
+    
+    while pending:
+        blob_name, future = pending.popleft()
+        yield blob_name, future.result()
 
-def process_document(blob_name: str, year: str) -> int:
-    """Process a single document's embedded chunks"""
+async def process_document(blob_name: str, year: str, data: bytes) -> int:
+    """Index a single document's downloaded embedded chunks"""
+    uploads = set()
     try:
-        doc_id = blob_name.split('/')[-1].replace('.jsonl', '')
+        doc_id = os.path.basename(blob_name).removesuffix('.jsonl')
         
-        # Download embedded chunks
-        chunks = download_jsonl(CONTAINER_EMBEDDED, blob_name)
+        # Parse the chunks as they are uploaded in batches; the document's batches upload
+        # concurrently, at most MAX_CONCURRENT_BATCHES of them held in memory at a time
+        chunk_count = 0
+        total_uploaded = 0
+        batch = []
+        for chunk in parse_jsonl(data):
+            chunk_count += 1
+            if 'content_vector_int8' in chunk:
+                chunk['content_vector'] = dequantize_int8(
+                    chunk.pop('content_vector_int8'), chunk.pop('content_vector_scale')
+                ).tolist()
+            batch.append(chunk)
+            if len(batch) >= batch_size:
+                uploads.add(asyncio.create_task(upload_batch(batch)))
+                batch = []
+                if len(uploads) >= MAX_CONCURRENT_BATCHES:
+                    done, uploads = await asyncio.wait(uploads, return_when=asyncio.FIRST_COMPLETED)
+                    total_uploaded += sum(task.result() for task in done)
+        if batch:
+            uploads.add(asyncio.create_task(upload_batch(batch)))
+        if uploads:
+            total_uploaded += sum(await asyncio.gather(*uploads))
         
-        if not chunks:
+        if chunk_count == 0:
             logger.warning(f"No embedded chunks found for {doc_id}")
             return 0
         
-        # Upload in batches
-        total_uploaded = 0
-        for i in range(0, len(chunks), BATCH_SIZE):
-            batch = chunks[i:i + BATCH_SIZE]
-            uploaded = upload_batch(batch)
-            total_uploaded += uploaded
+        # A partly uploaded document gets no metadata blob, so SKIP_EXISTING retries it next run
+        if total_uploaded < chunk_count:
+            logger.warning(f"Indexed {doc_id} partially: {total_uploaded}/{chunk_count} chunks, not marking as indexed")
+            return total_uploaded
         
         # Record indexed document
         metadata = {
             "doc_id": doc_id,
             "year": year,
-            "chunks": len(chunks),
-            "indexed_at": datetime.now().isoformat(),
+            "chunks": chunk_count,
+            "indexed_at": datetime.now(),
             "source_blob": blob_name
         }
-        upload_json(CONTAINER_INDEXED, f"{year}/{doc_id}.json", metadata)
+        await asyncio.to_thread(upload_json, CONTAINER_INDEXED, indexed_blob_name(blob_name, year), metadata)
         
-        logger.debug(f"Indexed {doc_id}: {total_uploaded}/{len(chunks)} chunks")
+        logger.debug(f"Indexed {doc_id}: {total_uploaded}/{chunk_count} chunks")
         return total_uploaded
         
     except Exception as e:
         logger.error(f"Failed to process {blob_name}: {str(e)}")
         return 0
+    finally:
+        for task in uploads:
+            task.cancel()
+
+async def index_documents_async(blobs: list, year: str) -> tuple:
+    """
+    Index a year's documents, up to WORKERS of them concurrently on one event loop.
+    Their batch uploads share one async search client, at most MAX_CONCURRENT_BATCHES in flight.
+    Returns (documents indexed, chunks indexed).
+    """
+    global search_client, upload_slots
+    docs_indexed = 0
+    chunks_indexed = 0
+    
+    def collect(tasks):
+        nonlocal docs_indexed, chunks_indexed
+        for task in tasks:
+            chunk_count = task.result()
+            if chunk_count > 0:
+                docs_indexed += 1
+                chunks_indexed += chunk_count
+                
+                if (docs_indexed % 10) == 0:
+                    logger.info(f"Progress: {docs_indexed}/{len(blobs)} docs, {chunks_indexed} chunks")
+    
+    async with AsyncDefaultAzureCredential() as async_credential, AsyncSearchClient(
+        endpoint=AZURE_SEARCH_ENDPOINT,
+        index_name=AZURE_SEARCH_INDEX,
+        credential=async_credential
+    ) as client:
+        search_client = client
+        upload_slots = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+        
+        # Downloads run ahead in a thread pool, so documents upload while the next ones arrive
+        with ThreadPoolExecutor(max_workers=WORKERS) as download_executor:
+            documents = prefetch_documents(download_executor, blobs)
+            exhausted = object()
+            in_flight = set()
+            try:
+                while (document := await asyncio.to_thread(next, documents, exhausted)) is not exhausted:
+                    blob_name, data = document
+                    if data is None:
+                        continue
+                    in_flight.add(asyncio.create_task(process_document(blob_name, year, data)))
+                    
+                    # Hold downloaded documents in the prefetch window rather than as pending tasks
+                    if len(in_flight) >= WORKERS:
+                        done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                        collect(done)
+                
+                if in_flight:
+                    done, in_flight = await asyncio.wait(in_flight)
+                    collect(done)
+            finally:
+                for task in in_flight:
+                    task.cancel()
+                search_client = None
+                upload_slots = None
+    
+    return docs_indexed, chunks_indexed
+
+def index_documents(blobs: list, year: str) -> tuple:
+    """Synchronous entry point for index_documents_async"""
+    return asyncio.run(index_documents_async(blobs, year))
 
 def main():
     """Main function for Stage 5"""
@@ -178,6 +363,7 @@ def main():
     logger.info("=" * 80)
     logger.info(f"Index: {AZURE_SEARCH_INDEX}")
     logger.info(f"Vector dimensions: {AZURE_OPENAI_DIMENSIONS}")
+    logger.info(f"Workers: {WORKERS}")
     
     try:
         # Ensure index exists
@@ -186,25 +372,24 @@ def main():
         total_docs = 0
         total_chunks = 0
         
+        # One listing per container covers all target years
+        inputs_by_year = list_blobs_by_year(CONTAINER_EMBEDDED, TARGET_YEARS)
+        existing_by_year = list_blobs_by_year(CONTAINER_INDEXED, TARGET_YEARS) if SKIP_EXISTING else {}
+        
         for year in TARGET_YEARS:
             logger.info(f"Processing year: {year}")
             
             # List all embedded documents
-            prefix = f"{year}/"
-            blobs = list_blobs(CONTAINER_EMBEDDED, prefix=prefix)
+            blobs = inputs_by_year[year]
             logger.info(f"Found {len(blobs)} embedded documents")
             
-            docs_indexed = 0
-            chunks_indexed = 0
+            # Documents with indexing metadata for this year are skipped before they are downloaded
+            existing = set(existing_by_year.get(year, ()))
+            if existing:
+                blobs = [blob_name for blob_name in blobs if indexed_blob_name(blob_name, year) not in existing]
+                logger.info(f"Skipping {len(inputs_by_year[year]) - len(blobs)} already indexed documents")
             
-            for blob_name in blobs:
-                chunk_count = process_document(blob_name, year)
-                if chunk_count > 0:
-                    docs_indexed += 1
-                    chunks_indexed += chunk_count
-                
-                if (docs_indexed % 10) == 0 and docs_indexed > 0:
-                    logger.info(f"Progress: {docs_indexed}/{len(blobs)} docs, {chunks_indexed} chunks")
+            docs_indexed, chunks_indexed = index_documents(blobs, year)
             
             logger.info(f"Year {year}: {docs_indexed} docs, {chunks_indexed} chunks")
             total_docs += docs_indexed
@@ -2,9 +2,13 @@
 Chunking module for splitting documents into optimal search chunks
 Uses tiktoken for accurate token counting
 """
+import bisect
 import logging
+import os
+import re
 import tiktoken
-from typing import List, Dict
+from itertools import accumulate
+from typing import List, Dict, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +18,13 @@ MAX_CHUNK_SIZE = 1000  # tokens
 OVERLAP_SIZE = 100  # tokens
 ENCODING_MODEL = "cl100k_base"  # For text-embedding-ada-002
 
+# Sentence-ending punctuation followed by whitespace or the end of the text
+SENTENCE_END_PATTERN = re.compile(r'[.!?](?=\s|\Z)')
+
+# Documents whose long sections are tokenized together in one parallel batch
+TOKENIZE_BATCH_DOCS = 64
+TOKENIZER_THREADS = os.cpu_count() or 1
+
 def chunk_documents(documents: List[Dict]) -> List[Dict]:
     """
     Split documents into chunks optimized for search
@@ -27,24 +38,60 @@ def chunk_documents(documents: List[Dict]) -> List[Dict]:
     encoding = tiktoken.get_encoding(ENCODING_MODEL)
     all_chunks = []
     
-    for doc in documents:
-        try:
-            doc_chunks = chunk_document(doc, encoding)
-            all_chunks.extend(doc_chunks)
-            logger.debug(f"Document '{doc.get('title', 'unknown')}' split into {len(doc_chunks)} chunks")
-        except Exception as e:
-            logger.error(f"Failed to chunk document {doc.get('document_id', 'unknown')}: {str(e)}")
+    for batch_start in range(0, len(documents), TOKENIZE_BATCH_DOCS):
+        batch = documents[batch_start:batch_start + TOKENIZE_BATCH_DOCS]
+        tokens_by_text = tokenize_batch(batch, encoding)
+        
+        for doc in batch:
+            try:
+                doc_chunks = chunk_document(doc, encoding, tokens_by_text)
+                all_chunks.extend(doc_chunks)
+                logger.debug("Document '%s' split into %d chunks", doc.get('title', 'unknown'), len(doc_chunks))
+            except Exception as e:
+                logger.error(f"Failed to chunk document {doc.get('document_id', 'unknown')}: {str(e)}")
     
     logger.info(f"Created {len(all_chunks)} chunks from {len(documents)} documents")
     return all_chunks
 
-def chunk_document(doc: Dict, encoding) -> List[Dict]:
+def tokenize_batch(documents: List[Dict], encoding) -> Dict[str, List[int]]:
+    """
+    Tokenize the texts of several documents that may need splitting in one batched call
+    
+    tiktoken releases the GIL while encoding, so the batch is spread over TOKENIZER_THREADS threads.
+    
+    Args:
+        documents: Parsed document dicts
+        encoding: Tiktoken encoding
+        
+    Returns:
+        Dict of text -> token ids, for section texts (or section-less full texts) longer than MAX_CHUNK_SIZE bytes
+    """
+    # With a single core there is nothing to parallelize; chunk_section encodes inline instead
+    if TOKENIZER_THREADS == 1:
+        return {}
+    
+    texts = []
+    for doc in documents:
+        sections = doc.get('sections', [])
+        candidates = [build_section_text(section) for section in sections] if sections else [doc.get('full_text', '')]
+        texts.extend(text for text in candidates if needs_tokens(text))
+    
+    if not texts:
+        return {}
+    return dict(zip(texts, encoding.encode_ordinary_batch(texts, num_threads=TOKENIZER_THREADS)))
+
+def needs_tokens(text: str) -> bool:
+    """Whether text could exceed MAX_CHUNK_SIZE; every token covers at least one byte"""
+    return len(text.encode('utf-8')) > MAX_CHUNK_SIZE
+
+def chunk_document(doc: Dict, encoding, tokens_by_text: Optional[Dict[str, List[int]]] = None) -> List[Dict]:
     """
     Chunk a single document preserving section boundaries
     
     Args:
         doc: Parsed document dict
         encoding: Tiktoken encoding
+        tokens_by_text: Pre-computed token ids from tokenize_batch, if available
         
     Returns:
         List of chunk dicts
@@ -56,7 +103,7 @@ def chunk_document(doc: Dict, encoding) -> List[Dict]:
     sections = doc.get('sections', [])
     if sections:
         for section in sections:
-            section_chunks = chunk_section(doc, section, encoding)
+            section_chunks = chunk_section(doc, section, encoding, tokens_by_text)
             for chunk in section_chunks:
                 chunk['chunk_index'] = chunk_index
                 chunks.append(chunk)
@@ -65,7 +112,8 @@ def chunk_document(doc: Dict, encoding) -> List[Dict]:
         # Fallback: chunk full text if no sections
         full_text = doc.get('full_text', '')
         if full_text:
-            text_chunks = chunk_text(full_text, encoding)
+            tokens = tokens_by_text.get(full_text) if tokens_by_text else None
+            text_chunks = chunk_tokens(tokens, encoding) if tokens is not None else chunk_text(full_text, encoding)
             for i, text in enumerate(text_chunks):
                 chunks.append(create_chunk_dict(
                     doc=doc,
@@ -77,7 +125,19 @@ def chunk_document(doc: Dict, encoding) -> List[Dict]:
     
     return chunks
 
-def chunk_section(doc: Dict, section: Dict, encoding) -> List[Dict]:
+def build_section_text(section: Dict) -> str:
+    """Join a section's heading and paragraphs into its chunkable text"""
+    section_parts = []
+    if section.get('heading'):
+        section_parts.append(f"## {section['heading']}")
+    
+    for para in section.get('paragraphs', []):
+        section_parts.append(para)
+    
+    return '\n\n'.join(section_parts)
+
+def chunk_section(doc: Dict, section: Dict, encoding,
+                  tokens_by_text: Optional[Dict[str, List[int]]] = None) -> List[Dict]:
     """
     Chunk a single section, respecting paragraph boundaries
     
@@ -85,6 +145,7 @@ def chunk_section(doc: Dict, section: Dict, encoding) -> List[Dict]:
         doc: Parent document dict
         section: Section dict with heading, paragraphs
         encoding: Tiktoken encoding
+        tokens_by_text: Pre-computed token ids from tokenize_batch, if available
         
     Returns:
         List of chunk dicts for this section
@@ -92,18 +153,17 @@ def chunk_section(doc: Dict, section: Dict, encoding) -> List[Dict]:
     chunks = []
     
     # Build section text
-    section_parts = []
-    if section.get('heading'):
-        section_parts.append(f"## {section['heading']}")
-    
-    for para in section.get('paragraphs', []):
-        section_parts.append(para)
+    section_text = build_section_text(section)
     
-    section_text = '\n\n'.join(section_parts)
-    
-    # Check if section fits in single chunk
-    tokens = encoding.encode(section_text)
-    if len(tokens) <= MAX_CHUNK_SIZE:
+    # Check if section fits in single chunk; short sections fit without being tokenized,
+    # and the tokens are reused if it has to be split
+    fits = not needs_tokens(section_text)
+    if not fits:
+        tokens = tokens_by_text.get(section_text) if tokens_by_text else None
+        if tokens is None:
+            tokens = encoding.encode_ordinary(section_text)
+        fits = len(tokens) <= MAX_CHUNK_SIZE
+    if fits:
         # Single chunk for this section
         chunks.append(create_chunk_dict(
             doc=doc,
@@ -114,7 +174,7 @@ def chunk_section(doc: Dict, section: Dict, encoding) -> List[Dict]:
         ))
     else:
         # Split section into multiple chunks
-        text_chunks = chunk_text(section_text, encoding)
+        text_chunks = chunk_tokens(tokens, encoding)
         for i, chunk_text in enumerate(text_chunks):
             chunks.append(create_chunk_dict(
                 doc=doc,
@@ -141,11 +201,36 @@ def chunk_text(text: str, encoding, min_size: int = MIN_CHUNK_SIZE,
     Returns:
         List of text chunks
     """
-    tokens = encoding.encode(text)
+    # Text no longer in bytes than max_size cannot exceed it in tokens
+    if len(text.encode('utf-8')) <= max_size:
+        return [text]
+    
+    # Finlex text contains no special tokens, so skip tiktoken's special-token scan
+    tokens = encoding.encode_ordinary(text)
     
     if len(tokens) <= max_size:
         return [text]
     
+    return chunk_tokens(tokens, encoding, min_size, max_size, overlap)
+
+def chunk_tokens(tokens: List[int], encoding, min_size: int = MIN_CHUNK_SIZE,
+                 max_size: int = MAX_CHUNK_SIZE, overlap: int = OVERLAP_SIZE) -> List[str]:
+    """
+    Split already-encoded text into chunks with overlap, without encoding any text again
+    
+    Args:
+        tokens: Token ids of the text
+        encoding: Tiktoken encoding
+        min_size: Minimum chunk size in tokens
+        max_size: Maximum chunk size in tokens
+        overlap: Overlap size in tokens
+        
+    Returns:
+        List of text chunks
+    """
+    if len(tokens) <= max_size:
+        return [encoding.decode(tokens)]
+    
     chunks = []
     start = 0
     
@@ -153,29 +238,54 @@ def chunk_text(text: str, encoding, min_size: int = MIN_CHUNK_SIZE,
         # Determine chunk end
         end = min(start + max_size, len(tokens))
         
-        # Extract token slice
-        chunk_tokens = tokens[start:end]
-        chunk_text = encoding.decode(chunk_tokens)
-        
         # Try to break at sentence boundary if possible
-        if end < len(tokens) and len(chunk_tokens) >= min_size:
+        if end < len(tokens) and end - start >= min_size:
             # Look for sentence endings in last 20% of chunk
-            search_start = int(len(chunk_text) * 0.8)
-            sentence_end = find_sentence_boundary(chunk_text, search_start)
+            tail_start = start + int((end - start) * 0.8)
+            boundary = find_token_boundary(tokens[tail_start:end], encoding)
             
-            if sentence_end > 0:
-                chunk_text = chunk_text[:sentence_end]
-                # Recalculate tokens for actual chunk
-                chunk_tokens = encoding.encode(chunk_text)
-                end = start + len(chunk_tokens)
+            if boundary > 0:
+                end = tail_start + boundary
         
-        chunks.append(chunk_text)
+        chunks.append(encoding.decode(tokens[start:end]))
         
         # Move start forward with overlap
         start = end - overlap if end < len(tokens) else end
     
     return chunks
 
+def find_token_boundary(tokens: List[int], encoding) -> int:
+    """
+    Find the nearest sentence boundary in a token window
+    
+    The window's token bytes are decoded once and the character boundary is mapped back
+    to a token count through the tokens' byte offsets, instead of re-encoding the text.
+    
+    Args:
+        tokens: Token ids to search
+        encoding: Tiktoken encoding
+        
+    Returns:
+        Number of leading tokens up to and including the boundary, or -1 if not found
+    """
+    token_bytes = encoding.decode_tokens_bytes(tokens)
+    raw = b''.join(token_bytes)
+    
+    # The window may start inside a multi-byte character; skip its continuation bytes
+    lead = 0
+    while lead < min(len(raw), 3) and 0x80 <= raw[lead] < 0xC0:
+        lead += 1
+    text = raw[lead:].decode('utf-8', errors='replace')
+    
+    sentence_end = find_sentence_boundary(text, 0)
+    if sentence_end <= 0:
+        return -1
+    
+    # Tokens that start before the boundary byte belong to the chunk
+    boundary_byte = lead + len(text[:sentence_end].encode('utf-8'))
+    token_starts = [0, *accumulate(len(b) for b in token_bytes[:-1])]
+    return bisect.bisect_left(token_starts, boundary_byte)
+
 def find_sentence_boundary(text: str, start_pos: int) -> int:
     """
     Find the nearest sentence boundary after start_pos
@@ -188,9 +298,9 @@ def find_sentence_boundary(text: str, start_pos: int) -> int:
         Position of sentence boundary, or -1 if not found
     """
     # Look for sentence endings: . ! ? followed by space or end
-    for i in range(start_pos, len(text)):
-        if text[i] in '.!?' and (i + 1 >= len(text) or text[i + 1].isspace()):
-            return i + 1
+    match = SENTENCE_END_PATTERN.search(text, start_pos)
+    if match:
+        return match.end()
     
     # Fallback: look for paragraph break
     para_pos = text.find('\n\n', start_pos)
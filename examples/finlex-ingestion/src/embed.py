@@ -1,10 +1,12 @@
 """
 Embedding module for generating vector embeddings using Azure OpenAI
 """
+import asyncio
 import logging
 import os
+import numpy as np
 from typing import List, Dict
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 
 logger = logging.getLogger(__name__)
@@ -14,20 +16,16 @@ AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT", "text-embedding-3-small")
 AZURE_OPENAI_DIMENSIONS = int(os.getenv("AZURE_OPENAI_DIMENSIONS", "1536"))  # 1536, 768, or 512 for v3 models
 BATCH_SIZE = 16  # Azure OpenAI allows max 16 inputs per request
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "8"))  # Embedding requests in flight
+EMBED_MAX_RETRIES = 5  # 429/5xx retries, backed off by the client (honoring Retry-After)
 
-# Initialize Azure OpenAI client with managed identity
+# Token provider for the OpenAI client (created per event loop in generate_embeddings)
 token_provider = get_bearer_token_provider(
     DefaultAzureCredential(),
     "https://cognitiveservices.azure.com/.default"
 )
 
-client = AzureOpenAI(
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    azure_ad_token_provider=token_provider,
-    api_version="2024-02-01"
-)
-
-def generate_embeddings(chunks: List[Dict]) -> List[Dict]:
+def generate_embeddings(chunks: List[Dict]) -> np.ndarray:
     """
     Generate embeddings for all chunks using Azure OpenAI
     
@@ -35,7 +33,7 @@ def generate_embeddings(chunks: List[Dict]) -> List[Dict]:
         chunks: List of chunk dicts with 'content' field
         
     Returns:
-        List of chunks with added 'content_vector' field (1536-dim embedding)
+        float32 matrix with one row (1536-dim embedding) per chunk, in chunk order
     """
     if not AZURE_OPENAI_ENDPOINT:
         raise ValueError("AZURE_OPENAI_ENDPOINT environment variable not set")
@@ -43,39 +41,78 @@ def generate_embeddings(chunks: List[Dict]) -> List[Dict]:
     logger.info(f"Generating embeddings for {len(chunks)} chunks")
     logger.info(f"Using deployment: {AZURE_OPENAI_DEPLOYMENT}")
     
-    chunks_with_embeddings = []
+    vectors = asyncio.run(generate_embeddings_async(chunks))
+    
+    logger.info(f"Successfully generated {len(vectors)} embeddings")
+    return vectors
+
+def create_embedding_client() -> AsyncAzureOpenAI:
+    """Async Azure OpenAI client for embed_chunks; close it (async with) in the event loop that uses it"""
+    return AsyncAzureOpenAI(
+        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        azure_ad_token_provider=token_provider,
+        api_version="2024-02-01",
+        max_retries=EMBED_MAX_RETRIES
+    )
+
+async def generate_embeddings_async(chunks: List[Dict]) -> np.ndarray:
+    """Embed chunks with a client opened for this call"""
+    async with create_embedding_client() as client:
+        return await embed_chunks(client, chunks)
+
+async def embed_chunks(client: AsyncAzureOpenAI, chunks: List[Dict]) -> np.ndarray:
+    """
+    Embed chunks in BATCH_SIZE requests, up to EMBED_CONCURRENCY of them in flight at once
+    
+    Args:
+        client: Client from create_embedding_client
+        chunks: List of chunk dicts with 'content' field
+        
+    Returns:
+        float32 matrix with one row per chunk
+    """
+    # One contiguous matrix instead of a vector object per chunk; row i belongs to chunks[i]
+    vectors = np.empty((len(chunks), AZURE_OPENAI_DIMENSIONS), dtype=np.float32)
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+    batch_count = (len(chunks) + BATCH_SIZE - 1) // BATCH_SIZE
     
-    # Process in batches
-    for i in range(0, len(chunks), BATCH_SIZE):
+    async def embed_batch(i: int):
         batch = chunks[i:i + BATCH_SIZE]
         batch_texts = [chunk['content'] for chunk in batch]
         
         try:
             # Generate embeddings for batch
-            logger.debug(f"Processing batch {i//BATCH_SIZE + 1}/{(len(chunks) + BATCH_SIZE - 1)//BATCH_SIZE}")
-            
-            response = client.embeddings.create(
-                model=AZURE_OPENAI_DEPLOYMENT,
-                input=batch_texts,
-                dimensions=AZURE_OPENAI_DIMENSIONS  # Specify dimensions for v3 models
-            )
+            async with semaphore:
+                logger.debug("Processing batch %d/%d", i//BATCH_SIZE + 1, batch_count)
+                
+                response = await client.embeddings.create(
+                    model=AZURE_OPENAI_DEPLOYMENT,
+                    input=batch_texts,
+                    dimensions=AZURE_OPENAI_DIMENSIONS  # Specify dimensions for v3 models
+                )
             
-            # Add embeddings to chunks
-            for j, chunk in enumerate(batch):
+            # Store the embeddings in the chunks' rows
+            for j in range(len(batch)):
                 embedding = response.data[j].embedding
                 
-                # Verify embedding dimensions
+                # Verify embedding dimensions; a row only fits AZURE_OPENAI_DIMENSIONS values
                 if len(embedding) != AZURE_OPENAI_DIMENSIONS:
-                    logger.warning(f"Unexpected embedding dimension: {len(embedding)}, expected {AZURE_OPENAI_DIMENSIONS}")
+                    raise ValueError(f"Unexpected embedding dimension: {len(embedding)}, expected {AZURE_OPENAI_DIMENSIONS}")
                 
-                chunk['content_vector'] = embedding
-                chunks_with_embeddings.append(chunk)
+                vectors[i + j] = embedding
             
-            logger.debug(f"Generated embeddings for {len(batch)} chunks")
+            logger.debug("Generated embeddings for %d chunks", len(batch))
             
         except Exception as e:
             logger.error(f"Failed to generate embeddings for batch starting at index {i}: {str(e)}")
             raise
     
-    logger.info(f"Successfully generated {len(chunks_with_embeddings)} embeddings")
-    return chunks_with_embeddings
+    tasks = [asyncio.create_task(embed_batch(i)) for i in range(0, len(chunks), BATCH_SIZE)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # A failed batch fails the run; stop the requests still waiting for a slot
+        for task in tasks:
+            task.cancel()
+    
+    return vectors
@@ -3,11 +3,17 @@ Extract module for processing ZIP archives containing Finlex legal documents
 """
 import logging
 import os
+import re
 import zipfile
-from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from typing import List, Dict, Tuple
 
 logger = logging.getLogger(__name__)
 
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 1)))  # Threads decompressing entries
+SHARDS_PER_WORKER = 4  # Smaller shards even out entries of different sizes
+
 def extract_xml_files(archive_path: str, target_years: List[str]) -> List[Dict[str, any]]:
     """
     Extract XML files from Finlex archive for specified years
@@ -25,28 +31,33 @@ def extract_xml_files(archive_path: str, target_years: List[str]) -> List[Dict[s
         with zipfile.ZipFile(archive_path, 'r') as zip_ref:
             file_list = zip_ref.namelist()
             logger.info(f"Archive contains {len(file_list)} files")
-            
-            for file_name in file_list:
-                # Check if file matches target year pattern
-                for year in target_years:
-                    prefix = f"akn/fi/act/statute-consolidated/{year}/"
-                    if file_name.startswith(prefix) and file_name.endswith(".xml"):
-                        try:
-                            logger.debug(f"Extracting: {file_name}")
-                            with zip_ref.open(file_name) as file_data:
-                                xml_content = file_data.read()
-                                
-                                xml_files.append({
-                                    'filename': file_name,
-                                    'content': xml_content,
-                                    'year': year,
-                                    'short_name': file_name.replace(prefix, f"{year}/")
-                                })
-                        except Exception as e:
-                            logger.error(f"Failed to extract {file_name}: {str(e)}")
-            
-            logger.info(f"Extracted {len(xml_files)} XML files for years: {', '.join(target_years)}")
-            
+        
+        # Matches XML files of the target years and captures the year and the path below it
+        statute_pattern = re.compile(
+            rf"akn/fi/act/statute-consolidated/(?P<year>{'|'.join(map(re.escape, target_years))})/(?P<rest>.*\.xml)"
+        )
+        # Target year directories; one C-level startswith drops most entries before the regex runs
+        year_prefixes = tuple(f"akn/fi/act/statute-consolidated/{year}/" for year in target_years)
+        
+        # Check which files match the target year pattern
+        targets = []
+        for file_name in file_list:
+            if not file_name.startswith(year_prefixes):
+                continue
+            match = statute_pattern.fullmatch(file_name)
+            if match is not None:
+                targets.append((file_name, match['year'], match['rest']))
+        
+        # zlib releases the GIL while inflating, so threads decompress entries on all cores
+        # without copying the contents between processes; shards keep the archive order
+        shard_size = max(1, -(-len(targets) // (EXTRACT_WORKERS * SHARDS_PER_WORKER)))
+        shards = [targets[i:i + shard_size] for i in range(0, len(targets), shard_size)]
+        with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+            for shard_files in executor.map(extract_shard, repeat(archive_path), shards):
+                xml_files.extend(shard_files)
+        
+        logger.info(f"Extracted {len(xml_files)} XML files for years: {', '.join(target_years)}")
+        
     except Exception as e:
         logger.error(f"Failed to process archive: {str(e)}")
         raise
@@ -57,3 +68,34 @@ def extract_xml_files(archive_path: str, target_years: List[str]) -> List[Dict[s
             logger.debug(f"Cleaned up archive: {archive_path}")
     
     return xml_files
+
+def extract_shard(archive_path: str, targets: List[Tuple[str, str, str]]) -> List[Dict[str, any]]:
+    """
+    Extract a shard of archive entries through the shard's own archive handle
+    
+    Args:
+        archive_path: Path to downloaded ZIP archive
+        targets: (file name, year, path below the year directory) of each entry
+        
+    Returns:
+        List of dicts with 'filename', 'content' (bytes), 'year', and 'short_name'
+    """
+    xml_files = []
+    
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        for file_name, year, rest in targets:
+            try:
+                logger.debug("Extracting: %s", file_name)
+                with zip_ref.open(file_name) as file_data:
+                    xml_content = file_data.read()
+                    
+                    xml_files.append({
+                        'filename': file_name,
+                        'content': xml_content,
+                        'year': year,
+                        'short_name': f"{year}/{rest}"
+                    })
+            except Exception as e:
+                logger.error(f"Failed to extract {file_name}: {str(e)}")
+    
+    return xml_files
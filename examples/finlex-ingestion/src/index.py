@@ -3,8 +3,12 @@ Indexing module for uploading documents to Azure AI Search with vector search
 """
 import logging
 import os
-from typing import List, Dict
+import random
+import time
+import numpy as np
+from typing import List, Dict, Optional, Tuple
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
@@ -26,16 +30,19 @@ AZURE_SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")  # Admin key for index creation
 AZURE_OPENAI_DIMENSIONS = int(os.getenv("AZURE_OPENAI_DIMENSIONS", "1536"))  # Vector dimensions
 INDEX_NAME = "finlex-documents"
 BATCH_SIZE = 1000  # Maximum batch size for Azure Search
+MIN_BATCH_SIZE = 100  # Floor for the batch size after throttling halves it
+BATCH_SIZE_STEP = 100  # Growth after a batch the service accepted without throttling
+UPLOAD_MAX_ATTEMPTS = 5
+MAX_BACKOFF_SECONDS = 30
+# Per-document statuses worth retrying: version conflict, index busy, throttled, unavailable
+RETRYABLE_STATUS_CODES = {409, 422, 429, 503}
 
-def index_to_search(chunks: List[Dict]) -> int:
+def create_search_client() -> SearchClient:
     """
-    Create/update index and upload chunks to Azure AI Search
+    Create/update index and return a client for uploading to it
     
-    Args:
-        chunks: List of chunks with embeddings
-        
     Returns:
-        Number of successfully indexed chunks
+        Search client for INDEX_NAME
     """
     if not AZURE_SEARCH_ENDPOINT or not AZURE_SEARCH_KEY:
         raise ValueError("AZURE_SEARCH_ENDPOINT and AZURE_SEARCH_KEY environment variables required")
@@ -48,45 +55,117 @@ def index_to_search(chunks: List[Dict]) -> int:
     
     ensure_index_exists(index_client)
     
-    # Upload documents
-    search_client = SearchClient(
+    return SearchClient(
         endpoint=AZURE_SEARCH_ENDPOINT,
         index_name=INDEX_NAME,
         credential=credential
     )
+
+def index_to_search(chunks: List[Dict], vectors: np.ndarray, search_client: Optional[SearchClient] = None) -> int:
+    """
+    Upload chunks to Azure AI Search
+    
+    Args:
+        chunks: List of chunks
+        vectors: Embedding matrix from generate_embeddings, one row per chunk
+        search_client: Client from create_search_client; created (with the index) if omitted
+        
+    Returns:
+        Number of successfully indexed chunks
+    """
+    if search_client is None:
+        search_client = create_search_client()
     
     indexed_count = 0
     
-    # Process in batches
-    for i in range(0, len(chunks), BATCH_SIZE):
-        batch = chunks[i:i + BATCH_SIZE]
+    # Process in batches; the size halves when the service throttles and grows back while it keeps up
+    batch_size = BATCH_SIZE
+    i = 0
+    while i < len(chunks):
+        batch = chunks[i:i + batch_size]
         
         try:
-            logger.debug(f"Uploading batch {i//BATCH_SIZE + 1}/{(len(chunks) + BATCH_SIZE - 1)//BATCH_SIZE}")
-            
-            # Convert chunks to search documents
-            documents = [chunk_to_search_document(chunk) for chunk in batch]
-            
-            # Upload with merge or upload (upsert) behavior
-            result = search_client.upload_documents(documents=documents)
+            logger.debug("Uploading %d chunks starting at index %d", len(batch), i)
             
-            # Count successful uploads
-            succeeded = sum(1 for r in result if r.succeeded)
+            # Chunks (create_chunk_dict fields) already match the index schema; each carries its
+            # matrix row as a list only while its batch uploads, so no per-batch copies are made
+            for chunk, vector in zip(batch, vectors[i:i + len(batch)].tolist()):
+                chunk['content_vector'] = vector
+            try:
+                # Upload with merge or upload (upsert) behavior, re-submitting throttled documents
+                succeeded, throttled = upload_documents_with_retry(search_client, batch)
+            finally:
+                for chunk in batch:
+                    del chunk['content_vector']
             indexed_count += succeeded
             
             if succeeded < len(batch):
                 failed = len(batch) - succeeded
                 logger.warning(f"Batch had {failed} failed uploads")
             else:
-                logger.debug(f"Successfully uploaded {succeeded} documents")
+                logger.debug("Successfully uploaded %d documents", succeeded)
                 
         except Exception as e:
             logger.error(f"Failed to upload batch starting at index {i}: {str(e)}")
             raise
+        
+        i += len(batch)
+        new_batch_size = max(MIN_BATCH_SIZE, batch_size // 2) if throttled else min(BATCH_SIZE, batch_size + BATCH_SIZE_STEP)
+        if new_batch_size != batch_size:
+            logger.info(f"Batch size: {batch_size} -> {new_batch_size}")
+            batch_size = new_batch_size
     
     logger.info(f"Successfully indexed {indexed_count} chunks to '{INDEX_NAME}'")
     return indexed_count
 
+def upload_documents_with_retry(search_client: SearchClient, documents: List[Dict]) -> Tuple[int, bool]:
+    """
+    Upload documents, retrying with exponential backoff when the service throttles
+    
+    A busy service either rejects the whole request (429/503) or individual documents;
+    only the rejected documents are re-submitted.
+    
+    Args:
+        search_client: Client for the target index
+        documents: Search documents to upload
+        
+    Returns:
+        Tuple of (documents indexed, whether any throttling occurred)
+    """
+    succeeded = 0
+    throttled = False
+    pending = documents
+    
+    for attempt in range(UPLOAD_MAX_ATTEMPTS):
+        last_attempt = attempt == UPLOAD_MAX_ATTEMPTS - 1
+        retry = []
+        try:
+            result = search_client.upload_documents(documents=pending)
+        except HttpResponseError as e:
+            if e.status_code not in (429, 503) or last_attempt:
+                raise
+            retry = pending
+        else:
+            by_key = {document['id']: document for document in pending}
+            for r in result:
+                if r.succeeded:
+                    succeeded += 1
+                elif r.status_code in RETRYABLE_STATUS_CODES and not last_attempt:
+                    retry.append(by_key[r.key])
+                else:
+                    logger.error(f"Failed to upload {r.key}: {r.error_message}")
+        
+        if not retry:
+            break
+        
+        throttled = True
+        delay = min(2 ** attempt, MAX_BACKOFF_SECONDS) * random.uniform(0.5, 1.0)
+        logger.warning(f"{len(retry)} of {len(pending)} documents throttled, retrying in {delay:.1f}s")
+        time.sleep(delay)
+        pending = retry
+    
+    return succeeded, throttled
+
 def ensure_index_exists(index_client: SearchIndexClient) -> None:
     """
     Create index if it doesn't exist
@@ -154,29 +233,3 @@ def ensure_index_exists(index_client: SearchIndexClient) -> None:
     
     index_client.create_index(index)
     logger.info(f"Successfully created index '{INDEX_NAME}'")
-
-def chunk_to_search_document(chunk: Dict) -> Dict:
-    """
-    Convert chunk dict to Azure Search document format
-    
-    Args:
-        chunk: Chunk with all required fields
-        
-    Returns:
-        Dict formatted for Azure Search
-    """
-    return {
-        'id': chunk['id'],
-        'document_id': chunk['document_id'],
-        'document_type': chunk['document_type'],
-        'title': chunk['title'],
-        'content': chunk['content'],
-        'content_vector': chunk['content_vector'],
-        'publication_date': chunk.get('publication_date'),
-        'effective_date': chunk.get('effective_date'),
-        'year': chunk.get('year'),
-        'section_number': chunk.get('section_number'),
-        'section_heading': chunk.get('section_heading'),
-        'chunk_index': chunk['chunk_index'],
-        'last_modified': chunk['last_modified']
-    }
@@ -2,16 +2,18 @@
 Finlex Legal Document Ingestion Pipeline
 Orchestrates download, extraction, chunking, embedding, and indexing of Finnish legal documents
 """
+import asyncio
 import logging
 import os
 import sys
 from datetime import datetime
+from typing import Dict, List
 from download import download_finlex_archive
 from extract import extract_xml_files
-from parse import parse_finlex_documents
+from parse import create_parse_executor, parse_finlex_documents
 from chunk import chunk_documents
-from embed import generate_embeddings
-from index import index_to_search
+from embed import create_embedding_client, embed_chunks
+from index import create_search_client, index_to_search
 
 # Configure logging
 logging.basicConfig(
@@ -29,6 +31,58 @@ STORAGE_ACCOUNT_NAME = os.getenv("AZURE_STORAGE_ACCOUNT_NAME")
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 
+# Steps 3-6 run as a pipeline over batches of documents, so embedding and indexing requests
+# overlap with parsing and chunking; the queues bound how many batches wait between steps
+PIPELINE_BATCH_DOCS = 256
+PIPELINE_QUEUE_BATCHES = 2
+
+async def run_pipeline(xml_files: List[Dict], ingest_ts: str) -> Dict[str, int]:
+    """
+    Parse, chunk, embed and index documents batch by batch, each step running concurrently
+    
+    Args:
+        xml_files: Extracted XML files
+        ingest_ts: ISO timestamp recorded as every document's last_modified
+        
+    Returns:
+        Dict of documents parsed, chunks created and chunks indexed
+    """
+    counts = {'documents': 0, 'chunks': 0, 'indexed': 0}
+    chunk_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_BATCHES)
+    index_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_BATCHES)
+    
+    async def parse_and_chunk():
+        # CPU work runs off the event loop: parsing in the process pool, chunking in a thread
+        with create_parse_executor() as parser:
+            for start in range(0, len(xml_files), PIPELINE_BATCH_DOCS):
+                batch = xml_files[start:start + PIPELINE_BATCH_DOCS]
+                # chunk_documents only falls back to full_text for documents without sections
+                documents = await asyncio.to_thread(parse_finlex_documents, batch, parser, full_text_fallback_only=True, ingest_ts=ingest_ts)
+                chunks = await asyncio.to_thread(chunk_documents, documents)
+                counts['documents'] += len(documents)
+                counts['chunks'] += len(chunks)
+                if chunks:
+                    await chunk_queue.put(chunks)
+        await chunk_queue.put(None)
+    
+    async def embed():
+        async with create_embedding_client() as client:
+            while (chunks := await chunk_queue.get()) is not None:
+                vectors = await embed_chunks(client, chunks)
+                await index_queue.put((chunks, vectors))
+        await index_queue.put(None)
+    
+    async def index():
+        search_client = await asyncio.to_thread(create_search_client)
+        while (batch := await index_queue.get()) is not None:
+            chunks, vectors = batch
+            counts['indexed'] += await asyncio.to_thread(index_to_search, chunks, vectors, search_client)
+            logger.info(f"Progress: {counts['documents']}/{len(xml_files)} files parsed, {counts['indexed']} chunks indexed")
+    
+    # A failing step fails the pipeline; asyncio.run cancels the steps still waiting on their queues
+    await asyncio.gather(parse_and_chunk(), embed(), index())
+    return counts
+
 def main():
     """Main orchestration function for Finlex ingestion pipeline"""
     start_time = datetime.now()
@@ -50,33 +104,15 @@ def main():
         xml_files = extract_xml_files(archive_path, TARGET_YEARS)
         logger.info(f"Extracted {len(xml_files)} XML files")
         
-        # Step 3: Parse documents and extract metadata
-        logger.info("=" * 80)
-        logger.info("STEP 3: Parsing documents")
-        logger.info("=" * 80)
-        documents = parse_finlex_documents(xml_files)
-        logger.info(f"Parsed {len(documents)} documents")
-        
-        # Step 4: Chunk documents for optimal search
-        logger.info("=" * 80)
-        logger.info("STEP 4: Chunking documents")
-        logger.info("=" * 80)
-        chunks = chunk_documents(documents)
-        logger.info(f"Created {len(chunks)} chunks")
-        
-        # Step 5: Generate embeddings for chunks
-        logger.info("=" * 80)
-        logger.info("STEP 5: Generating embeddings")
-        logger.info("=" * 80)
-        chunks_with_embeddings = generate_embeddings(chunks)
-        logger.info(f"Generated embeddings for {len(chunks_with_embeddings)} chunks")
-        
-        # Step 6: Index to Azure AI Search
+        # Steps 3-6: Parse, chunk, embed and index, pipelined over batches of documents
         logger.info("=" * 80)
-        logger.info("STEP 6: Indexing to Azure AI Search")
+        logger.info("STEPS 3-6: Parsing, chunking, embedding and indexing documents")
         logger.info("=" * 80)
-        indexed_count = index_to_search(chunks_with_embeddings)
-        logger.info(f"Successfully indexed {indexed_count} chunks")
+        # One ingestion timestamp for the whole run, rather than one per parsed document
+        ingest_ts = datetime.utcnow().isoformat()
+        counts = asyncio.run(run_pipeline(xml_files, ingest_ts))
+        logger.info(f"Parsed {counts['documents']} documents into {counts['chunks']} chunks")
+        logger.info(f"Successfully indexed {counts['indexed']} chunks")
         
         # Summary
         duration = (datetime.now() - start_time).total_seconds()
@@ -84,9 +120,9 @@ def main():
         logger.info("PIPELINE COMPLETED SUCCESSFULLY")
         logger.info("=" * 80)
         logger.info(f"Total execution time: {duration:.2f} seconds ({duration/60:.1f} minutes)")
-        logger.info(f"Documents processed: {len(documents)}")
-        logger.info(f"Chunks created: {len(chunks)}")
-        logger.info(f"Chunks indexed: {indexed_count}")
+        logger.info(f"Documents processed: {counts['documents']}")
+        logger.info(f"Chunks created: {counts['chunks']}")
+        logger.info(f"Chunks indexed: {counts['indexed']}")
         
     except Exception as e:
         logger.error("Pipeline failed with error", exc_info=True)
@@ -1,94 +1,208 @@
 """
 Parse module for processing Finlex Akoma Ntoso (AKN) legal document XML
 """
+import io
 import logging
-import xml.etree.ElementTree as ET
-from typing import List, Dict
+import multiprocessing
+import os
+import threading
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime
+from lxml import etree
 
 logger = logging.getLogger(__name__)
 
+# Documents are parsed in separate processes, since walking the trees holds the GIL
+PARSE_PROCESSES = int(os.getenv("PARSE_PROCESSES", str(os.cpu_count() or 1)))
+PARSE_TASKS_PER_PROCESS = 4  # Batches handed to each process, to even out document sizes
+
 # AKN namespace
-AKN_NS = {'akn': 'http://docs.oasis-open.org/legaldocml/ns/akn/3.0'}
+AKN = '{http://docs.oasis-open.org/legaldocml/ns/akn/3.0}'
+AKN_DOC_TITLE = AKN + 'docTitle'
+AKN_PUBLICATION = AKN + 'publication'
+AKN_FRBR_DATE = AKN + 'FRBRdate'
+AKN_FRBR_WORK = AKN + 'FRBRWork'
+AKN_FRBR_TYPE = AKN + 'FRBRtype'
+AKN_NUM = AKN + 'num'
+AKN_HEADING = AKN + 'heading'
+AKN_PARAGRAPH = AKN + 'p'
+
+# Section-like elements and their hierarchy levels; sections are listed first, then chapters, then articles
+SECTION_LEVELS = {
+    AKN + 'section': 1,
+    AKN + 'chapter': 0,
+    AKN + 'article': 2,
+}
+
+# Elements scan_document looks at; lxml filters the walk by tag in C, skipping all others
+SCANNED_TAGS = (AKN_DOC_TITLE, AKN_PUBLICATION, AKN_FRBR_DATE, AKN_FRBR_WORK, *SECTION_LEVELS)
+
+# Markdown heading marks by hierarchy level in the full text (H2-H6)
+HEADING_MARKS = {level: "#" * min(level + 2, 6) for level in SECTION_LEVELS.values()}
+
+# Parser settings; comments and processing instructions are dropped so element text matches
+# ElementTree's, and xml:id values are not indexed since nothing looks them up. Entities are not
+# expanded and nothing is fetched over the network, and huge_tree lifts libxml2's depth and
+# text-size limits for large statutes. Blank text is kept: between inline elements of a
+# paragraph it is the space separating their words
+XML_PARSER_OPTIONS = dict(
+    remove_comments=True,
+    remove_pis=True,
+    collect_ids=False,
+    resolve_entities=False,
+    no_network=True,
+    huge_tree=True
+)
+
+# Documents larger than this are scanned incrementally, freeing each section's subtree once it
+# has been read, instead of building the whole tree first
+STREAM_PARSE_THRESHOLD = 2 * 1024 * 1024
+
+# Elements scan_document_stream receives events for
+STREAMED_TAGS = (*SCANNED_TAGS, AKN_FRBR_TYPE, AKN_PARAGRAPH, AKN_NUM, AKN_HEADING)
 
-def parse_finlex_documents(xml_files: List[Dict]) -> List[Dict]:
+# Each thread reuses one parser across documents: an lxml parser serialises concurrent parses
+# behind its own lock, so a single shared instance would make parsing threads wait on each other
+_thread_local = threading.local()
+
+def get_xml_parser() -> etree.XMLParser:
+    """This thread's XML parser, created on first use"""
+    parser = getattr(_thread_local, 'xml_parser', None)
+    if parser is None:
+        parser = _thread_local.xml_parser = etree.XMLParser(**XML_PARSER_OPTIONS)
+    return parser
+
+def create_parse_executor() -> ProcessPoolExecutor:
+    """Process pool for parse_finlex_documents, reusable across calls"""
+    return ProcessPoolExecutor(
+        max_workers=PARSE_PROCESSES,
+        mp_context=multiprocessing.get_context("spawn")
+    )
+
+def parse_finlex_documents(
+    xml_files: List[Dict],
+    executor: Optional[ProcessPoolExecutor] = None,
+    full_text_fallback_only: bool = False,
+    ingest_ts: Optional[str] = None
+) -> List[Dict]:
     """
     Parse Finlex XML documents and extract structured content
     
     Args:
         xml_files: List of dicts with 'filename', 'content', 'year', 'short_name'
+        executor: Pool from create_parse_executor to parse in; a pool is created for this call if omitted
+        full_text_fallback_only: Build full_text only for documents without sections (see parse_akn_document)
+        ingest_ts: ISO timestamp stored as every document's last_modified; the time of this call if omitted
         
     Returns:
         List of parsed document dicts with metadata and structured content
     """
-    documents = []
-    
-    for xml_file in xml_files:
-        try:
-            doc = parse_akn_document(xml_file['content'])
-            if doc:
-                # Add file metadata
-                doc['filename'] = xml_file['filename']
-                doc['short_name'] = xml_file['short_name']
-                doc['year'] = xml_file['year']
-                doc['document_id'] = extract_document_id(xml_file['filename'])
-                
-                documents.append(doc)
-                logger.debug(f"Parsed: {xml_file['short_name']}")
-            else:
-                logger.warning(f"No content extracted from: {xml_file['short_name']}")
-                
-        except Exception as e:
-            logger.error(f"Failed to parse {xml_file.get('short_name', 'unknown')}: {str(e)}")
+    if ingest_ts is None:
+        ingest_ts = datetime.utcnow().isoformat()
+    
+    if executor is None and PARSE_PROCESSES > 1 and len(xml_files) > 1:
+        with create_parse_executor() as executor:
+            return parse_finlex_documents(xml_files, executor, full_text_fallback_only, ingest_ts)
+    
+    parse = partial(parse_xml_file, full_text_fallback_only=full_text_fallback_only, ingest_ts=ingest_ts)
+    if executor is not None:
+        chunksize = max(1, len(xml_files) // (PARSE_PROCESSES * PARSE_TASKS_PER_PROCESS))
+        documents = [doc for doc in executor.map(parse, xml_files, chunksize=chunksize) if doc]
+    else:
+        documents = [doc for doc in map(parse, xml_files) if doc]
     
     logger.info(f"Successfully parsed {len(documents)} documents")
     return documents
 
-def parse_akn_document(xml_content: bytes) -> Dict:
+def parse_xml_file(xml_file: Dict, full_text_fallback_only: bool = False, ingest_ts: Optional[str] = None) -> Optional[Dict]:
+    """
+    Parse one extracted XML file; runs in a parse worker process
+    
+    Args:
+        xml_file: Dict with 'filename', 'content', 'year', 'short_name'
+        full_text_fallback_only: Passed on to parse_akn_document
+        ingest_ts: Passed on to parse_akn_document
+        
+    Returns:
+        Parsed document dict with file metadata, or None if nothing could be extracted
+    """
+    try:
+        doc = parse_akn_document(xml_file['content'], full_text_fallback_only, ingest_ts)
+        if doc:
+            # Add file metadata
+            doc['filename'] = xml_file['filename']
+            doc['short_name'] = xml_file['short_name']
+            doc['year'] = xml_file['year']
+            doc['document_id'] = extract_document_id(xml_file['filename'])
+            
+            logger.debug("Parsed: %s", xml_file['short_name'])
+            return doc
+        else:
+            logger.warning(f"No content extracted from: {xml_file['short_name']}")
+            
+    except Exception as e:
+        logger.error(f"Failed to parse {xml_file.get('short_name', 'unknown')}: {str(e)}")
+    
+    return None
+
+def parse_akn_document(xml_content: bytes, full_text_fallback_only: bool = False, ingest_ts: Optional[str] = None) -> Dict:
     """
     Parse AKN XML document and extract structured content
     
     Args:
         xml_content: Raw XML bytes
+        full_text_fallback_only: Build full_text only when there are no sections; chunk_documents
+            reads it just for those documents, so for the rest it would be rendered for nothing
+        ingest_ts: ISO timestamp to store as last_modified; the current time if omitted
         
     Returns:
-        Dict with title, sections, metadata
+        Dict with title, sections, metadata; full_text is None when it was skipped. None if the
+        document has neither sections nor a title, as there is nothing to index
     """
     try:
-        root = ET.fromstring(xml_content)
+        # Metadata elements and structured sections, collected in one pass over the tree
+        if len(xml_content) > STREAM_PARSE_THRESHOLD:
+            elements, sections = scan_document_stream(xml_content)
+        else:
+            root = etree.fromstring(xml_content, get_xml_parser())
+            elements, sections = scan_document(root)
         
         # Extract document title
-        title_elem = root.find('.//akn:docTitle', AKN_NS)
+        title_elem = elements.get('docTitle')
         title = title_elem.text.strip() if title_elem is not None and title_elem.text else "Untitled"
         
+        # Without sections or a title the full text would be just "# Untitled"
+        if not sections and title == "Untitled":
+            return None
+        
         # Extract publication date
-        pub_date_elem = root.find('.//akn:publication[@date]', AKN_NS)
+        pub_date_elem = elements.get('publication')
         pub_date = pub_date_elem.get('date') if pub_date_elem is not None else None
         
         # Extract effective date
-        eff_date_elem = root.find('.//akn:FRBRdate[@name="vigencyDate"]', AKN_NS)
+        eff_date_elem = elements.get('FRBRdate')
         eff_date = eff_date_elem.get('date') if eff_date_elem is not None else None
         
         # Extract document type
-        doc_type_elem = root.find('.//akn:FRBRWork/akn:FRBRtype', AKN_NS)
+        doc_type_elem = elements.get('FRBRtype')
         doc_type = doc_type_elem.get('value') if doc_type_elem is not None else "statute"
         
-        # Extract structured sections with hierarchy
-        sections = extract_sections(root)
-        
-        # Build full text for chunking (preserve structure)
-        full_text_parts = [f"# {title}\n"]
-        for section in sections:
-            level = section.get('level', 0)
-            indent = "#" * min(level + 2, 6)  # H2-H6
-            
-            if section.get('heading'):
-                full_text_parts.append(f"\n{indent} {section['heading']}\n")
+        # Build full text for chunking (preserve structure); every part after the title starts on a new line
+        full_text = None
+        if not (full_text_fallback_only and sections):
+            buffer = io.StringIO()
+            buffer.write(f"# {title}\n")
+            for section in sections:
+                heading = section['heading']
+                if heading:
+                    buffer.write(f"\n\n{HEADING_MARKS[section['level']]} {heading}\n")
+                
+                for para in section['paragraphs']:
+                    buffer.write(f"\n{para}\n")
             
-            for para in section.get('paragraphs', []):
-                full_text_parts.append(f"{para}\n")
-        
-        full_text = '\n'.join(full_text_parts)
+            full_text = buffer.getvalue()
         
         return {
             'title': title,
@@ -97,44 +211,146 @@ def parse_akn_document(xml_content: bytes) -> Dict:
             'effective_date': eff_date,
             'sections': sections,
             'full_text': full_text,
-            'last_modified': datetime.utcnow().isoformat()
+            'last_modified': ingest_ts or datetime.utcnow().isoformat()
         }
         
     except Exception as e:
         logger.error(f"XML parsing error: {str(e)}")
         return None
 
-def extract_sections(root: ET.Element) -> List[Dict]:
+def scan_document(root: etree._Element) -> Tuple[Dict, List[Dict]]:
     """
-    Extract hierarchical sections from AKN document
+    Walk an AKN document once, collecting metadata elements and hierarchical sections
     
     Args:
         root: XML root element
         
     Returns:
-        List of section dicts with headings, paragraphs, hierarchy
+        Tuple of (first docTitle, dated publication, vigencyDate FRBRdate and FRBRWork's FRBRtype
+        element by local name, list of section dicts with headings, paragraphs, hierarchy)
     """
-    sections = []
+    elements = {}
+    sections_by_tag = {tag: [] for tag in SECTION_LEVELS}
     
-    # Find all sections, chapters, articles
-    for elem in root.findall('.//akn:section', AKN_NS):
-        section = extract_section_content(elem, level=1)
-        if section:
-            sections.append(section)
+    for elem in root.iter(*SCANNED_TAGS):
+        if elem is root:
+            continue
+        
+        tag = elem.tag
+        if tag in SECTION_LEVELS:
+            section = extract_section_content(elem, level=SECTION_LEVELS[tag])
+            if section:
+                sections_by_tag[tag].append(section)
+        elif tag == AKN_DOC_TITLE:
+            elements.setdefault('docTitle', elem)
+        elif tag == AKN_PUBLICATION:
+            if elem.get('date') is not None:
+                elements.setdefault('publication', elem)
+        elif tag == AKN_FRBR_DATE:
+            if elem.get('name') == "vigencyDate":
+                elements.setdefault('FRBRdate', elem)
+        elif tag == AKN_FRBR_WORK and 'FRBRtype' not in elements:
+            doc_type_elem = elem.find(AKN_FRBR_TYPE)
+            if doc_type_elem is not None:
+                elements['FRBRtype'] = doc_type_elem
+    
+    sections = [section for tag_sections in sections_by_tag.values() for section in tag_sections]
+    return elements, sections
+
+def scan_document_stream(xml_content: bytes) -> Tuple[Dict, List[Dict]]:
+    """
+    Scan a large AKN document while it is parsed; same results as scan_document
+    
+    Every open section-like element collects the first num and heading and the paragraphs that
+    start inside it, so a section's subtree can be cleared as soon as it ends, even when it sits
+    inside a chapter. Paragraphs are kept intact until they end, since their inline children and
+    tails make up their text.
+    
+    Args:
+        xml_content: Raw XML bytes
+        
+    Returns:
+        Tuple as from scan_document
+    """
+    elements = {}
+    sections_by_tag = {tag: [] for tag in SECTION_LEVELS}
+    open_sections = []  # [element, section dict, first num, first heading] per open section
+    open_paragraphs = []  # (element, [(section dict, paragraph slot)]) per open p
+    work_order = {}  # FRBRWork -> position in document order
+    work_types = {}  # FRBRWork -> its first FRBRtype child
     
-    for elem in root.findall('.//akn:chapter', AKN_NS):
-        section = extract_section_content(elem, level=0)
-        if section:
-            sections.append(section)
+    for event, elem in etree.iterparse(io.BytesIO(xml_content), events=('start', 'end'), tag=STREAMED_TAGS, **XML_PARSER_OPTIONS):
+        if elem.getparent() is None:
+            continue
+        
+        tag = elem.tag
+        if event == 'start':
+            # Document order is start order; paragraph slots are reserved here so that nested
+            # paragraphs keep it, and filled when the paragraph ends
+            if tag in SECTION_LEVELS:
+                section = {'level': SECTION_LEVELS[tag], 'number': None, 'heading': None, 'paragraphs': []}
+                sections_by_tag[tag].append(section)
+                open_sections.append([elem, section, None, None])
+            elif tag == AKN_PARAGRAPH:
+                slots = []
+                for _, section, _, _ in open_sections:
+                    slots.append((section, len(section['paragraphs'])))
+                    section['paragraphs'].append(None)
+                open_paragraphs.append((elem, slots))
+            elif tag == AKN_NUM:
+                for state in open_sections:
+                    if state[2] is None:
+                        state[2] = elem
+            elif tag == AKN_HEADING:
+                for state in open_sections:
+                    if state[3] is None:
+                        state[3] = elem
+            elif tag == AKN_DOC_TITLE:
+                elements.setdefault('docTitle', elem)
+            elif tag == AKN_PUBLICATION:
+                if elem.get('date') is not None:
+                    elements.setdefault('publication', elem)
+            elif tag == AKN_FRBR_DATE:
+                if elem.get('name') == "vigencyDate":
+                    elements.setdefault('FRBRdate', elem)
+            elif tag == AKN_FRBR_WORK:
+                work_order[elem] = len(work_order)
+            elif tag == AKN_FRBR_TYPE:
+                parent = elem.getparent()
+                if parent in work_order:
+                    work_types.setdefault(parent, elem)
+            continue
+        
+        if tag == AKN_PARAGRAPH:
+            _, slots = open_paragraphs.pop()
+            text = elem.text if len(elem) == 0 else ''.join(elem.itertext())
+            if text:
+                text = text.strip()
+                if text:
+                    for section, slot in slots:
+                        section['paragraphs'][slot] = text
+        elif tag in SECTION_LEVELS:
+            _, section, num_elem, heading_elem = open_sections.pop()
+            section['number'] = num_elem.text.strip() if num_elem is not None and num_elem.text else None
+            section['heading'] = heading_elem.text.strip() if heading_elem is not None and heading_elem.text else None
+            section['paragraphs'] = [para for para in section['paragraphs'] if para is not None]
+        else:
+            continue
+        
+        # Everything this subtree contributes has been collected; elements still referenced
+        # (first num, heading, metadata) survive being unlinked
+        if not open_paragraphs:
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
     
-    for elem in root.findall('.//akn:article', AKN_NS):
-        section = extract_section_content(elem, level=2)
-        if section:
-            sections.append(section)
+    if work_types:
+        elements['FRBRtype'] = work_types[min(work_types, key=work_order.__getitem__)]
     
-    return sections
+    sections = [section for tag_sections in sections_by_tag.values() for section in tag_sections]
+    return elements, sections
 
-def extract_section_content(elem: ET.Element, level: int) -> Dict:
+def extract_section_content(elem: etree._Element, level: int) -> Dict:
     """
     Extract content from a section element
     
@@ -145,21 +361,28 @@ def extract_section_content(elem: ET.Element, level: int) -> Dict:
     Returns:
         Dict with heading, paragraphs, level, number
     """
-    # Extract section number
-    num_elem = elem.find('.//akn:num', AKN_NS)
-    number = num_elem.text.strip() if num_elem is not None and num_elem.text else None
-    
-    # Extract heading
-    heading_elem = elem.find('.//akn:heading', AKN_NS)
-    heading = heading_elem.text.strip() if heading_elem is not None and heading_elem.text else None
-    
-    # Extract paragraphs
+    # One walk over the subtree, filtered by tag in C: the first num and heading in document
+    # order give the section number and heading, every p a paragraph with its inline text
+    num_elem = None
+    heading_elem = None
     paragraphs = []
-    for para in elem.findall('.//akn:p', AKN_NS):
-        if para.text:
-            text = para.text.strip()
+    for child in elem.iterdescendants(AKN_PARAGRAPH, AKN_NUM, AKN_HEADING):
+        tag = child.tag
+        if tag == AKN_PARAGRAPH:
+            # Inline elements (refs, emphasis) split a paragraph's text; only then join the pieces
+            text = child.text if len(child) == 0 else ''.join(child.itertext())
             if text:
-                paragraphs.append(text)
+                text = text.strip()
+                if text:
+                    paragraphs.append(text)
+        elif tag == AKN_NUM:
+            if num_elem is None:
+                num_elem = child
+        elif heading_elem is None:
+            heading_elem = child
+    
+    number = num_elem.text.strip() if num_elem is not None and num_elem.text else None
+    heading = heading_elem.text.strip() if heading_elem is not None and heading_elem.text else None
     
     return {
         'level': level,
@@ -179,9 +402,4 @@ def extract_document_id(filename: str) -> str:
         Document identifier
     """
     # Extract ID from path like "akn/fi/act/statute-consolidated/2024/1234.xml"
-    parts = filename.split('/')
-    if len(parts) > 0:
-        basename = parts[-1]
-        doc_id = basename.replace('.xml', '')
-        return doc_id
-    return filename
+    return os.path.basename(filename).removesuffix('.xml')